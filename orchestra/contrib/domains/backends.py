@@ -25,6 +25,7 @@ class Bind9MasterDomainController(ServiceController):
         ('domains.Record', 'domain__origin'),
         ('domains.Domain', 'origin'),
     )
+    prefetch_related = ('records', 'subdomain_set__records')
     ignore_fields = ('serial',)
     doc_settings = (settings,
         ('DOMAINS_MASTERS_PATH',)
@@ -109,7 +110,7 @@ class Bind9MasterDomainController(ServiceController):
     def get_servers(self, domain, backend):
         """ Get related server IPs from registered backend routes """
         from orchestra.contrib.orchestration.manager import router
-        operation = Operation(backend, domain, Operation.SAVE)
+        operation = Operation(backend, domain, Operation.SAVE, copy_instance=False)
         servers = []
         for route in router.objects.get_for_operation(operation):
             servers.append(route.host.get_ip())
@@ -125,7 +125,10 @@ class Domain(models.Model):
     
     def get_subdomains(self):
         """ proxy method, needed for input validation, see helpers.domain_for_validation """
-        return self.origin.subdomain_set.all().prefetch_related('records')
+        origin = self.origin
+        if 'subdomain_set' in getattr(origin, '_prefetched_objects_cache', {}):
+            return origin.subdomain_set.all()
+        return origin.subdomain_set.all().prefetch_related('records')
     
     def get_parent(self, top=False):
         return type(self).objects.get_parent(self.name, top=top)
@@ -239,7 +239,9 @@ class MailmanTraffic(ServiceMonitor):
         context = {
             'postlogs': str((postlog, postlog+'.1')),
             'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
+            'cursor_path': repr(self.get_log_cursor_path(postlog)),
         }
+        self.append_log_reader()
         self.append(textwrap.dedent("""\
             import re
             import subprocess
@@ -254,6 +256,7 @@ class MailmanTraffic(ServiceMonitor):
                 return date
             
             postlogs = {postlogs}
+            cursor_path = {cursor_path}
             # Use local timezone
             end_date = to_local_timezone('{current_date}')
             end_date = int(end_date.strftime('%Y%m%d%H%M%S'))
@@ -280,33 +283,37 @@ class MailmanTraffic(ServiceMonitor):
                 ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
                 lists[list_name] = [ini_date, object_id, 0]
             
-            def monitor(lists, end_date, months, postlogs):
-                for postlog in postlogs:
-                    try:
-                        with open(postlog, 'r') as postlog:
-                            for line in postlog.readlines():
-                                line = line.split()
-                                if len(line) < 11:
-                                    continue
-                                month, day, time, year, __, __, __, list_name, __, addr, size = line[:11]
+            def get_date(line):
+                try:
+                    month, day, time, year = line.split()[:4]
+                    return int(year + months[month] + day + time.replace(':', ''))
+                except (ValueError, KeyError):
+                    return None
+            
+            def monitor(lists, end_date, months, postlogs, cursor_path):
+                if lists:
+                    # Single pass over the new lines for all lists
+                    ini_date = min(list[0] for list in lists.values())
+                    for date, line in read_logs(postlogs, cursor_path, ini_date, end_date, get_date):
+                        line = line.split()
+                        if len(line) < 11:
+                            continue
+                        __, __, __, __, __, __, __, list_name, __, addr, size = line[:11]
+                        try:
+                            list = lists[list_name]
+                        except KeyError:
+                            continue
+                        else:
+                            # discard mailman messages because of inconsistent POST logging
+                            if mailman_addr.match(addr):
+                                continue
+                            if list[0] < date:
+                                size = size[5:-1]
                                 try:
-                                    list = lists[list_name]
-                                except KeyError:
-                                    continue
-                                else:
-                                    # discard mailman messages because of inconsistent POST logging
-                                    if mailman_addr.match(addr):
-                                        continue
-                                    date = year + months[month] + day + time.replace(':', '')
-                                    if list[0] < int(date) < end_date:
-                                        size = size[5:-1]
-                                        try:
-                                            list[2] += int(size)
-                                        except ValueError:
-                                            # anonymized post
-                                            pass
-                    except IOError as e:
-                        sys.stderr.write(str(e)+'\\n')
+                                    list[2] += int(size)
+                                except ValueError:
+                                    # anonymized post
+                                    pass
                 
                 for list_name, opts in lists.items():
                     __, object_id, size = opts
@@ -325,7 +332,7 @@ class MailmanTraffic(ServiceMonitor):
         self.append("prepare(%(object_id)s, '%(list_name)s', '%(last_date)s')" % context)
     
     def commit(self):
-        self.append('monitor(lists, end_date, months, postlogs)')
+        self.append('monitor(lists, end_date, months, postlogs, cursor_path)')
     
     def get_context(self, mail_list):
         context = {
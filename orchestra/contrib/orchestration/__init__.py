@@ -1,8 +1,11 @@
 import collections
 import copy
 
+from django.utils.encoding import force_text
+
 from orchestra.utils.python import AttrDict
 
+from . import settings
 from .backends import ServiceBackend, ServiceController, replace
 
 
@@ -24,25 +27,51 @@ class Operation():
     
     def __hash__(self):
         """ set() """
-        return hash((self.backend, self.instance, self.action))
+        return hash(self.key)
     
     def __eq__(self, operation):
         """ set() """
         return hash(self) == hash(operation)
     
-    def __init__(self, backend, instance, action, routes=None):
+    def __init__(self, backend, instance, action, routes=None, copy_instance=True):
         self.backend = backend
         # instance should maintain any dynamic attribute until backend execution
-        # deep copy is prefered over copy otherwise objects will share same atributes (queryset cache)
-        self.instance = copy.deepcopy(instance)
+        if not copy_instance:
+            # i.e. mocks used for set lookups
+            self.instance = instance
+        elif action == self.DELETE:
+            # Deleted objects can not be fetched again, preload_context() needs their full state
+            self.instance = copy.deepcopy(instance)
+        else:
+            self.instance = self.snapshot(instance)
         self.action = action
         self.routes = routes
+        # Hash of the script section generated for this operation, see manager.generate()
+        self.script_hash = None
+        opts = instance._meta
+        self.key = (backend, opts.label, instance.pk, action)
+    
+    @staticmethod
+    def snapshot(instance):
+        """
+        Lightweight copy that keeps field values and dynamic attributes
+        
+        Related objects are shared with the original instance, while its model state and
+        prefetch cache are copied, so objects do not share the same atributes (queryset cache)
+        """
+        snapshot = instance.__class__.__new__(instance.__class__)
+        snapshot.__dict__.update(instance.__dict__)
+        snapshot._state = copy.copy(instance._state)
+        prefetched = instance.__dict__.get('_prefetched_objects_cache')
+        if prefetched is not None:
+            snapshot._prefetched_objects_cache = dict(prefetched)
+        return snapshot
     
     @classmethod
-    def execute(cls, operations, serialize=False, async=None):
+    def execute(cls, operations, serialize=False, async=None, force=False):
         from . import manager
-        scripts, backend_serialize = manager.generate(operations)
-        return manager.execute(scripts, serialize=(serialize or backend_serialize), async=async)
+        scripts = manager.generate(operations, force=force)
+        return manager.execute(scripts, serialize=serialize, async=async)
     
     @classmethod
     def create_for_action(cls, instances, action):
@@ -78,8 +107,39 @@ class Operation():
             backend=self.backend.get_name(),
             instance=self.instance,
             action=self.action,
+            script_hash=self.script_hash or '',
         )
     
+    @classmethod
+    def bulk_store(cls, operations, log, batch_size=None):
+        """
+        Stores operations with one INSERT per batch_size operations,
+        content types are resolved once per model
+        """
+        from django.contrib.contenttypes.models import ContentType
+        from .models import BackendOperation
+        batch_size = batch_size or settings.ORCHESTRATION_OPERATION_BATCH_SIZE
+        content_types = {}
+        objs = []
+        for operation in operations:
+            instance = operation.instance
+            model = type(instance)
+            try:
+                content_type = content_types[model]
+            except KeyError:
+                content_type = ContentType.objects.get_for_model(instance)
+                content_types[model] = content_type
+            objs.append(BackendOperation(
+                log=log,
+                backend=operation.backend.get_name(),
+                action=operation.action,
+                content_type=content_type,
+                object_id=instance.pk,
+                instance_repr=force_text(instance)[:256],
+                script_hash=operation.script_hash or '',
+            ))
+        return BackendOperation.objects.bulk_create(objs, batch_size=batch_size)
+    
     @classmethod
     def load(cls, operation, log=None):
         routes = None
@@ -27,7 +27,8 @@ def retry_backend(modeladmin, request, queryset):
         if not operations:
             messages.warning(request, _("No backend operation has been executed."))
         else:
-            logs = Operation.execute(operations)
+            # Retries are executed even if their scripts have not changed
+            logs = Operation.execute(operations, force=True)
             message_user(request, logs)
         for backendlog in queryset:
             modeladmin.log_change(request, backendlog, 'Retried')
@@ -89,10 +90,9 @@ def orchestrate(modeladmin, request, queryset):
                 models.add(model)
         querysets = [model.objects.order_by('id') for model in models]
         
-        route_cache = {}
         for model in models:
             for instance in model.objects.all():
-                manager.collect(instance, action, operations=operations, route_cache=route_cache)
+                manager.collect(instance, action, operations=operations)
             routes = []
         result = []
         for operation in operations:
@@ -154,8 +154,10 @@ class BackendLogAdmin(ChangeViewActionsMixin, admin.ModelAdmin):
     display_created = admin_date('created_at', short_description=_("Created"))
     display_state = admin_colored('state', colors=STATE_COLORS)
     display_script = display_code('script')
-    mono_stdout = display_mono('stdout')
-    mono_stderr = display_mono('stderr')
+    mono_stdout = display_mono('current_stdout')
+    mono_stdout.short_description = 'stdout'
+    mono_stderr = display_mono('current_stderr')
+    mono_stderr.short_description = 'stderr'
     mono_traceback = display_mono('traceback')
     
     class Media:
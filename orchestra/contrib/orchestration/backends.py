@@ -1,13 +1,16 @@
+import hashlib
+import re
 import textwrap
 from functools import partial
 
 from django.apps import apps
+from django.db.models.query import prefetch_related_objects
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from orchestra import plugins
 
-from . import methods
+from . import methods, settings
 
 
 def replace(context, pattern, repl):
@@ -44,8 +47,13 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
     ignore_fields = []
     actions = []
     default_route_match = 'True'
-    # Force the backend manager to block in multiple backend executions executing them synchronously
+    # Run after all the backends scheduled before it, on any server, and before the ones after it
     serialize = False
+    # Names of the backends that have to finish before this one when both run on the same server
+    dependencies = ()
+    # Related objects fetched in bulk for all the instances of an execution, see prefetch()
+    select_related = ()
+    prefetch_related = ()
     doc_settings = None
     # By default backend will not run if actions do not generate insctructions,
     # If your backend uses prepare() or commit() only then you should set force_empty_action_execution = True
@@ -104,20 +112,60 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
         opts = obj._meta
         return cls.model == '%s.%s' % (opts.app_label, opts.object_name)
     
+    @classmethod
+    def depends_on(cls, backend):
+        """ whether cls has to run after backend, dependencies also match backend's base classes """
+        return any(base.__name__ in cls.dependencies for base in backend.__mro__)
+    
     @classmethod
     def get_related(cls, obj):
         opts = obj._meta
         model = '%s.%s' % (opts.app_label, opts.object_name)
         for rel_model, field in cls.related_models:
             if rel_model == model:
-                related = obj
-                for attribute in field.split('__'):
-                    related = getattr(related, attribute)
-                if type(related).__name__ == 'RelatedManager':
-                    return related.all()
-                return [related]
+                return cls.resolve_related(obj, field.split('__'))
         return []
     
+    @staticmethod
+    def resolve_related(obj, path):
+        related = obj
+        for attribute in path:
+            related = getattr(related, attribute)
+        if type(related).__name__ == 'RelatedManager':
+            return related.all()
+        return [related]
+    
+    @classmethod
+    def get_dispatch_table(cls):
+        """
+        Maps 'app.Model' labels to the backends interested on them, as (backend, is_model, path)
+        tuples, where path is the related_models accessor split on '__'.
+        Lazily built and rebuilt only when new backends get registered.
+        """
+        backends = cls.get_backends()
+        size, table = cls.__dict__.get('_dispatch_table', (None, None))
+        if size != len(backends):
+            table = {}
+            for backend in backends:
+                models = [backend.model]
+                models += [rel_model for rel_model, __ in backend.related_models]
+                for model in models:
+                    if any(entry[0] is backend for entry in table.get(model, ())):
+                        continue
+                    path = None
+                    for rel_model, field in backend.related_models:
+                        if rel_model == model:
+                            path = tuple(field.split('__'))
+                            break
+                    table.setdefault(model, []).append((backend, model == backend.model, path))
+            cls._dispatch_table = (len(backends), table)
+        return table
+    
+    @classmethod
+    def get_dispatch(cls, obj):
+        opts = obj._meta
+        return cls.get_dispatch_table().get('%s.%s' % (opts.app_label, opts.object_name), ())
+    
     @classmethod
     def get_backends(cls, instance=None, action=None):
         backends = cls.get_plugins()
@@ -164,6 +212,35 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
         time = now.strftime("%h %d, %Y %I:%M:%S %Z")
         return "Generated by Orchestra at %s" % time
     
+    def get_content_mark(self):
+        """ position of the next content command, see get_content_since() and truncate_content() """
+        if not self.content:
+            return (0, 0)
+        return (len(self.content), len(self.content[-1][1]))
+    
+    def get_content_since(self, mark):
+        size, last_size = mark
+        commands = []
+        if size:
+            commands += self.content[size-1][1][last_size:]
+        for method, section_commands in self.content[size:]:
+            commands += section_commands
+        return commands
+    
+    def truncate_content(self, mark):
+        """ drops the content commands appended after mark """
+        size, last_size = mark
+        del self.content[size:]
+        if size:
+            del self.content[size-1][1][last_size:]
+    
+    def get_content_hash(self, commands):
+        """ hash of rendered script commands, ignoring banner dates; None if not hashable """
+        if not commands or not all(isinstance(cmd, str) for cmd in commands):
+            return None
+        script = re.sub(r'Generated by Orchestra at [^\n]*', '', '\n'.join(commands))
+        return hashlib.sha1(script.encode('utf8')).hexdigest()
+    
     def create_log(self, server, **kwargs):
         from .models import BackendLog
         state = BackendLog.RECEIVED
@@ -175,6 +252,8 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
         if using:
             manager = manager.using(using)
         log = manager.create(backend=self.get_name(), state=state, server=server)
+        # Initialize the output writer on this thread, readers may tail it from others
+        log.writer
         return log
     
     def execute(self, server, async=False, log=None):
@@ -206,6 +285,41 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
     def get_context(self, obj):
         return {}
     
+    def prefetch(self, instances):
+        """
+        hook called with all the instances of this execution before any action method,
+        allows fetching in bulk the data that actions would otherwise query per instance
+        
+        applies the select_related and prefetch_related plans of the backend in batches
+        """
+        instances = [ instance for instance in instances if instance.pk is not None ]
+        batch_size = settings.ORCHESTRATION_PREFETCH_BATCH_SIZE
+        for ix in range(0, len(instances), batch_size):
+            batch = instances[ix:ix+batch_size]
+            if self.select_related:
+                self.select_related_objects(batch, self.select_related)
+            if self.prefetch_related:
+                prefetch_related_objects(batch, self.prefetch_related)
+    
+    @staticmethod
+    def select_related_objects(instances, lookups):
+        """ select_related() counterpart for already fetched instances of the same model """
+        model = type(instances[0])
+        opts = model._meta
+        fetched = model._base_manager.select_related(*lookups).in_bulk(
+            [ instance.pk for instance in instances ]
+        )
+        cache_names = set(
+            opts.get_field(lookup.split('__')[0]).get_cache_name() for lookup in lookups
+        )
+        for instance in instances:
+            related = fetched.get(instance.pk)
+            # Deleted instances are not refetched
+            if related is not None:
+                for cache_name in cache_names:
+                    if hasattr(related, cache_name):
+                        setattr(instance, cache_name, getattr(related, cache_name))
+    
     def prepare(self):
         """
         hook for executing something at the beging
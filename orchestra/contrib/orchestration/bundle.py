@@ -0,0 +1,214 @@
+import codecs
+import textwrap
+import uuid
+
+from . import methods
+from .backends import ServiceBackend
+from .models import BackendLog
+
+
+class BundleLog(object):
+    """
+    In-memory stand-in for BackendLog, collects the output of a bundle while it runs
+    through a script method, it is split into the logs of each backend afterwards
+    """
+    STDOUT = BackendLog.STDOUT
+    STDERR = BackendLog.STDERR
+    RECEIVED = BackendLog.RECEIVED
+    TIMEOUT = BackendLog.TIMEOUT
+    STARTED = BackendLog.STARTED
+    SUCCESS = BackendLog.SUCCESS
+    FAILURE = BackendLog.FAILURE
+    ERROR = BackendLog.ERROR
+    ABORTED = BackendLog.ABORTED
+
+    def __init__(self):
+        self.state = self.RECEIVED
+        self.script = ''
+        self.exit_code = None
+        self.traceback = ''
+        self.autoflush = False
+        self.decoders = {
+            self.STDOUT: codecs.getincrementaldecoder('utf8')('replace'),
+            self.STDERR: codecs.getincrementaldecoder('utf8')('replace'),
+        }
+        # Output chunks, joined when read
+        self.chunks = {
+            self.STDOUT: [],
+            self.STDERR: [],
+        }
+
+    @property
+    def writer(self):
+        return self
+
+    @property
+    def stdout(self):
+        return self.get_value(self.STDOUT)
+
+    @stdout.setter
+    def stdout(self, value):
+        self.chunks[self.STDOUT] = [value]
+
+    @property
+    def stderr(self):
+        return self.get_value(self.STDERR)
+
+    @stderr.setter
+    def stderr(self, value):
+        self.chunks[self.STDERR] = [value]
+
+    def get_value(self, stream):
+        chunks = self.chunks[stream]
+        if len(chunks) > 1:
+            chunks[:] = [''.join(chunks)]
+        return chunks[0] if chunks else ''
+
+    def write(self, stream, content, final=False):
+        if isinstance(content, bytes):
+            content = self.decoders[stream].decode(content, final=final)
+        if content:
+            self.chunks[stream].append(content)
+
+    def close(self):
+        for stream in self.decoders:
+            self.write(stream, b'', final=True)
+
+    def save(self, **kwargs):
+        pass
+
+
+class ScriptBundle(object):
+    """
+    Merges the bash scripts of several backends targeting the same server into a single remote run
+
+    Each backend script runs in its own bash process, thus keeping its semantics (set -e, exit),
+    between marker lines that allow splitting the output and exit code of every section back
+    into its own BackendLog. Bundled backends do not reload services by themselves, they
+    register them on $ORCHESTRA_RELOADS and each service is reloaded once at the end.
+    """
+    script_executable = '/bin/bash'
+
+    def __init__(self, server):
+        self.server = server
+        self.members = []
+        self.mark = '### ORCHESTRA %s' % uuid.uuid4().hex
+
+    def __str__(self):
+        return 'ScriptBundle(%s)' % ', '.join(str(backend) for backend, __, __ in self.members)
+
+    def __len__(self):
+        return len(self.members)
+
+    @staticmethod
+    def accepts(backend, log):
+        """ only plain bash scripts of backends that do not customize their execution can be bundled """
+        if log.state == log.NOTHING or backend.script_executable != '/bin/bash':
+            return False
+        if type(backend).execute is not ServiceBackend.execute:
+            # i.e. ServiceMonitor.execute() stores the collected data
+            return False
+        scripts = backend.scripts
+        return len(scripts) == 1 and getattr(scripts[0][0], '__func__', None) is methods.SSH
+
+    def add(self, backend, log, operations):
+        self.members.append((backend, log, operations))
+
+    def get_section_script(self, backend):
+        __, commands = backend.scripts[0]
+        return '\n'.join(commands).replace('\r', '')
+
+    def get_script(self):
+        script = [textwrap.dedent("""\
+            ORCHESTRA_RELOADS=$(mktemp)
+            export ORCHESTRA_RELOADS""")
+        ]
+        for section, (backend, __, __) in enumerate(self.members):
+            script.append(textwrap.dedent("""\
+                echo '{mark} BEGIN {section}'; echo '{mark} BEGIN {section}' >&2
+                ORCHESTRA_SECTION={section} bash << '{eof}'
+                {script}
+                {eof}
+                exit_code=$?
+                echo "{mark} EXIT {section} $exit_code"; echo "{mark} EXIT {section} $exit_code" >&2\
+                """).format(
+                    mark=self.mark,
+                    section=section,
+                    eof='ORCHESTRA_SECTION_%i_EOF' % section,
+                    script=self.get_section_script(backend),
+                )
+            )
+        script.append(textwrap.dedent("""\
+            echo '{mark} BEGIN reload'; echo '{mark} BEGIN reload' >&2
+            exit_code=0
+            for service in $(cut -d' ' -f1 $ORCHESTRA_RELOADS | sort -u); do
+                if service $service status > /dev/null; then
+                    service $service reload || exit_code=$?
+                else
+                    service $service start || exit_code=$?
+                fi
+            done
+            sections=$(cut -d' ' -f2 $ORCHESTRA_RELOADS | sort -u | tr '\\n' ' ')
+            rm -f $ORCHESTRA_RELOADS
+            echo "{mark} EXIT reload $exit_code $sections"; echo "{mark} EXIT reload $exit_code $sections" >&2
+            exit 0""").format(mark=self.mark)
+        )
+        return '\n'.join(script)
+
+    def split(self, output):
+        """
+        returns the output of each section, output outside of any section is keyed by None,
+        and the exit line arguments of each finished section
+        """
+        sections = {}
+        exits = {}
+        current = None
+        for line in output.splitlines(True):
+            index = line.find(self.mark)
+            if index == -1:
+                sections.setdefault(current, []).append(line)
+                continue
+            if index:
+                # Section output without trailing new line
+                sections.setdefault(current, []).append(line[:index])
+            words = line[index+len(self.mark):].split()
+            if words[0] == 'BEGIN':
+                current = words[1]
+            else:
+                exits[words[1]] = words[2:]
+                current = None
+        return {key: ''.join(value) for key, value in sections.items()}, exits
+
+    def execute(self, server, async=False):
+        for backend, log, __ in self.members:
+            log.state = log.STARTED
+            log.script = self.get_section_script(backend)
+            log.save(update_fields=('script', 'state', 'updated_at'))
+        bundle_log = BundleLog()
+        methods.SSH(self, bundle_log, server, [self.get_script()], async)
+        stdout, exits = self.split(bundle_log.stdout)
+        stderr, __ = self.split(bundle_log.stderr)
+        reload_exit_code, *reloaded = exits.get('reload', [0])
+        for section, (backend, log, __) in enumerate(self.members):
+            section = str(section)
+            log.stdout += stdout.get(section, '')
+            log.stderr += stderr.get(section, '')
+            if section in exits:
+                log.exit_code = int(exits[section][0])
+                if section in reloaded:
+                    log.stdout += stdout.get('reload', '')
+                    log.stderr += stderr.get('reload', '')
+                    log.exit_code = log.exit_code or int(reload_exit_code)
+                log.state = log.SUCCESS if log.exit_code == 0 else log.FAILURE
+            else:
+                # The bundle did not make it to this section
+                log.stdout += stdout.get(None, '')
+                log.stderr += stderr.get(None, '')
+                log.exit_code = bundle_log.exit_code
+                log.traceback = bundle_log.traceback
+                if bundle_log.state in (log.TIMEOUT, log.ERROR):
+                    log.state = bundle_log.state
+                else:
+                    log.state = log.ABORTED
+            log.save()
+        return [log for __, log, __ in self.members]
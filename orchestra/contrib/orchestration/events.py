@@ -0,0 +1,49 @@
+import queue
+import threading
+
+
+class ExecutionEvents(object):
+    """
+    Thread-safe stream of the output of running backends, pass it to manager.execute()
+    
+    Iterating over it blocks until the next event and yields (log, stream, content) tuples,
+    where stream is FINISHED (and content None) once the log has finished.
+    Iteration ends when all the logs of the execution have finished.
+    """
+    FINISHED = 'finished'
+    
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # Characters streamed per (log, stream)
+        self.streamed = {}
+        self.pending = 0
+    
+    def watch(self, log):
+        with self.lock:
+            self.pending += 1
+        log.writer.listeners.append(self.output)
+    
+    def output(self, log, stream, content):
+        with self.lock:
+            key = (log, stream)
+            self.streamed[key] = self.streamed.get(key, 0) + len(content)
+        self.queue.put((log, stream, content))
+    
+    def finished(self, log):
+        for stream in (log.STDOUT, log.STDERR):
+            with self.lock:
+                streamed = self.streamed.pop((log, stream), 0)
+            # Output not written through log.writer, i.e. bundled backends or tracebacks,
+            # is only known once the log has finished
+            content = getattr(log, stream)[streamed:]
+            if content:
+                self.queue.put((log, stream, content))
+        self.queue.put((log, self.FINISHED, None))
+    
+    def __iter__(self):
+        while self.pending:
+            log, stream, content = self.queue.get()
+            if stream == self.FINISHED:
+                self.pending -= 1
+            yield log, stream, content
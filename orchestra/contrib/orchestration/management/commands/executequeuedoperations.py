@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from orchestra.contrib.orchestration import manager, settings
+
+
+class Command(BaseCommand):
+    help = 'Executes the operations queued by OperationsMiddleware.'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', dest='loop', default=False,
+            help='Keeps draining the queue instead of exiting when done.')
+        parser.add_argument('-i', '--interval', action='store', dest='interval', type=float,
+            default=settings.ORCHESTRATION_QUEUE_DEBOUNCE,
+            help='Seconds between queue checks when looping.')
+    
+    def handle(self, *args, **options):
+        while True:
+            for log in manager.execute_queued():
+                self.stdout.write(' '.join((log.backend, str(log.server), log.state)))
+            if not options.get('loop'):
+                break
+            time.sleep(options.get('interval'))
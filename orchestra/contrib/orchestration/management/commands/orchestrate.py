@@ -1,10 +1,16 @@
+import json
+import os
 import time
+from datetime import timedelta
+
+from django.apps import apps
 from django.core.management.base import BaseCommand, CommandError
 from django.db.models import Q
 
 from orchestra.contrib.orchestration import manager, Operation
-from orchestra.contrib.orchestration.models import Server
+from orchestra.contrib.orchestration.models import Route, Server
 from orchestra.contrib.orchestration.backends import ServiceBackend
+from orchestra.contrib.orchestration.events import ExecutionEvents
 from orchestra.utils.python import OrderedSet
 from orchestra.utils.sys import confirm
 
@@ -29,9 +35,17 @@ class Command(BaseCommand):
             help='List available baclends.')
         parser.add_argument('--dry-run', action='store_true', dest='dry', default=False,
             help='Only prints scrtipt.')
+        parser.add_argument('-f', '--force', action='store_true', dest='force', default=False,
+            help='Executes save operations whose scripts have not changed since their last '
+                 'successful execution.')
+        parser.add_argument('-c', '--chunk-size', action='store', dest='chunk_size', type=int,
+            default=0, help='Streams the objects and executes them in chunks of this size, '
+                            'the next chunk is collected while the previous one runs.')
+        parser.add_argument('-r', '--resume-file', action='store', dest='resume_file',
+            default='', help='With --chunk-size, keeps track of the last completed chunk on this '
+                             'file and resumes from it when it already exists.')
     
-    
-    def collect_operations(self, **options):
+    def get_querysets(self, **options):
         model = options.get('model')
         backends = options.get('backends') or set()
         if backends:
@@ -39,7 +53,6 @@ class Command(BaseCommand):
         servers = options.get('servers') or set()
         if servers:
             servers = set([Server.objects.get(Q(address=server)|Q(name=server)) for server in servers.split(',')])
-        action = options.get('action')
         if not model:
             models = set()
             if servers:
@@ -65,12 +78,9 @@ class Command(BaseCommand):
             model = apps.get_model(*model.split('.'))
             queryset = model.objects.filter(**kwargs).order_by('id')
             querysets = [queryset]
-        
-        operations = OrderedSet()
-        route_cache = {}
-        for queryset in querysets:
-            for instance in queryset:
-                manager.collect(instance, action, operations=operations, route_cache=route_cache)
+        return querysets, backends, servers
+    
+    def filter_operations(self, operations, backends, servers):
         if backends:
             result = []
             for operation in operations:
@@ -88,18 +98,17 @@ class Command(BaseCommand):
             operations = result
         return operations
     
-    def handle(self, *args, **options):
-        list_backends = options.get('list_backends')
-        if list_backends:
-            for backend in ServiceBackend.get_backends():
-                self.stdout.write(str(backend).split("'")[1])
-            return
-        interactive = options.get('interactive')
-        dry = options.get('dry')
-        operations = self.collect_operations(**options)
-        scripts, serialize = manager.generate(operations)
+    def collect_operations(self, **options):
+        querysets, backends, servers = self.get_querysets(**options)
+        action = options.get('action')
+        operations = OrderedSet()
+        for queryset in querysets:
+            for instance in queryset:
+                manager.collect(instance, action, operations=operations)
+        return self.filter_operations(operations, backends, servers)
+    
+    def print_scripts(self, scripts):
         servers = set()
-        # Print scripts
         for key, value in scripts.items():
             route, __, __ = key
             backend, operations = value
@@ -108,6 +117,140 @@ class Command(BaseCommand):
             for method, commands in backend.scripts:
                 script = '\n'.join(commands)
                 self.stdout.write(script.encode('ascii', errors='replace').decode())
+        return servers
+    
+    def tail_logs(self, events, logs):
+        """ prints the output of the running logs as it arrives, prefixing lines with their host """
+        partial = {}
+        for log, stream, content in events:
+            prefix = '[%s %s] ' % (log.server, log.backend)
+            if stream == events.FINISHED:
+                for stream in (log.STDOUT, log.STDERR):
+                    line = partial.pop((log, stream), '')
+                    if line:
+                        getattr(self, stream).write(prefix + line)
+                continue
+            lines = (partial.pop((log, stream), '') + content).split('\n')
+            if lines[-1]:
+                partial[(log, stream)] = lines[-1]
+            for line in lines[:-1]:
+                getattr(self, stream).write(prefix + line)
+        for log in logs:
+            self.stdout.write(' '.join((log.backend, log.state)))
+    
+    def iter_chunks(self, querysets, chunk_size, resume):
+        """ yields (label, chunk) streaming each queryset, skipping objects up to resume[label] """
+        for queryset in querysets:
+            label = queryset.model._meta.label
+            if label in resume:
+                queryset = queryset.filter(pk__gt=resume[label])
+            chunk = []
+            for instance in queryset.iterator():
+                chunk.append(instance)
+                if len(chunk) == chunk_size:
+                    yield label, chunk
+                    chunk = []
+            if chunk:
+                yield label, chunk
+    
+    def handle_chunks(self, **options):
+        """
+        Pipelined execution: chunk N+1 is collected and generated while chunk N runs,
+        memory usage is bounded by the chunk size instead of the number of objects
+        """
+        chunk_size = options.get('chunk_size')
+        resume_file = options.get('resume_file')
+        action = options.get('action')
+        dry = options.get('dry')
+        force = options.get('force')
+        querysets, backends, servers = self.get_querysets(**options)
+        resume = {}
+        if resume_file and os.path.exists(resume_file):
+            with open(resume_file) as handler:
+                resume = json.load(handler)
+            self.stdout.write('Resuming after %s' % ', '.join(
+                '%s %s' % (label, pk) for label, pk in sorted(resume.items())))
+        total = 0
+        for queryset in querysets:
+            label = queryset.model._meta.label
+            if label in resume:
+                queryset = queryset.filter(pk__gt=resume[label])
+            total += queryset.count()
+        if options.get('interactive') and not dry:
+            context = {
+                'total': total,
+                'chunk_size': chunk_size,
+            }
+            msg = "Are your sure to execute %(total)i objects in chunks of %(chunk_size)i (yes/no)? "
+            if not confirm(msg % context):
+                return
+        start = time.time()
+        done = 0
+        failed = False
+        previous = None
+        for index, (label, chunk) in enumerate(self.iter_chunks(querysets, chunk_size, resume)):
+            operations = OrderedSet()
+            for instance in chunk:
+                manager.collect(instance, action, operations=operations)
+            operations = self.filter_operations(operations, backends, servers)
+            scripts = manager.generate(operations, force=force)
+            if previous:
+                failed = not self.finish_chunk(previous, resume, resume_file)
+                done += len(previous[2])
+                self.report_progress(index, done, total, start)
+                if failed:
+                    break
+            if dry:
+                # Nothing has been executed, the resume file is left as it was
+                self.print_scripts(scripts)
+                continue
+            events = ExecutionEvents()
+            logs = manager.execute(scripts, async=True, events=events)
+            previous = (label, logs, chunk, events)
+        else:
+            if previous:
+                failed = not self.finish_chunk(previous, resume, resume_file)
+                done += len(previous[2])
+                self.report_progress(index+1, done, total, start)
+        if failed:
+            raise CommandError("Chunk execution failed, run again with the same --resume-file "
+                               "to resume from the last completed chunk.")
+        if resume_file and not dry and os.path.exists(resume_file):
+            os.remove(resume_file)
+    
+    def finish_chunk(self, chunk, resume, resume_file):
+        """ waits for the chunk logs and records its progress, returns False on failure """
+        label, logs, instances, events = chunk
+        self.tail_logs(events, logs)
+        if not all(log.is_success for log in logs):
+            return False
+        resume[label] = instances[-1].pk
+        if resume_file:
+            with open(resume_file, 'w') as handler:
+                json.dump(resume, handler)
+        return True
+    
+    def report_progress(self, chunks, done, total, start):
+        elapsed = time.time() - start
+        percent = 100*done/total if total else 100
+        eta = elapsed*(total-done)/done if done else 0
+        self.stdout.write('Chunk %i: %i/%i objects (%i%%), elapsed %s, ETA %s' % (
+            chunks, done, total, percent,
+            timedelta(seconds=int(elapsed)), timedelta(seconds=int(eta))))
+    
+    def handle(self, *args, **options):
+        list_backends = options.get('list_backends')
+        if list_backends:
+            for backend in ServiceBackend.get_backends():
+                self.stdout.write(str(backend).split("'")[1])
+            return
+        if options.get('chunk_size'):
+            return self.handle_chunks(**options)
+        interactive = options.get('interactive')
+        dry = options.get('dry')
+        operations = self.collect_operations(**options)
+        scripts = manager.generate(operations, force=options.get('force'))
+        servers = self.print_scripts(scripts)
         if interactive:
             context = {
                 'servers': ', '.join(servers),
@@ -115,22 +258,6 @@ class Command(BaseCommand):
             if not confirm("\n\nAre your sure to execute the previous scripts on %(servers)s (yes/no)? " % context):
                 return
         if not dry:
-            logs = manager.execute(scripts, serialize=serialize, async=True)
-            running = list(logs)
-            stdout = 0
-            stderr = 0
-            while running:
-                for log in running:
-                    cstdout = len(log.stdout)
-                    cstderr = len(log.stderr)
-                    if cstdout > stdout:
-                        self.stdout.write(log.stdout[stdout:])
-                        stdout = cstdout
-                    if cstderr > stderr:
-                        self.stderr.write(log.stderr[stderr:])
-                        stderr = cstderr
-                    if log.has_finished:
-                        running.remove(log)
-                    time.sleep(0.05)
-            for log in logs:
-                self.stdout.write(' '.join((log.backend, log.state)))
+            events = ExecutionEvents()
+            logs = manager.execute(scripts, async=True, events=events)
+            self.tail_logs(events, logs)
@@ -1,17 +1,22 @@
 import logging
-import threading
 import traceback
+import uuid
 from collections import OrderedDict
+from datetime import timedelta
 
 from django.core.mail import mail_admins
+from django.db import router as db_router
+from django.utils import timezone
 
 from orchestra.utils import db
 from orchestra.utils.python import import_class, OrderedSet
 
 from . import settings, Operation
 from .backends import ServiceBackend
+from .bundle import ScriptBundle
 from .helpers import send_report
-from .models import BackendLog
+from .models import BackendLog, QueuedOperation
+from .pool import TaskGraph, get_pool
 from .signals import pre_action, post_action, pre_commit, post_commit, pre_prepare, post_prepare
 
 
@@ -19,7 +24,20 @@ logger = logging.getLogger(__name__)
 router = import_class(settings.ORCHESTRATION_ROUTER)
 
 
-def keep_log(execute, log, operations):
+def store_log(execute, args, log, operations):
+    """ store the executed operations and send a report on failure """
+    for operation in operations:
+        logger.info("Executed %s" % operation)
+    Operation.bulk_store(operations, log)
+    if not log.is_success:
+        send_report(execute, args, log)
+    stdout = log.stdout.strip()
+    stdout and logger.debug('STDOUT %s', stdout.encode('ascii', errors='replace').decode())
+    stderr = log.stderr.strip()
+    stderr and logger.debug('STDERR %s', stderr.encode('ascii', errors='replace').decode())
+
+
+def keep_log(execute, log, operations, events=None):
     def wrapper(*args, **kwargs):
         """ send report """
         # Remember that threads have their oun connection poll
@@ -29,52 +47,118 @@ def keep_log(execute, log, operations):
             log = execute(*args, **kwargs)
         except Exception as e:
             trace = traceback.format_exc()
+            # Output streamed before the exception
+            log.writer.close()
             log.state = log.EXCEPTION
             log.stderr += trace
             log.save()
+            log.writer.clean()
             subject = 'EXCEPTION executing backend(s) %s %s' % (args, kwargs)
             logger.error(subject)
             logger.error(trace)
             mail_admins(subject, trace)
             # We don't propagate the exception further to avoid transaction rollback
         finally:
-            # Store and log the operation
-            for operation in operations:
-                logger.info("Executed %s" % operation)
-                operation.store(log)
-            if not log.is_success:
-                send_report(execute, args, log)
-            stdout = log.stdout.strip()
-            stdout and logger.debug('STDOUT %s', stdout.encode('ascii', errors='replace').decode())
-            stderr = log.stderr.strip()
-            stderr and logger.debug('STDERR %s', stderr.encode('ascii', errors='replace').decode())
+            try:
+                store_log(execute, args, log, operations)
+            finally:
+                # Readers wait for it, even when storing the log has failed
+                if events is not None:
+                    events.finished(log)
+    return wrapper
+
+
+def keep_bundle_logs(bundle, events=None):
+    """ keep_log counterpart for the logs of all the backends of a bundle """
+    def wrapper(*args, **kwargs):
+        try:
+            bundle.execute(*args, **kwargs)
+        except Exception as e:
+            trace = traceback.format_exc()
+            for backend, log, operations in bundle.members:
+                log.state = log.EXCEPTION
+                log.stderr += trace
+                log.save()
+            subject = 'EXCEPTION executing backend(s) %s %s' % (args, kwargs)
+            logger.error(subject)
+            logger.error(trace)
+            mail_admins(subject, trace)
+        finally:
+            try:
+                for backend, log, operations in bundle.members:
+                    store_log(backend.execute, args, log, operations)
+            finally:
+                # Readers wait for them, even when storing the logs has failed
+                if events is not None:
+                    for backend, log, operations in bundle.members:
+                        events.finished(log)
     return wrapper
 
 
-def generate(operations):
+def get_applied_hashes(route, backend, operations):
+    """
+    {object_id: script_hash} of the save operations whose last execution
+    by backend on route.host was successful
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from django.db.models import Max
+    from .models import BackendOperation
+    object_ids = [
+        operation.instance.pk for operation in operations if operation.action == Operation.SAVE
+    ]
+    if not object_ids:
+        return {}
+    content_type = ContentType.objects.get_for_model(backend.model_class())
+    applied = {}
+    batch_size = settings.ORCHESTRATION_PREFETCH_BATCH_SIZE
+    for ix in range(0, len(object_ids), batch_size):
+        last_ids = BackendOperation.objects.filter(backend=backend.get_name(),
+            content_type=content_type, object_id__in=object_ids[ix:ix+batch_size],
+            log__server=route.host,
+        ).values('object_id').annotate(last_id=Max('id')).values_list('last_id', flat=True)
+        last_operations = BackendOperation.objects.filter(id__in=list(last_ids)).values_list(
+            'object_id', 'action', 'script_hash', 'log__state')
+        for object_id, action, script_hash, state in last_operations:
+            if action == Operation.SAVE and script_hash and state == BackendLog.SUCCESS:
+                applied[object_id] = script_hash
+    return applied
+
+
+def generate(operations, force=False):
+    """
+    generates the scripts of operations grouped per route and backend
+    
+    force: do not drop save operations whose script has already been applied
+    """
     scripts = OrderedDict()
-    cache = {}
-    serialize = False
-    # Generate scripts per route+backend
+    # Group operations per route+backend
     for operation in operations:
         logger.debug("Queued %s" % operation)
         if operation.routes is None:
-            operation.routes = router.objects.get_for_operation(operation, cache=cache)
+            operation.routes = router.objects.get_for_operation(operation)
         for route in operation.routes:
             # TODO key by action.async
             async_action = route.action_is_async(operation.action)
             key = (route, operation.backend, async_action)
             if key not in scripts:
-                backend, operations = (operation.backend(), [operation])
-                scripts[key] = (backend, operations)
-                backend.set_head()
-                pre_prepare.send(sender=backend.__class__, backend=backend)
-                backend.prepare()
-                post_prepare.send(sender=backend.__class__, backend=backend)
+                scripts[key] = (operation.backend(), [operation])
             else:
                 scripts[key][1].append(operation)
+    # Generate scripts per route+backend
+    unchanged = []
+    for key, value in scripts.items():
+        route = key[0]
+        backend, operations = value
+        backend.set_head()
+        pre_prepare.send(sender=backend.__class__, backend=backend)
+        backend.prepare()
+        post_prepare.send(sender=backend.__class__, backend=backend)
+        backend.prefetch([operation.instance for operation in operations])
+        applied = {}
+        if not force and settings.ORCHESTRATION_SKIP_UNCHANGED:
+            applied = get_applied_hashes(route, backend, operations)
+        for operation in list(operations):
             # Get and call backend action method
-            backend = scripts[key][0]
             method = getattr(backend, operation.action)
             kwargs = {
                 'sender': backend.__class__,
@@ -83,78 +167,192 @@ def generate(operations):
                 'action': operation.action,
             }
             backend.set_content()
+            mark = backend.get_content_mark()
             pre_action.send(**kwargs)
             method(operation.instance)
             post_action.send(**kwargs)
-            if backend.serialize:
-                serialize = True
+            if operation.action == Operation.SAVE:
+                operation.script_hash = backend.get_content_hash(backend.get_content_since(mark))
+                if operation.script_hash and applied.get(operation.instance.pk) == operation.script_hash:
+                    # Already applied on this server, drop its section
+                    logger.debug("Unchanged %s on %s" % (operation, route.host))
+                    backend.truncate_content(mark)
+                    operations.remove(operation)
+        if not operations:
+            unchanged.append(key)
+    for key in unchanged:
+        scripts.pop(key)
     for value in scripts.values():
         backend, operations = value
         backend.set_tail()
         pre_commit.send(sender=backend.__class__, backend=backend)
         backend.commit()
         post_commit.send(sender=backend.__class__, backend=backend)
-    return scripts, serialize
+    return scripts
+
+
+def sort_scripts(scripts):
+    """
+    orders scripts so that backends run after the backends they depend on
+    when both target the same server, generation order is kept otherwise
+    """
+    remaining = list(scripts.keys())
+    ordered = OrderedDict()
+    while remaining:
+        for key in remaining:
+            route, backend, __ = key
+            if not any(other is not key and other[0].host == route.host and backend.depends_on(other[1])
+                       for other in remaining):
+                break
+        else:
+            key = remaining[0]
+            logger.warning('Circular backend dependencies on %s, keeping generation order.' % key[0].host)
+        remaining.remove(key)
+        ordered[key] = scripts[key]
+    return ordered
 
 
-def execute(scripts, serialize=False, async=None):
+def get_jobs(entries):
+    """
+    returns (server, is_async, job) tuples of (server, is_async, backend, log, operations) entries,
+    where job is either a (backend, log, operations) tuple or a ScriptBundle
+    
+    With ORCHESTRATION_BUNDLE_SCRIPTS the bash scripts of a server run as a single bundle,
+    scheduled at the position of its first member. Serialize backends and backends that
+    depend on a backend running on its own are not bundled, and bundles do not extend
+    across serialize backends.
+    """
+    jobs = []
+    bundles = {}
+    # Classes of the backends that run on their own, per server
+    unbundled = {}
+    for server, is_async, backend, log, operations in entries:
+        bundle = (settings.ORCHESTRATION_BUNDLE_SCRIPTS and not backend.serialize and
+            ScriptBundle.accepts(backend, log))
+        if bundle and any(backend.depends_on(other) for other in unbundled.get(server, ())):
+            # The bundle would run before the backend it depends on
+            bundle = False
+        if bundle:
+            # One remote run per server for all its bash scripts
+            bundle = bundles.get((server, is_async))
+            if bundle is None:
+                bundle = ScriptBundle(server)
+                bundles[(server, is_async)] = bundle
+                jobs.append((server, is_async, bundle))
+            bundle.add(backend, log, operations)
+        else:
+            unbundled.setdefault(server, []).append(type(backend))
+            jobs.append((server, is_async, (backend, log, operations)))
+            if backend.serialize:
+                # Backends after a barrier can not join the bundles scheduled before it
+                bundles = {}
+    return jobs
+
+
+def execute(scripts, serialize=False, async=None, events=None):
     """
     executes the operations on the servers
     
     serialize: execute one backend at a time
     async: do not join threads (overrides route.async)
+    events: ExecutionEvents instance where the output of the backends is streamed
+    
+    Otherwise backends run concurrently, except on the same server where a backend waits
+    for the backends it depends on, and serialize backends wait for and are waited by all others
+    on any server. See get_jobs() for ORCHESTRATION_BUNDLE_SCRIPTS.
     """
     if settings.ORCHESTRATION_DISABLE_EXECUTION:
         logger.info('Orchestration execution is dissabled by ORCHESTRATION_DISABLE_EXECUTION.')
         return []
     # Execute scripts on each server
-    executions = []
-    threads_to_join = []
+    pool = get_pool()
+    graph = TaskGraph(pool)
+    log_origin = db_router.db_for_write(BackendLog)
+    log_alias = db.autocommit(origin=log_origin, max_age=settings.ORCHESTRATION_LOG_CONN_MAX_AGE)
+    tasks_to_join = []
     logs = []
-    for key, value in scripts.items():
-        route, __, async_action = key
-        backend, operations = value
-        args = (route.host,)
-        if async is None:
-            is_async = not serialize and (route.async or async_action)
-        else:
-            is_async = not serialize and (async or async_action)
-        kwargs = {
-            'async': is_async,
-        }
-        # we clone the connection just in case we are isolated inside a transaction
-        with db.clone(model=BackendLog) as handle:
-            log = backend.create_log(*args, using=handle.target)
-            log._state.db = handle.origin
-        kwargs['log'] = log
-        task = keep_log(backend.execute, log, operations)
-        logger.debug('%s is going to be executed on %s.' % (backend, route.host))
-        if serialize:
-            # Execute one backend at a time, no need for threads
-            task(*args, **kwargs)
-        else:
-            task = db.close_connection(task)
-            thread = threading.Thread(target=task, args=args, kwargs=kwargs)
-            thread.start()
-            if not is_async:
-                threads_to_join.append(thread)
-        logs.append(log)
-    [ thread.join() for thread in threads_to_join ]
+    entries = []
+    # Logs of the tasks already run, the rest are finished here when scheduling fails
+    executed = set()
+    try:
+        for key, value in sort_scripts(scripts).items():
+            route, __, async_action = key
+            backend, operations = value
+            if async is None:
+                is_async = not serialize and (route.async or async_action)
+            else:
+                is_async = not serialize and (async or async_action)
+            # created on a persistent autocommit connection just in case we are isolated inside a transaction
+            log = backend.create_log(route.host, using=log_alias)
+            # Bound to the regular alias so it can be related with other objects
+            log._state.db = log_origin
+            if events is not None:
+                events.watch(log)
+            logs.append(log)
+            entries.append((route.host, is_async, backend, log, operations))
+        scheduled = []
+        for server, is_async, job in get_jobs(entries):
+            args = (server,)
+            kwargs = {
+                'async': is_async,
+            }
+            if isinstance(job, ScriptBundle) and len(job) > 1:
+                task = keep_bundle_logs(job, events)
+                backends = [ type(backend) for backend, __, __ in job.members ]
+                logger.debug('%s is going to be executed on %s.' % (job, server))
+            else:
+                if isinstance(job, ScriptBundle):
+                    job = job.members[0]
+                backend, log, operations = job
+                kwargs['log'] = log
+                task = keep_log(backend.execute, log, operations, events)
+                backends = [type(backend)]
+                logger.debug('%s is going to be executed on %s.' % (backend, server))
+            if serialize:
+                # Execute one backend at a time, no need for threads
+                if isinstance(job, ScriptBundle):
+                    executed.update(log for __, log, __ in job.members)
+                else:
+                    executed.add(log)
+                task(*args, **kwargs)
+            else:
+                task = db.close_connection(task)
+                barrier = any(backend.serialize for backend in backends)
+                after = []
+                for previous_server, previous_backends, previous_barrier, previous in scheduled:
+                    if barrier or previous_barrier or (previous_server == server and any(
+                            backend.depends_on(previous_backend)
+                            for backend in backends for previous_backend in previous_backends)):
+                        after.append(previous)
+                # Concurrency is bounded by the pool, tasks are queued and fairly scheduled per host
+                task = graph.add(task, server.get_address(), *args, after=after, **kwargs)
+                scheduled.append((server, backends, barrier, task))
+                if not is_async:
+                    tasks_to_join.append(task)
+    except Exception:
+        if events is not None:
+            # Otherwise readers would wait forever for them
+            for log in logs:
+                if log not in executed:
+                    events.finished(log)
+        raise
+    graph.start()
+    [ task.join() for task in tasks_to_join ]
     return logs
 
 
 def collect(instance, action, **kwargs):
     """ collect operations """
     operations = kwargs.get('operations', OrderedSet())
-    route_cache = kwargs.get('route_cache', {})
-    for backend_cls in ServiceBackend.get_backends():
+    # Only backends with instance's model as main or related model are considered
+    for backend_cls, is_model, path in ServiceBackend.get_dispatch(instance):
         # Check if there exists a related instance to be executed for this backend and action
         instances = []
         if action in backend_cls.actions:
-            if backend_cls.is_main(instance):
+            if is_model and backend_cls.is_main(instance):
                 instances = [(instance, action)]
-            else:
-                for candidate in backend_cls.get_related(instance):
+            elif path:
+                for candidate in backend_cls.resolve_related(instance, path):
                     if candidate.__class__.__name__ == 'ManyRelatedManager':
                         if 'pk_set' in kwargs:
                             # m2m_changed signal
@@ -165,7 +363,7 @@ def collect(instance, action, **kwargs):
                         candidates = [candidate]
                     for candidate in candidates:
                         # Check if a delete for candidate is in operations
-                        delete_mock = Operation(backend_cls, candidate, Operation.DELETE)
+                        delete_mock = Operation(backend_cls, candidate, Operation.DELETE, copy_instance=False)
                         if delete_mock not in operations:
                             # related objects with backend.model trigger save()
                             instances.append((candidate, Operation.SAVE))
@@ -173,7 +371,7 @@ def collect(instance, action, **kwargs):
             # Maintain consistent state of operations based on save/delete behaviour
             # Prevent creating a deleted selected by deleting existing saves
             if iaction == Operation.DELETE:
-                save_mock = Operation(backend_cls, selected, Operation.SAVE)
+                save_mock = Operation(backend_cls, selected, Operation.SAVE, copy_instance=False)
                 try:
                     operations.remove(save_mock)
                 except KeyError:
@@ -193,12 +391,13 @@ def collect(instance, action, **kwargs):
                                 break
                         if not execute:
                             continue
-            operation = Operation(backend_cls, selected, iaction)
+            operation = Operation(backend_cls, selected, iaction, copy_instance=False)
             # Only schedule operations if the router has execution routes
-            routes = router.objects.get_for_operation(operation, cache=route_cache)
+            routes = router.objects.get_for_operation(operation)
             if routes:
+                # Copying the instance is only worth it for scheduled operations
+                operation = Operation(backend_cls, selected, iaction, routes=routes)
                 logger.debug("Operation %s collected for execution" % operation)
-                operation.routes = routes
                 if iaction != Operation.DELETE:
                     # usually we expect to be using last object state,
                     # except when we are deleting it
@@ -207,3 +406,41 @@ def collect(instance, action, **kwargs):
                     operation.preload_context()
                 operations.add(operation)
     return operations
+
+
+def coalesce(queued_operations):
+    """ keeps the DELETE, if any, or the latest SAVE of each backend and object """
+    selected = OrderedDict()
+    for queued in queued_operations:
+        current = selected.get(queued.key)
+        if current is None or current.action != Operation.DELETE or queued.action == Operation.DELETE:
+            selected[queued.key] = queued
+    return list(selected.values())
+
+
+def execute_queued():
+    """
+    executes the queued operations whose object has not changed for ORCHESTRATION_QUEUE_DEBOUNCE
+    
+    Pending operations of the same backend and object are coalesced, see coalesce().
+    Operations are claimed by key before being executed, see QueuedOperationQuerySet.claim(),
+    allowing concurrent workers, and removed once executed.
+    """
+    quiet_since = timezone.now() - timedelta(seconds=settings.ORCHESTRATION_QUEUE_DEBOUNCE)
+    token = uuid.uuid4().hex
+    claimed = QueuedOperation.objects.claim(token, quiet_since)
+    operations = OrderedSet()
+    for queued in coalesce(claimed.order_by('id')):
+        try:
+            backend = queued.backend_class
+            instance = queued.get_instance()
+        except Exception as exc:
+            logger.error('Discarding queued %s: %s' % (queued, exc))
+            continue
+        operations.add(Operation(backend, instance, queued.action, copy_instance=False))
+    logs = []
+    if operations:
+        logger.debug('Executing %i coalesced operations out of %i queued' % (len(operations), len(claimed)))
+        logs = Operation.execute(operations)
+    claimed.delete()
+    return logs
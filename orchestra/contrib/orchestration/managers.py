@@ -10,19 +10,19 @@ from orchestra.utils.python import OrderedSet
 
 from . import manager, Operation, helpers
 from .middlewares import OperationsMiddleware
-from .models import BackendLog, BackendOperation
+from .models import BackendLog, BackendLogChunk, BackendOperation, QueuedOperation
 
 
 @receiver(post_save, dispatch_uid='orchestration.post_save_manager_collector')
 def post_save_collector(sender, *args, **kwargs):
-    if sender not in (BackendLog, BackendOperation, LogEntry):
+    if sender not in (BackendLog, BackendLogChunk, BackendOperation, QueuedOperation, LogEntry):
         instance = kwargs.get('instance')
         orchestrate.collect(Operation.SAVE, **kwargs)
 
 
 @receiver(pre_delete, dispatch_uid='orchestration.pre_delete_manager_collector')
 def pre_delete_collector(sender, *args, **kwargs):
-    if sender not in (BackendLog, BackendOperation, LogEntry):
+    if sender not in (BackendLog, BackendLogChunk, BackendOperation, QueuedOperation, LogEntry):
         orchestrate.collect(Operation.DELETE, **kwargs)
 
 
@@ -45,7 +45,6 @@ class orchestrate(ContextDecorator):
     """
     thread_locals = local()
     thread_locals.pending_operations = None
-    thread_locals.route_cache = None
     
     @classmethod
     def collect(cls, action, **kwargs):
@@ -54,7 +53,6 @@ class orchestrate(ContextDecorator):
             # No active orchestrate context manager
             return
         kwargs['operations'] = cls.thread_locals.pending_operations
-        kwargs['route_cache'] = cls.thread_locals.route_cache
         instance = kwargs.pop('instance')
         manager.collect(instance, action, **kwargs)
     
@@ -62,20 +60,17 @@ class orchestrate(ContextDecorator):
         cls = type(self)
         self.old_pending_operations = cls.thread_locals.pending_operations
         cls.thread_locals.pending_operations = OrderedSet()
-        self.old_route_cache = cls.thread_locals.route_cache
-        cls.thread_locals.route_cache = {}
     
     def __exit__(self, exc_type, exc_value, traceback):
         cls = type(self)
         if not exc_type:
             operations = cls.thread_locals.pending_operations
             if operations:
-                scripts, serialize = manager.generate(operations)
-                logs = manager.execute(scripts, serialize=serialize)
+                scripts = manager.generate(operations)
+                logs = manager.execute(scripts)
                 for t, msg in helpers.get_messages(logs):
                     if t == 'error':
                         sys.stderr.write('%s: %s\n' % (t, msg))
                     else:
                         sys.stdout.write('%s: %s\n' % (t, msg))
         cls.thread_locals.pending_operations = self.old_pending_operations
-        cls.thread_locals.route_cache = self.old_route_cache
@@ -4,6 +4,8 @@ import socket
 import sys
 import select
 import textwrap
+import threading
+import time
 
 from celery.datastructures import ExceptionInfo
 
@@ -17,11 +19,119 @@ from . import settings
 logger = logging.getLogger(__name__)
 
 
-def Paramiko(backend, log, server, cmds, async=False, paramiko_connections={}):
+class ParamikoConnection(object):
+    def __init__(self, ssh, max_channels):
+        self.ssh = ssh
+        self.channels = threading.BoundedSemaphore(max_channels)
+        self.in_use = 0
+        self.last_used = time.time()
+    
+    def is_active(self):
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+    
+    def open_session(self):
+        """ blocks while the transport has max_channels open sessions """
+        self.channels.acquire()
+        try:
+            return self.ssh.get_transport().open_session()
+        except:
+            self.channels.release()
+            raise
+    
+    def close_session(self, channel):
+        try:
+            channel.close()
+        finally:
+            self.channels.release()
+    
+    def close(self):
+        try:
+            self.ssh.close()
+        except Exception:
+            pass
+
+
+class ParamikoPool(object):
+    """
+    Thread-safe pool of persistent SSH connections keyed by server address
+    
+    Transports are kept alive with keepalive packets, reconnected when found dead,
+    evicted after max_idle seconds without use and limited to max_channels
+    concurrent sessions each.
+    """
+    def __init__(self, keepalive=None, max_idle=None, max_channels=None):
+        self.keepalive = keepalive or settings.ORCHESTRATION_PARAMIKO_KEEPALIVE
+        self.max_idle = max_idle or settings.ORCHESTRATION_PARAMIKO_MAX_IDLE
+        self.max_channels = max_channels or settings.ORCHESTRATION_PARAMIKO_MAX_CHANNELS
+        self.connections = {}
+        self.addr_locks = {}
+        self.lock = threading.Lock()
+    
+    def connect(self, addr):
+        import paramiko
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        key = settings.ORCHESTRATION_SSH_KEY_PATH
+        ssh.connect(addr, username=ORCHESTRA_SSH_DEFAULT_USER, key_filename=key)
+        ssh.get_transport().set_keepalive(self.keepalive)
+        return ParamikoConnection(ssh, self.max_channels)
+    
+    def evict(self):
+        """ closes idle connections, expects self.lock to be held """
+        now = time.time()
+        for addr, connection in list(self.connections.items()):
+            if not connection.in_use and now-connection.last_used > self.max_idle:
+                logger.debug('Evicting idle SSH connection to %s' % addr)
+                connection.close()
+                self.connections.pop(addr)
+    
+    def get_connection(self, addr):
+        with self.lock:
+            self.evict()
+            addr_lock = self.addr_locks.setdefault(addr, threading.Lock())
+        # Handshakes with different servers can happen concurrently
+        with addr_lock:
+            with self.lock:
+                connection = self.connections.get(addr)
+                if connection is not None and not connection.is_active():
+                    # Dead transport, sessions still using it will close it on release
+                    self.connections.pop(addr)
+                    if not connection.in_use:
+                        connection.close()
+                    connection = None
+                if connection is not None:
+                    connection.in_use += 1
+                    return connection
+            connection = self.connect(addr)
+            with self.lock:
+                connection.in_use += 1
+                self.connections[addr] = connection
+            return connection
+    
+    def release(self, addr, connection):
+        with self.lock:
+            connection.in_use -= 1
+            connection.last_used = time.time()
+            if self.connections.get(addr) is connection and not connection.is_active():
+                self.connections.pop(addr)
+            if not connection.in_use and self.connections.get(addr) is not connection:
+                connection.close()
+    
+    def close(self):
+        with self.lock:
+            for connection in self.connections.values():
+                connection.close()
+            self.connections = {}
+
+
+paramiko_pool = ParamikoPool()
+
+
+def Paramiko(backend, log, server, cmds, async=False):
     """
     Executes cmds to remote server using Pramaiko
     """
-    import paramiko
     script = '\n'.join(cmds)
     script = script.replace('\r', '')
     log.state = log.STARTED
@@ -30,26 +140,19 @@ def Paramiko(backend, log, server, cmds, async=False, paramiko_connections={}):
     if not cmds:
         return
     channel = None
-    ssh = None
+    connection = None
     try:
         addr = server.get_address()
         # ssh connection
-        ssh = paramiko_connections.get(addr)
-        if not ssh:
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            key = settings.ORCHESTRATION_SSH_KEY_PATH
-            try:
-                ssh.connect(addr, username=ORCHESTRA_SSH_DEFAULT_USER, key_filename=key)
-            except socket.error as e:
-                logger.error('%s timed out on %s' % (backend, addr))
-                log.state = log.TIMEOUT
-                log.stderr = str(e)
-                log.save(update_fields=('state', 'stderr', 'updated_at'))
-                return
-            paramiko_connections[addr] = ssh
-        transport = ssh.get_transport()
-        channel = transport.open_session()
+        try:
+            connection = paramiko_pool.get_connection(addr)
+        except socket.error as e:
+            logger.error('%s timed out on %s' % (backend, addr))
+            log.state = log.TIMEOUT
+            log.stderr = str(e)
+            log.save(update_fields=('state', 'stderr', 'updated_at'))
+            return
+        channel = connection.open_session()
         channel.exec_command(backend.script_executable)
         channel.sendall(script)
         channel.shutdown_write()
@@ -60,17 +163,10 @@ def Paramiko(backend, log, server, cmds, async=False, paramiko_connections={}):
             while True:
                 # Non-blocking is the secret ingridient in the async sauce
                 select.select([channel], [], [])
-                if channel.recv_ready():
-                    part = channel.recv(1024).decode('utf-8')
-                    while part:
-                        log.stdout += part
-                        part = channel.recv(1024).decode('utf-8')
-                if channel.recv_stderr_ready():
-                    part = channel.recv_stderr(1024).decode('utf-8')
-                    while part:
-                        log.stderr += part
-                        part = channel.recv_stderr(1024).decode('utf-8')
-                log.save(update_fields=('stdout', 'stderr', 'updated_at'))
+                while channel.recv_ready():
+                    log.writer.write(log.STDOUT, channel.recv(32768))
+                while channel.recv_stderr_ready():
+                    log.writer.write(log.STDERR, channel.recv_stderr(32768))
                 if channel.exit_status_ready():
                     if second:
                         break
@@ -80,21 +176,27 @@ def Paramiko(backend, log, server, cmds, async=False, paramiko_connections={}):
             log.stderr += channel.makefile_stderr('rb', -1).read().decode('utf-8')
         
         log.exit_code = channel.recv_exit_status()
+        log.writer.close()
         log.state = log.SUCCESS if log.exit_code == 0 else log.FAILURE
         logger.debug('%s execution state on %s is %s' % (backend, server, log.state))
         log.save()
+        log.writer.clean()
     except:
+        log.writer.close()
         log.state = log.ERROR
         log.traceback = ExceptionInfo(sys.exc_info()).traceback
         logger.error('Exception while executing %s on %s' % (backend, server))
         logger.debug(log.traceback)
         log.save()
+        log.writer.clean()
     finally:
         if log.state == log.STARTED:
             log.state = log.ABORTED
             log.save(update_fields=('state', 'updated_at'))
-        if channel is not None:
-            channel.close()
+        if connection is not None:
+            if channel is not None:
+                connection.close_session(channel)
+            paramiko_pool.release(addr, connection)
 
 
 def OpenSSH(backend, log, server, cmds, async=False):
@@ -114,9 +216,9 @@ def OpenSSH(backend, log, server, cmds, async=False):
         logger.debug('%s running on %s' % (backend, server))
         if async:
             for state in ssh:
-                log.stdout += state.stdout.decode('utf8')
-                log.stderr += state.stderr.decode('utf8')
-                log.save(update_fields=('stdout', 'stderr', 'updated_at'))
+                log.writer.write(log.STDOUT, state.stdout)
+                log.writer.write(log.STDERR, state.stderr)
+            log.writer.close()
             exit_code = state.exit_code
         else:
             log.stdout += ssh.stdout.decode('utf8')
@@ -130,12 +232,15 @@ def OpenSSH(backend, log, server, cmds, async=False):
                 log.state = log.SUCCESS if exit_code == 0 else log.FAILURE
         logger.debug('%s execution state on %s is %s' % (backend, server, log.state))
         log.save()
+        log.writer.clean()
     except:
+        log.writer.close()
         log.state = log.ERROR
         log.traceback = ExceptionInfo(sys.exc_info()).traceback
         logger.error('Exception while executing %s on %s' % (backend, server))
         logger.debug(log.traceback)
         log.save()
+        log.writer.clean()
     finally:
         if log.state == log.STARTED:
             log.state = log.ABORTED
@@ -162,25 +267,28 @@ def Python(backend, log, server, cmds, async=False):
     log.script = '\n'.join((log.script, script))
     log.save(update_fields=('script', 'state', 'updated_at'))
     stdout = ''
+    # Only running executions are worth tailing
+    log.writer.autoflush = async
     try:
         for cmd in cmds:
             with CaptureStdout() as stdout:
                 result = cmd(server)
             for line in stdout:
-                log.stdout += line + '\n'
+                log.writer.write(log.STDOUT, line + '\n')
             if result:
-                log.stdout += '# Result: %s\n' % result
-            if async:
-                log.save(update_fields=('stdout', 'updated_at'))
+                log.writer.write(log.STDOUT, '# Result: %s\n' % result)
     except:
+        log.writer.write(log.STDOUT, '\n'.join(stdout))
+        log.writer.close()
         log.exit_code = 1
         log.state = log.FAILURE
-        log.stdout += '\n'.join(stdout)
         log.traceback += ExceptionInfo(sys.exc_info()).traceback
         logger.error('Exception while executing %s on %s' % (backend, server))
     else:
+        log.writer.close()
         if not log.exit_code:
             log.exit_code = 0
             log.state = log.SUCCESS
         logger.debug('%s execution state on %s is %s' % (backend, server, log.state))
     log.save()
+    log.writer.clean()
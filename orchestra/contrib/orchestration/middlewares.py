@@ -9,21 +9,21 @@ from django.http.response import HttpResponseServerError
 
 from orchestra.utils.python import OrderedSet
 
-from . import manager, Operation
+from . import manager, settings, Operation
 from .helpers import message_user
-from .models import BackendLog, BackendOperation
+from .models import BackendLog, BackendLogChunk, BackendOperation, QueuedOperation
 
 
 @receiver(post_save, dispatch_uid='orchestration.post_save_collector')
 def post_save_collector(sender, *args, **kwargs):
-    if sender not in (BackendLog, BackendOperation, LogEntry):
+    if sender not in (BackendLog, BackendLogChunk, BackendOperation, QueuedOperation, LogEntry):
         instance = kwargs.get('instance')
         OperationsMiddleware.collect(Operation.SAVE, **kwargs)
 
 
 @receiver(pre_delete, dispatch_uid='orchestration.pre_delete_collector')
 def pre_delete_collector(sender, *args, **kwargs):
-    if sender not in (BackendLog, BackendOperation, LogEntry):
+    if sender not in (BackendLog, BackendLogChunk, BackendOperation, QueuedOperation, LogEntry):
         OperationsMiddleware.collect(Operation.DELETE, **kwargs)
 
 
@@ -55,16 +55,6 @@ class OperationsMiddleware(object):
             return request.pending_operations
         return set()
     
-    @classmethod
-    def get_route_cache(cls):
-        """ chache the routes to save sql queries """
-        if hasattr(cls.thread_locals, 'request'):
-            request = cls.thread_locals.request
-            if not hasattr(request, 'route_cache'):
-                request.route_cache = {}
-            return request.route_cache
-        return {}
-    
     @classmethod
     def collect(cls, action, **kwargs):
         """ Collects all pending operations derived from model signals """
@@ -72,7 +62,6 @@ class OperationsMiddleware(object):
         if request is None:
             return
         kwargs['operations'] = cls.get_pending_operations()
-        kwargs['route_cache'] = cls.get_route_cache()
         instance = kwargs.pop('instance')
         manager.collect(instance, action, **kwargs)
     
@@ -99,16 +88,23 @@ class OperationsMiddleware(object):
         """ Processes pending backend operations """
         if response.status_code != 500:
             operations = self.get_pending_operations()
+            if operations and settings.ORCHESTRATION_QUEUE_OPERATIONS:
+                try:
+                    # Committed along with the changes that originated them
+                    operations = QueuedOperation.objects.enqueue(operations)
+                except Exception as exception:
+                    self.leave_transaction_management(exception)
+                    raise
             if operations:
                 try:
-                    scripts, serialize = manager.generate(operations)
+                    scripts = manager.generate(operations)
                 except Exception as exception:
                     self.leave_transaction_management(exception)
                     raise
                 # We commit transaction just before executing operations
                 # because here is when IntegrityError show up
                 self.leave_transaction_management()
-                logs = manager.execute(scripts, serialize=serialize)
+                logs = manager.execute(scripts)
                 if logs and resolve(request.path).app_name == 'admin':
                     message_user(request, logs)
                 return response
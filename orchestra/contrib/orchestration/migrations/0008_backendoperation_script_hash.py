@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestration', '0007_backendlogchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backendoperation',
+            name='script_hash',
+            field=models.CharField(blank=True, max_length=40, verbose_name='script hash'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('orchestration', '0008_backendoperation_script_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedOperation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('backend', models.CharField(max_length=256, verbose_name='backend')),
+                ('action', models.CharField(max_length=64, verbose_name='action')),
+                ('object_id', models.PositiveIntegerField(null=True)),
+                ('instance_repr', models.CharField(max_length=256, verbose_name='instance representation')),
+                ('data', models.BinaryField(verbose_name='data')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='created')),
+                ('claimed_by', models.CharField(blank=True, db_index=True, max_length=32, verbose_name='claimed by')),
+                ('claimed_at', models.DateTimeField(null=True, verbose_name='claimed')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+            options={
+                'verbose_name': 'Queued operation',
+                'verbose_name_plural': 'Queued operations',
+            },
+        ),
+    ]
@@ -1,10 +1,20 @@
+import codecs
 import logging
+import pickle
 import socket
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
 
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import force_text
 from django.utils.functional import cached_property
 from django.utils.module_loading import autodiscover_modules
@@ -12,6 +22,7 @@ from django.utils.translation import ugettext_lazy as _
 
 from orchestra.core.validators import validate_ip_address, validate_hostname, OrValidator
 from orchestra.models.fields import NullableCharField, MultiSelectField
+from orchestra.utils.python import format_exception
 
 from . import settings
 from .backends import ServiceBackend
@@ -33,6 +44,7 @@ class Server(models.Model):
     os = models.CharField(_("operative system"), max_length=32,
         choices=settings.ORCHESTRATION_OS_CHOICES,
         default=settings.ORCHESTRATION_DEFAULT_OS)
+    updated_at = models.DateTimeField(_("updated"), auto_now=True)
     
     def __str__(self):
         return self.name or str(self.address)
@@ -76,6 +88,9 @@ class BackendLog(models.Model):
     # Special state for mocked backendlogs
     EXCEPTION = 'EXCEPTION'
     
+    STDOUT = 'stdout'
+    STDERR = 'stderr'
+    
     STATES = (
         (RECEIVED, RECEIVED),
         (TIMEOUT, TIMEOUT),
@@ -121,6 +136,117 @@ class BackendLog(models.Model):
     
     def backend_class(self):
         return ServiceBackend.get_backend(self.backend)
+    
+    @cached_property
+    def writer(self):
+        return LogWriter(self)
+    
+    def get_output(self, stream):
+        """ stream output, including the chunks already flushed by a running execution """
+        output = getattr(self, stream)
+        if not self.has_finished and self.pk:
+            chunks = self.chunks.filter(stream=stream).values_list('content', flat=True)
+            output += ''.join(chunks)
+        return output
+    
+    @property
+    def current_stdout(self):
+        return self.get_output(BackendLog.STDOUT)
+    
+    @property
+    def current_stderr(self):
+        return self.get_output(BackendLog.STDERR)
+
+
+class BackendLogChunk(models.Model):
+    """ Append-only output of running executions, merged into its log once finished """
+    STREAMS = (
+        (BackendLog.STDOUT, BackendLog.STDOUT),
+        (BackendLog.STDERR, BackendLog.STDERR),
+    )
+    
+    log = models.ForeignKey(BackendLog, related_name='chunks')
+    stream = models.CharField(_("stream"), max_length=6, choices=STREAMS)
+    content = models.TextField(_("content"))
+    
+    class Meta:
+        ordering = ('id',)
+
+
+class LogWriter(object):
+    """
+    Buffers the output of an execution
+    
+    Chunks are kept in memory, where readers can tail them by index, and flushed every
+    ORCHESTRATION_LOG_FLUSH_INTERVAL seconds or ORCHESTRATION_LOG_FLUSH_SIZE characters as
+    BackendLogChunk rows. close() assembles the output into the log fields only once,
+    instead of rewriting the whole stdout on every chunk, and clean() drops the chunks
+    after the log has been saved.
+    """
+    def __init__(self, log, interval=None, size=None):
+        self.log = log
+        self.interval = interval or settings.ORCHESTRATION_LOG_FLUSH_INTERVAL
+        self.size = size or settings.ORCHESTRATION_LOG_FLUSH_SIZE
+        self.decoders = {
+            BackendLog.STDOUT: codecs.getincrementaldecoder('utf8')(errors='replace'),
+            BackendLog.STDERR: codecs.getincrementaldecoder('utf8')(errors='replace'),
+        }
+        # (stream, content) tuples in arrival order, only appended to
+        self.chunks = []
+        # callables notified of every chunk, i.e. ExecutionEvents
+        self.listeners = []
+        self.flushed = 0
+        self.merged = 0
+        self.pending_size = 0
+        self.stored = False
+        self.autoflush = True
+        self.last_flush = time.time()
+    
+    def write(self, stream, content, final=False):
+        if isinstance(content, bytes):
+            content = self.decoders[stream].decode(content, final=final)
+        if content:
+            self.chunks.append((stream, content))
+            for listener in self.listeners:
+                listener(self.log, stream, content)
+            self.pending_size += len(content)
+            if not self.autoflush:
+                return
+            if self.pending_size >= self.size or time.time()-self.last_flush >= self.interval:
+                self.flush()
+    
+    def flush(self):
+        """ stores pending chunks, making them visible to other processes """
+        pending = self.chunks[self.flushed:]
+        if pending:
+            BackendLogChunk.objects.bulk_create([
+                BackendLogChunk(log=self.log, stream=stream, content=content)
+                    for stream, content in pending
+            ])
+            self.stored = True
+            self.flushed += len(pending)
+            self.log.save(update_fields=('updated_at',))
+        self.pending_size = 0
+        self.last_flush = time.time()
+    
+    def get_value(self, stream, start=0):
+        return ''.join(content for s, content in self.chunks[start:] if s == stream)
+    
+    def close(self):
+        """ merges the buffered output into the log fields, the caller is expected to save it """
+        for stream in self.decoders:
+            self.write(stream, b'', final=True)
+        self.log.stdout += self.get_value(BackendLog.STDOUT, start=self.merged)
+        self.log.stderr += self.get_value(BackendLog.STDERR, start=self.merged)
+        self.merged = len(self.chunks)
+        self.flushed = self.merged
+        self.pending_size = 0
+    
+    def clean(self):
+        """ deletes the stored chunks, only once the log has been saved with the merged output """
+        if self.stored:
+            self.log.chunks.all().delete()
+            self.stored = False
 
 
 class BackendOperationQuerySet(models.QuerySet):
@@ -141,6 +267,7 @@ class BackendOperation(models.Model):
     content_type = models.ForeignKey(ContentType)
     object_id = models.PositiveIntegerField(null=True)
     instance_repr = models.CharField(_("instance representation"), max_length=256)
+    script_hash = models.CharField(_("script hash"), max_length=40, blank=True)
     
     instance = GenericForeignKey('content_type', 'object_id')
     objects = BackendOperationQuerySet.as_manager()
@@ -160,36 +287,196 @@ class BackendOperation(models.Model):
         return ServiceBackend.get_backend(self.backend)
 
 
+class QueuedOperationQuerySet(models.QuerySet):
+    def enqueue(self, operations):
+        """
+        Stores operations for being executed by a queue worker, see manager.execute_queued()
+        returns the operations that can not be queued because their instance is not picklable
+        """
+        content_types = {}
+        objs = []
+        rejected = []
+        for operation in operations:
+            instance = operation.instance
+            try:
+                # Deleted instances can not be fetched again and dynamic attributes matter
+                data = pickle.dumps(instance, protocol=pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, TypeError, AttributeError) as exc:
+                logger.warning('%s can not be queued: %s' % (operation, exc))
+                rejected.append(operation)
+                continue
+            model = type(instance)
+            try:
+                content_type = content_types[model]
+            except KeyError:
+                content_type = ContentType.objects.get_for_model(instance)
+                content_types[model] = content_type
+            objs.append(self.model(
+                backend=operation.backend.get_name(),
+                action=operation.action,
+                content_type=content_type,
+                object_id=instance.pk,
+                instance_repr=force_text(instance)[:256],
+                data=data,
+            ))
+        self.bulk_create(objs)
+        return rejected
+    
+    def get_claim_deadline(self):
+        return timezone.now() - timedelta(seconds=settings.ORCHESTRATION_QUEUE_CLAIM_TIMEOUT)
+    
+    def pending(self):
+        """ not claimed by any worker, or claimed by one that did not finish on time """
+        stale = self.get_claim_deadline()
+        return self.filter(Q(claimed_at__isnull=True) | Q(claimed_at__lt=stale))
+    
+    def in_flight(self):
+        """ claimed by a worker that is still on time """
+        return self.filter(claimed_at__gte=self.get_claim_deadline())
+    
+    def get_keys(self):
+        return set(self.values_list('backend', 'content_type_id', 'object_id'))
+    
+    def claim(self, token, quiet_since):
+        """
+        claims with token the pending operations of the keys (backend and object) without
+        changes after quiet_since, returns the claimed operations
+        
+        Keys are claimed as a whole: keys with operations in flight are skipped, and keys
+        partially claimed by a concurrent worker are released for a later run, so operations
+        of the same backend and object are never executed concurrently.
+        """
+        in_flight = self.in_flight().get_keys()
+        changes = OrderedDict()
+        pending = self.pending().order_by('id')
+        for pk, backend, content_type_id, object_id, created_at in pending.values_list(
+                'pk', 'backend', 'content_type_id', 'object_id', 'created_at'):
+            key = (backend, content_type_id, object_id)
+            changes.setdefault(key, []).append((pk, created_at))
+        ids = []
+        for key, key_changes in changes.items():
+            if key not in in_flight and key_changes[-1][1] <= quiet_since:
+                ids.extend(pk for pk, __ in key_changes)
+        if not ids:
+            return self.none()
+        # Only one worker will succeed on claiming each operation
+        self.pending().filter(id__in=ids).update(claimed_by=token, claimed_at=timezone.now())
+        claimed = self.filter(claimed_by=token)
+        conflicts = claimed.get_keys() & self.in_flight().exclude(claimed_by=token).get_keys()
+        for backend, content_type_id, object_id in conflicts:
+            claimed.filter(backend=backend, content_type_id=content_type_id,
+                object_id=object_id).update(claimed_by='', claimed_at=None)
+        return self.filter(claimed_by=token)
+
+
+class QueuedOperation(models.Model):
+    """
+    Operation waiting to be executed out of the request/response cycle,
+    pending operations of the same backend and object are coalesced
+    """
+    backend = models.CharField(_("backend"), max_length=256)
+    action = models.CharField(_("action"), max_length=64)
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField(null=True)
+    instance_repr = models.CharField(_("instance representation"), max_length=256)
+    data = models.BinaryField(_("data"))
+    created_at = models.DateTimeField(_("created"), auto_now_add=True, db_index=True)
+    claimed_by = models.CharField(_("claimed by"), max_length=32, blank=True, db_index=True)
+    claimed_at = models.DateTimeField(_("claimed"), null=True)
+    
+    objects = QueuedOperationQuerySet.as_manager()
+    
+    class Meta:
+        verbose_name = _("Queued operation")
+        verbose_name_plural = _("Queued operations")
+    
+    def __str__(self):
+        return '%s.%s(%s)' % (self.backend, self.action, self.instance_repr)
+    
+    @property
+    def key(self):
+        return (self.backend, self.content_type_id, self.object_id)
+    
+    @cached_property
+    def backend_class(self):
+        return ServiceBackend.get_backend(self.backend)
+    
+    def get_instance(self):
+        return pickle.loads(bytes(self.data))
+
+
 autodiscover_modules('backends')
 
 
-class RouteQuerySet(models.QuerySet):
-    def get_for_operation(self, operation, **kwargs):
-        cache = kwargs.get('cache', {})
-        if not cache:
-            for route in self.filter(is_active=True).select_related('host'):
+class RouteIndex(object):
+    """
+    Process-wide index of active routes keyed by (backend, action)
+    
+    Built once instead of querying and rebuilding the routes on every collection. Each lookup
+    compares a cheap version of the routes and their hosts, thus changes made by other
+    processes are picked up right away.
+    """
+    def __init__(self):
+        self.index = None
+        self.version = None
+        self.lock = threading.Lock()
+    
+    def get_version(self, queryset):
+        """ changes whenever a route, or the host of a route, is created, updated or deleted """
+        version = queryset.aggregate(
+            count=models.Count('id'),
+            last_id=models.Max('id'),
+            updated_at=models.Max('updated_at'),
+            host_updated_at=models.Max('host__updated_at'),
+        )
+        return (version['count'], version['last_id'], version['updated_at'], version['host_updated_at'])
+    
+    def build(self, queryset):
+        index = {}
+        for route in queryset.filter(is_active=True).select_related('host'):
+            try:
+                backend_class = route.backend_class
+            except KeyError:
+                logger.warning("Backed '%s' not installed." % route.backend)
+                continue
+            try:
+                # compile now, avoiding parsing the expression on each match
+                route.compiled_match
+            except SyntaxError as exc:
+                logger.error("Route %s has an invalid match: %s" % (route, exc))
+                continue
+            for action in backend_class.get_actions():
+                key = (route.backend, action)
                 try:
-                    backend_class = route.backend_class
+                    index[key].append(route)
                 except KeyError:
-                    logger.warning("Backed '%s' not installed." % route.backend)
-                else:
-                    for action in backend_class.get_actions():
-                        key = (route.backend, action)
-                        try:
-                            cache[key].append(route)
-                        except KeyError:
-                            cache[key] = [route]
-        routes = []
+                    index[key] = [route]
+        return index
+    
+    def get(self, queryset, key):
+        version = self.get_version(queryset)
+        with self.lock:
+            if self.index is None or self.version != version:
+                self.index = self.build(queryset)
+                self.version = version
+            index = self.index
+        return index.get(key, [])
+    
+    def invalidate(self):
+        self.index = None
+
+
+route_index = RouteIndex()
+
+
+class RouteQuerySet(models.QuerySet):
+    def get_for_operation(self, operation, **kwargs):
         backend_cls = operation.backend
         key = (backend_cls.get_name(), operation.action)
-        try:
-            target_routes = cache[key]
-        except KeyError:
-            pass
-        else:
-            for route in target_routes:
-                if route.matches(operation.instance):
-                    routes.append(route)
+        routes = []
+        for route in route_index.get(self, key):
+            if route.matches(operation.instance):
+                routes.append(route)
         return routes
 
 
@@ -211,6 +498,7 @@ class Route(models.Model):
 #    method = models.CharField(_("method"), max_lenght=32, choices=method_choices,
 #            default=MethodBackend.get_default())
     is_active = models.BooleanField(_("active"), default=True)
+    updated_at = models.DateTimeField(_("updated"), auto_now=True)
     
     objects = RouteQuerySet.as_manager()
     
@@ -227,6 +515,13 @@ class Route(models.Model):
     def clean(self):
         if not self.match:
             self.match = 'True'
+        self.__dict__.pop('compiled_match', None)
+        try:
+            self.compiled_match
+        except SyntaxError as exception:
+            raise ValidationError({
+                'match': format_exception(exception)
+            })
         if self.backend:
             try:
                 backend_class = self.backend_class
@@ -248,13 +543,17 @@ class Route(models.Model):
     def action_is_async(self, action):
         return action in self.async_actions
     
+    @cached_property
+    def compiled_match(self):
+        return compile(self.match or 'True', '<route %s>' % self, 'eval')
+    
     def matches(self, instance):
         safe_locals = {
             'instance': instance,
             'obj': instance,
             instance._meta.model_name: instance,
         }
-        return eval(self.match, safe_locals)
+        return eval(self.compiled_match, safe_locals)
     
     def enable(self):
         self.is_active = True
@@ -263,3 +562,11 @@ class Route(models.Model):
     def disable(self):
         self.is_active = False
         self.save()
+
+
+@receiver(post_save, sender=Route, dispatch_uid='orchestration.save_route_index')
+@receiver(post_delete, sender=Route, dispatch_uid='orchestration.delete_route_index')
+@receiver(post_save, sender=Server, dispatch_uid='orchestration.save_server_route_index')
+@receiver(post_delete, sender=Server, dispatch_uid='orchestration.delete_server_route_index')
+def invalidate_route_index(sender, **kwargs):
+    route_index.invalidate()
@@ -0,0 +1,157 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+
+from . import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class Task(object):
+    """ Handle of a unit of work submitted to the pool, join() blocks until it has finished """
+    def __init__(self, func, host, args, kwargs):
+        self.func = func
+        self.host = host
+        self.args = args
+        self.kwargs = kwargs
+        self.finished = threading.Event()
+        self.callbacks = []
+    
+    def __str__(self):
+        return '%s@%s' % (getattr(self.func, '__name__', self.func), self.host)
+    
+    def run(self):
+        try:
+            self.func(*self.args, **self.kwargs)
+        except Exception:
+            logger.exception('Exception while running %s' % self)
+        finally:
+            self.finished.set()
+            for callback in self.callbacks:
+                callback(self)
+    
+    def join(self, timeout=None):
+        return self.finished.wait(timeout)
+
+
+class ExecutionPool(object):
+    """
+    Bounded pool of worker threads used for running backends concurrently
+    
+    max_workers limits the total number of running backends, thus the number of
+    database connections and ssh sessions opened by this process.
+    max_per_host limits how many of them can run simultaneously against the same host.
+    Pending tasks are queued per host and hosts are served in round-robin fashion,
+    preventing a large batch on one server from starving the others.
+    Workers are started on demand and exit when there is nothing left to do.
+    """
+    def __init__(self, max_workers=None, max_per_host=None):
+        self.max_workers = max_workers or settings.ORCHESTRATION_MAX_WORKERS
+        self.max_per_host = max_per_host or settings.ORCHESTRATION_MAX_PER_HOST
+        self.queues = OrderedDict()
+        self.running = {}
+        self.workers = 0
+        self.condition = threading.Condition()
+    
+    def submit(self, func, host, *args, **kwargs):
+        task = Task(func, host, args, kwargs)
+        self.enqueue(task)
+        return task
+    
+    def enqueue(self, task):
+        host = task.host
+        with self.condition:
+            try:
+                self.queues[host].append(task)
+            except KeyError:
+                self.queues[host] = deque([task])
+            if self.workers < self.max_workers:
+                self.workers += 1
+                worker = threading.Thread(target=self.work)
+                worker.start()
+            else:
+                self.condition.notify()
+    
+    def get_task(self):
+        """ next task of the first host that has not reached max_per_host, moving it to the end """
+        for host, queue in self.queues.items():
+            if self.running.get(host, 0) < self.max_per_host:
+                task = queue.popleft()
+                if queue:
+                    self.queues.move_to_end(host)
+                else:
+                    self.queues.pop(host)
+                self.running[host] = self.running.get(host, 0) + 1
+                return task
+    
+    def work(self):
+        while True:
+            with self.condition:
+                task = self.get_task()
+                while task is None:
+                    if not self.queues:
+                        self.workers -= 1
+                        return
+                    # All pending hosts are saturated
+                    self.condition.wait()
+                    task = self.get_task()
+            try:
+                task.run()
+            finally:
+                with self.condition:
+                    self.running[task.host] -= 1
+                    if not self.running[task.host]:
+                        self.running.pop(task.host)
+                    self.condition.notify_all()
+
+
+class TaskGraph(object):
+    """
+    Submits tasks to the pool as soon as all the tasks they depend on have finished,
+    thus independent branches run concurrently.
+    Tasks have to be added after their dependencies, and start() called once all are added.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.pending = OrderedDict()
+        self.dependents = {}
+        self.lock = threading.Lock()
+    
+    def add(self, func, host, *args, after=(), **kwargs):
+        task = Task(func, host, args, kwargs)
+        task.callbacks.append(self.finished)
+        self.pending[task] = len(after)
+        for dependency in after:
+            self.dependents.setdefault(dependency, []).append(task)
+        return task
+    
+    def start(self):
+        with self.lock:
+            ready = [ task for task, pending in self.pending.items() if not pending ]
+        for task in ready:
+            self.pool.enqueue(task)
+    
+    def finished(self, task):
+        ready = []
+        with self.lock:
+            for dependent in self.dependents.pop(task, ()):
+                self.pending[dependent] -= 1
+                if not self.pending[dependent]:
+                    ready.append(dependent)
+        for task in ready:
+            self.pool.enqueue(task)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """ process-wide pool, so limits hold across concurrent requests """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ExecutionPool()
+    return _pool
@@ -45,7 +45,107 @@ ORCHESTRATION_SSH_METHOD_BACKEND = Setting('ORCHESTRATION_SSH_METHOD_BACKEND',
     'orchestra.contrib.orchestration.methods.OpenSSH',
     help_text=_("Two methods are provided:<br>"
                 "1) <tt>orchestra.contrib.orchestration.methods.OpenSSH</tt> with ControlPersist.<br>"
-                "2) <tt>orchestra.contrib.orchestration.methods.Paramiko</tt> with connection pool.<br>"
+                "2) <tt>orchestra.contrib.orchestration.methods.Paramiko</tt> with a keepalive connection pool.<br>"
                 "Both perform similarly, but OpenSSH has the advantage that the connections are shared between workers. "
                 "Paramiko, in contrast, has a per worker connection pool.")
 )
+
+
+ORCHESTRATION_MAX_WORKERS = Setting('ORCHESTRATION_MAX_WORKERS',
+    20,
+    help_text=_("Maximum number of backends executed concurrently by each process, "
+                "it also bounds the number of database connections and SSH sessions used for execution.")
+)
+
+
+ORCHESTRATION_MAX_PER_HOST = Setting('ORCHESTRATION_MAX_PER_HOST',
+    4,
+    help_text=_("Maximum number of backends executed concurrently on the same server.<br>"
+                "Keep it below sshd <tt>MaxSessions</tt>.")
+)
+
+
+ORCHESTRATION_PARAMIKO_KEEPALIVE = Setting('ORCHESTRATION_PARAMIKO_KEEPALIVE',
+    30,
+    help_text=_("Seconds between keepalive packets sent over pooled Paramiko connections.")
+)
+
+
+ORCHESTRATION_PARAMIKO_MAX_IDLE = Setting('ORCHESTRATION_PARAMIKO_MAX_IDLE',
+    600,
+    help_text=_("Pooled Paramiko connections unused for more than this number of seconds are closed.")
+)
+
+
+ORCHESTRATION_PARAMIKO_MAX_CHANNELS = Setting('ORCHESTRATION_PARAMIKO_MAX_CHANNELS',
+    8,
+    help_text=_("Maximum number of concurrent sessions opened on a single Paramiko connection.")
+)
+
+
+ORCHESTRATION_LOG_FLUSH_INTERVAL = Setting('ORCHESTRATION_LOG_FLUSH_INTERVAL',
+    1,
+    help_text=_("Seconds between flushes of the output of running backends to the database.")
+)
+
+
+ORCHESTRATION_LOG_FLUSH_SIZE = Setting('ORCHESTRATION_LOG_FLUSH_SIZE',
+    64*1024,
+    help_text=_("Buffered characters that force a flush of the output of running backends.")
+)
+
+
+ORCHESTRATION_OPERATION_BATCH_SIZE = Setting('ORCHESTRATION_OPERATION_BATCH_SIZE',
+    500,
+    help_text=_("Number of executed operations stored per database INSERT.")
+)
+
+
+ORCHESTRATION_LOG_CONN_MAX_AGE = Setting('ORCHESTRATION_LOG_CONN_MAX_AGE',
+    None,
+    help_text=_("Lifetime in seconds of the autocommit connection used for creating backend logs "
+                "outside the current transaction. None keeps it open for the whole process.")
+)
+
+
+ORCHESTRATION_BUNDLE_SCRIPTS = Setting('ORCHESTRATION_BUNDLE_SCRIPTS',
+    False,
+    help_text=_("Merge the bash scripts of all the backends that target the same server into a single "
+                "remote run, reloading each service only once at the end.")
+)
+
+
+ORCHESTRATION_PREFETCH_BATCH_SIZE = Setting('ORCHESTRATION_PREFETCH_BATCH_SIZE',
+    1000,
+    help_text=_("Number of instances whose related objects are prefetched together while "
+                "generating backend scripts.")
+)
+
+
+ORCHESTRATION_SKIP_UNCHANGED = Setting('ORCHESTRATION_SKIP_UNCHANGED',
+    True,
+    help_text=_("Do not execute save operations whose generated script is the same as the one of "
+                "their last successful execution on the same server.")
+)
+
+
+ORCHESTRATION_QUEUE_OPERATIONS = Setting('ORCHESTRATION_QUEUE_OPERATIONS',
+    False,
+    help_text=_("Commit the operations of each request to a queue instead of executing them "
+                "before returning the response. A worker has to run the "
+                "<tt>executequeuedoperations</tt> management command.")
+)
+
+
+ORCHESTRATION_QUEUE_DEBOUNCE = Setting('ORCHESTRATION_QUEUE_DEBOUNCE',
+    5,
+    help_text=_("Seconds a queued operation waits for further changes of the same object, "
+                "successive operations are coalesced into one execution.")
+)
+
+
+ORCHESTRATION_QUEUE_CLAIM_TIMEOUT = Setting('ORCHESTRATION_QUEUE_CLAIM_TIMEOUT',
+    60*60,
+    help_text=_("Seconds after which operations claimed by a worker that has not finished "
+                "are executed again.")
+)
@@ -0,0 +1,148 @@
+import subprocess
+
+from orchestra.utils.tests import BaseTestCase
+
+from .. import backends, manager, settings
+from ..bundle import BundleLog, ScriptBundle
+from ..models import BackendLog, Server
+
+
+def LocalBash(backend, log, server, cmds, async=False):
+    """ stands for the SSH method, running the script on this machine """
+    log.state = log.STARTED
+    process = subprocess.Popen(['/bin/bash'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate('\n'.join(cmds).encode('utf8'))
+    log.writer.write(log.STDOUT, stdout)
+    log.writer.write(log.STDERR, stderr)
+    log.writer.close()
+    log.exit_code = process.returncode
+    log.state = log.SUCCESS if log.exit_code == 0 else log.FAILURE
+
+
+class BundledBackend(backends.ServiceController):
+    verbose_name = 'Bundled'
+    model = 'orchestration.Route'
+    
+    def save(self, commands):
+        self.append(commands)
+
+
+class CustomExecutionBackend(BundledBackend):
+    verbose_name = 'Custom execution'
+    
+    def execute(self, server, async=False, log=None):
+        return super(CustomExecutionBackend, self).execute(server, async=async, log=log)
+
+
+class PythonBackend(BundledBackend):
+    verbose_name = 'Python'
+    
+    def save(self, commands):
+        self.append(print, commands)
+
+
+class DependentBackend(BundledBackend):
+    verbose_name = 'Dependent'
+    dependencies = ('PythonBackend',)
+
+
+class SerializeBackend(BundledBackend):
+    verbose_name = 'Serialize'
+    serialize = True
+
+
+class BundleTests(BaseTestCase):
+    def setUp(self):
+        self.server = Server.objects.create(name='localhost')
+        self.ssh_method = settings.ORCHESTRATION_SSH_METHOD_BACKEND
+        self.bundle_scripts = settings.ORCHESTRATION_BUNDLE_SCRIPTS
+        settings.ORCHESTRATION_SSH_METHOD_BACKEND = '%s.LocalBash' % __name__
+    
+    def tearDown(self):
+        settings.ORCHESTRATION_SSH_METHOD_BACKEND = self.ssh_method
+        settings.ORCHESTRATION_BUNDLE_SCRIPTS = self.bundle_scripts
+    
+    def get_backend(self, commands, backend_class=BundledBackend):
+        backend = backend_class()
+        backend.set_head()
+        backend.save(commands)
+        backend.commit()
+        return backend
+    
+    def test_accepts(self):
+        log = BackendLog(state=BackendLog.RECEIVED)
+        self.assertTrue(ScriptBundle.accepts(self.get_backend('echo 1'), log))
+        # Their execute() would be skipped
+        self.assertFalse(ScriptBundle.accepts(self.get_backend('echo 1', CustomExecutionBackend), log))
+        log.state = BackendLog.NOTHING
+        self.assertFalse(ScriptBundle.accepts(self.get_backend('echo 1'), log))
+    
+    def test_split(self):
+        bundle = ScriptBundle(self.server)
+        bundle.add(self.get_backend('echo one; echo err >&2'), None, [])
+        bundle.add(self.get_backend('echo partial; exit 3'), None, [])
+        bundle.add(self.get_backend("printf 'no new line'"), None, [])
+        log = BundleLog()
+        LocalBash(bundle, log, self.server, [bundle.get_script()])
+        stdout, exits = bundle.split(log.stdout)
+        stderr, __ = bundle.split(log.stderr)
+        self.assertEqual('one\n', stdout['0'])
+        self.assertEqual('err\n', stderr['0'])
+        self.assertEqual('partial\n', stdout['1'])
+        self.assertEqual('no new line', stdout['2'])
+        self.assertEqual(['0'], exits['0'])
+        self.assertEqual(['3'], exits['1'])
+        self.assertEqual(['0'], exits['2'])
+        self.assertEqual('0', exits['reload'][0])
+    
+    def test_execute(self):
+        bundle = ScriptBundle(self.server)
+        commands = ('echo one', 'echo partial; exit 3', 'echo three')
+        for command in commands:
+            backend = self.get_backend(command)
+            log = backend.create_log(self.server)
+            bundle.add(backend, log, [])
+        logs = bundle.execute(self.server)
+        self.assertEqual(
+            [(BackendLog.SUCCESS, 0, 'one\n'), (BackendLog.FAILURE, 3, 'partial\n'),
+             (BackendLog.SUCCESS, 0, 'three\n')],
+            [(log.state, log.exit_code, log.stdout) for log in logs]
+        )
+    
+    def test_bundle_log_chunks(self):
+        log = BundleLog()
+        for ix in range(100):
+            log.write(log.STDOUT, ('%i\n' % ix).encode('utf8'))
+        log.write(log.STDERR, b'\xc3')
+        log.write(log.STDERR, b'\xa9')
+        log.close()
+        self.assertEqual(''.join('%i\n' % ix for ix in range(100)), log.stdout)
+        self.assertEqual('\xe9', log.stderr)
+        log.stdout += 'end'
+        self.assertTrue(log.stdout.endswith('99\nend'))
+    
+    def test_get_jobs(self):
+        settings.ORCHESTRATION_BUNDLE_SCRIPTS = True
+        backend_classes = (
+            BundledBackend, PythonBackend, DependentBackend, BundledBackend, SerializeBackend,
+            BundledBackend,
+        )
+        entries = []
+        for backend_class in backend_classes:
+            backend = self.get_backend('echo 1', backend_class)
+            log = BackendLog(state=BackendLog.RECEIVED)
+            entries.append((self.server, False, backend, log, []))
+        jobs = []
+        for server, is_async, job in manager.get_jobs(entries):
+            if isinstance(job, ScriptBundle):
+                jobs.append([type(backend) for backend, __, __ in job.members])
+            else:
+                jobs.append(type(job[0]))
+        # DependentBackend would run before PythonBackend within the bundle,
+        # the last BundledBackend comes after a barrier
+        self.assertEqual([
+                [BundledBackend, BundledBackend], PythonBackend, DependentBackend, SerializeBackend,
+                [BundledBackend],
+            ], jobs
+        )
@@ -0,0 +1,55 @@
+from orchestra.utils.tests import BaseTestCase
+
+from ..models import BackendLog, BackendLogChunk, LogWriter, Server
+
+
+class LogWriterTests(BaseTestCase):
+    def setUp(self):
+        server = Server.objects.create(name='web.example.com')
+        self.log = BackendLog.objects.create(backend='TestBackend', server=server)
+        self.writer = LogWriter(self.log, interval=3600, size=10)
+    
+    def get_chunks(self):
+        return list(BackendLogChunk.objects.filter(log=self.log).values_list('stream', 'content'))
+    
+    def test_flush(self):
+        self.writer.write(BackendLog.STDOUT, 'abcd')
+        self.assertEqual([], self.get_chunks())
+        # Over the flush size
+        self.writer.write(BackendLog.STDERR, 'efghijk')
+        self.assertEqual([
+            (BackendLog.STDOUT, 'abcd'),
+            (BackendLog.STDERR, 'efghijk'),
+        ], self.get_chunks())
+        self.writer.write(BackendLog.STDOUT, 'l')
+        self.assertEqual(2, len(self.get_chunks()))
+        # Readers of the running log see the flushed output
+        log = BackendLog.objects.get(pk=self.log.pk)
+        self.assertEqual('abcd', log.current_stdout)
+        self.assertEqual('efghijk', log.current_stderr)
+    
+    def test_merge(self):
+        # Multibyte characters split across chunks
+        self.writer.write(BackendLog.STDOUT, b'caf\xc3')
+        self.writer.write(BackendLog.STDERR, b'error\n')
+        self.writer.write(BackendLog.STDOUT, b'\xa9\n')
+        self.writer.close()
+        self.assertEqual('caf\xe9\n', self.log.stdout)
+        self.assertEqual('error\n', self.log.stderr)
+        # Only the output written after the previous close is merged
+        self.writer.write(BackendLog.STDOUT, 'more\n')
+        self.writer.close()
+        self.assertEqual('caf\xe9\nmore\n', self.log.stdout)
+        self.assertEqual('error\n', self.log.stderr)
+    
+    def test_clean(self):
+        self.writer.write(BackendLog.STDOUT, 'a'*20)
+        self.writer.close()
+        # Kept until the merged output has been saved
+        self.assertEqual(1, len(self.get_chunks()))
+        self.log.state = BackendLog.SUCCESS
+        self.log.save()
+        self.writer.clean()
+        self.assertEqual([], self.get_chunks())
+        log = BackendLog.objects.get(pk=self.log.pk)
+        self.assertEqual('a'*20, log.current_stdout)
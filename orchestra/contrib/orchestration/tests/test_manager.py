@@ -0,0 +1,175 @@
+import threading
+from datetime import timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from orchestra.utils import db
+from orchestra.utils.tests import BaseTestCase
+
+from .. import backends, manager, settings, Operation
+from ..events import ExecutionEvents
+from ..models import BackendLog, QueuedOperation, Route, Server
+
+
+class QueuedBackend(backends.ServiceController):
+    verbose_name = 'Queued'
+    model = 'orchestration.Server'
+
+
+class HashedBackend(backends.ServiceController):
+    verbose_name = 'Hashed'
+    model = 'orchestration.Server'
+    
+    def save(self, server):
+        self.append('echo %s' % server.name)
+
+
+class ManagerTests(BaseTestCase):
+    def setUp(self):
+        self.server = Server.objects.create(name='web.example.com')
+        self.route = Route.objects.create(backend=HashedBackend.get_name(), host=self.server)
+        self.skip_unchanged = settings.ORCHESTRATION_SKIP_UNCHANGED
+        settings.ORCHESTRATION_SKIP_UNCHANGED = True
+    
+    def tearDown(self):
+        settings.ORCHESTRATION_SKIP_UNCHANGED = self.skip_unchanged
+    
+    def create_log(self, state=BackendLog.RECEIVED):
+        return BackendLog.objects.create(backend='TestBackend', state=state, server=self.server)
+    
+    def test_keep_log_finished_on_store_failure(self):
+        log = self.create_log()
+        events = ExecutionEvents()
+        events.watch(log)
+        
+        def execute(server, log=None):
+            log.state = BackendLog.SUCCESS
+            return log
+        
+        # Storing the operations fails
+        task = manager.keep_log(execute, log, None, events)
+        with self.assertRaises(TypeError):
+            task(self.server, log=log)
+        self.assertEqual([(log, ExecutionEvents.FINISHED, None)], list(events))
+    
+    def test_events_output_after_streaming(self):
+        log = self.create_log()
+        events = ExecutionEvents()
+        events.watch(log)
+        log.writer.write(BackendLog.STDOUT, 'streamed\n')
+        log.writer.close()
+        # i.e. keep_log tracebacks
+        log.stdout += 'appended\n'
+        log.stderr += 'Traceback'
+        events.finished(log)
+        self.assertEqual([
+            (log, BackendLog.STDOUT, 'streamed\n'),
+            (log, BackendLog.STDOUT, 'appended\n'),
+            (log, BackendLog.STDERR, 'Traceback'),
+            (log, ExecutionEvents.FINISHED, None),
+        ], list(events))
+    
+    def test_execute_scheduling_failure(self):
+        events = ExecutionEvents()
+        get_jobs = manager.get_jobs
+        autocommit = db.autocommit
+        
+        def fail(entries):
+            raise RuntimeError
+        
+        manager.get_jobs = fail
+        # Logs on the test transaction
+        db.autocommit = lambda **kwargs: kwargs['origin']
+        try:
+            with self.assertRaises(RuntimeError):
+                manager.execute(self.generate(), events=events)
+        finally:
+            manager.get_jobs = get_jobs
+            db.autocommit = autocommit
+        # Iteration ends instead of waiting for the logs that never ran
+        self.assertEqual([ExecutionEvents.FINISHED], [stream for __, stream, __ in events])
+    
+    def enqueue(self, instance, *actions):
+        operations = [Operation(QueuedBackend, instance, action) for action in actions]
+        return QueuedOperation.objects.enqueue(operations)
+    
+    def test_enqueue(self):
+        self.assertEqual([], self.enqueue(self.server, Operation.SAVE, Operation.DELETE))
+        queued = list(QueuedOperation.objects.order_by('id'))
+        self.assertEqual([Operation.SAVE, Operation.DELETE], [op.action for op in queued])
+        content_type = ContentType.objects.get_for_model(Server)
+        self.assertEqual(('QueuedBackend', content_type.pk, self.server.pk), queued[0].key)
+        self.assertEqual(QueuedBackend, queued[0].backend_class)
+        self.assertEqual(self.server.name, queued[0].get_instance().name)
+        # Instances that can not be pickled are left for being executed right away
+        self.server.lock = threading.Lock()
+        rejected = self.enqueue(self.server, Operation.SAVE)
+        self.assertEqual([Operation.SAVE], [operation.action for operation in rejected])
+        self.assertEqual(2, QueuedOperation.objects.count())
+    
+    def test_coalesce(self):
+        other = Server.objects.create(name='mail.example.com')
+        self.enqueue(self.server, Operation.SAVE, Operation.DELETE, Operation.SAVE)
+        self.enqueue(other, Operation.SAVE, Operation.SAVE)
+        queued = list(QueuedOperation.objects.order_by('id'))
+        # The DELETE wins, otherwise the latest SAVE
+        self.assertEqual([queued[1], queued[4]], manager.coalesce(queued))
+    
+    def test_claim(self):
+        start = timezone.now()
+        other = Server.objects.create(name='mail.example.com')
+        self.enqueue(self.server, Operation.SAVE, Operation.SAVE)
+        self.enqueue(other, Operation.SAVE)
+        # Objects that changed after quiet_since are left for later
+        self.assertFalse(QueuedOperation.objects.claim('a', start-timedelta(seconds=10)))
+        claimed = QueuedOperation.objects.claim('a', timezone.now())
+        self.assertEqual(3, len(claimed))
+        # Keys with operations in flight are skipped, even when their new operations are quiet
+        self.enqueue(self.server, Operation.DELETE)
+        self.assertFalse(QueuedOperation.objects.claim('b', timezone.now()))
+        # Abandoned claims are claimed again, along with the rest of their key
+        timeout = settings.ORCHESTRATION_QUEUE_CLAIM_TIMEOUT+1
+        QueuedOperation.objects.filter(claimed_by='a').update(
+            claimed_at=timezone.now()-timedelta(seconds=timeout))
+        claimed = QueuedOperation.objects.claim('b', timezone.now())
+        self.assertEqual(4, len(claimed))
+        self.assertFalse(QueuedOperation.objects.pending())
+    
+    def generate(self, force=False):
+        operation = Operation(HashedBackend, self.server, Operation.SAVE, routes=[self.route])
+        return manager.generate([operation], force=force)
+    
+    def store(self, scripts, state):
+        """ stores the operations of scripts as executed with state """
+        for (route, __, __), (backend, operations) in scripts.items():
+            log = backend.create_log(route.host)
+            log.state = state
+            log.save()
+            Operation.bulk_store(operations, log)
+    
+    def test_skip_unchanged(self):
+        scripts = self.generate()
+        self.assertEqual(1, len(scripts))
+        self.store(scripts, BackendLog.SUCCESS)
+        operations = list(scripts.values())[0][1]
+        applied = manager.get_applied_hashes(self.route, HashedBackend(), operations)
+        self.assertEqual({self.server.pk: operations[0].script_hash}, applied)
+        # Same script as the one already applied
+        self.assertEqual(0, len(self.generate()))
+        self.assertEqual(1, len(self.generate(force=True)))
+        settings.ORCHESTRATION_SKIP_UNCHANGED = False
+        self.assertEqual(1, len(self.generate()))
+        settings.ORCHESTRATION_SKIP_UNCHANGED = True
+        # Changed script
+        self.server.name = 'web1.example.com'
+        self.assertEqual(1, len(self.generate()))
+    
+    def test_execute_failed_again(self):
+        self.store(self.generate(), BackendLog.FAILURE)
+        self.assertEqual(1, len(self.generate()))
+        # Only the last execution counts
+        self.store(self.generate(), BackendLog.SUCCESS)
+        self.assertEqual(0, len(self.generate()))
+        self.store(self.generate(force=True), BackendLog.EXCEPTION)
+        self.assertEqual(1, len(self.generate()))
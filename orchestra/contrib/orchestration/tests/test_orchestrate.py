@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from orchestra.utils.tests import BaseTestCase
+
+from .. import manager
+from ..models import BackendLog, Route, Server
+from .test_manager import HashedBackend
+
+
+class OrchestrateTests(BaseTestCase):
+    def setUp(self):
+        self.servers = [ Server.objects.create(name='web%i.example.com' % ix) for ix in range(5) ]
+        Route.objects.create(backend=HashedBackend.get_name(), host=self.servers[0])
+        self.resume_file = os.path.join(tempfile.mkdtemp(), 'resume.json')
+        self.executed = []
+        self.failing = set()
+        self.execute = manager.execute
+        manager.execute = self.fake_execute
+    
+    def tearDown(self):
+        manager.execute = self.execute
+        shutil.rmtree(os.path.dirname(self.resume_file))
+    
+    def fake_execute(self, scripts, **kwargs):
+        """ records the executed servers, chunks listed on self.failing fail """
+        events = kwargs['events']
+        logs = []
+        for (route, __, __), (backend, operations) in scripts.items():
+            chunk = [ operation.instance.pk for operation in operations ]
+            self.executed.append(chunk)
+            log = backend.create_log(route.host)
+            log.state = BackendLog.FAILURE if len(self.executed) in self.failing else BackendLog.SUCCESS
+            log.save()
+            events.watch(log)
+            events.finished(log)
+            logs.append(log)
+        return logs
+    
+    def orchestrate(self, **options):
+        options.setdefault('resume_file', self.resume_file)
+        call_command('orchestrate', 'orchestration.Server', chunk_size=2, interactive=False,
+            stdout=StringIO(), **options)
+    
+    def get_resume(self):
+        with open(self.resume_file) as handler:
+            return json.load(handler)
+    
+    def test_chunks(self):
+        self.orchestrate()
+        pks = [ server.pk for server in self.servers ]
+        self.assertEqual([pks[:2], pks[2:4], pks[4:]], self.executed)
+        self.assertFalse(os.path.exists(self.resume_file))
+    
+    def test_resume(self):
+        pks = [ server.pk for server in self.servers ]
+        self.failing = {2}
+        with self.assertRaises(CommandError):
+            self.orchestrate()
+        # The chunk collected after the failing one is not executed
+        self.assertEqual([pks[:2], pks[2:4]], self.executed)
+        self.assertEqual({'orchestration.Server': pks[1]}, self.get_resume())
+        self.executed = []
+        self.failing = set()
+        self.orchestrate()
+        self.assertEqual([pks[2:4], pks[4:]], self.executed)
+        self.assertFalse(os.path.exists(self.resume_file))
+    
+    def test_dry_run(self):
+        pks = [ server.pk for server in self.servers ]
+        resume = {'orchestration.Server': pks[1]}
+        with open(self.resume_file, 'w') as handler:
+            json.dump(resume, handler)
+        self.orchestrate(dry=True)
+        self.assertEqual([], self.executed)
+        # Nothing has been executed, the progress is kept as it was
+        self.assertEqual(resume, self.get_resume())
@@ -0,0 +1,79 @@
+import threading
+
+from orchestra.utils.tests import BaseTestCase
+
+from ..pool import ExecutionPool, TaskGraph
+
+
+class PoolTests(BaseTestCase):
+    def setUp(self):
+        self.executed = []
+        self.lock = threading.Lock()
+    
+    def record(self, name, started=None, gate=None):
+        if started is not None:
+            started.set()
+            gate.wait(5)
+        with self.lock:
+            self.executed.append(name)
+    
+    def test_dependencies(self):
+        graph = TaskGraph(ExecutionPool(max_workers=4, max_per_host=4))
+        first = graph.add(self.record, 'a', 'first')
+        second = graph.add(self.record, 'b', 'second', after=[first])
+        independent = graph.add(self.record, 'c', 'independent')
+        third = graph.add(self.record, 'a', 'third', after=[first, second])
+        graph.start()
+        for task in (first, second, independent, third):
+            self.assertTrue(task.join(5))
+        self.assertEqual(4, len(self.executed))
+        self.assertLess(self.executed.index('first'), self.executed.index('second'))
+        self.assertLess(self.executed.index('second'), self.executed.index('third'))
+    
+    def test_failure_releases_dependents(self):
+        def fail():
+            raise ValueError("Backend failure")
+        
+        graph = TaskGraph(ExecutionPool(max_workers=2, max_per_host=2))
+        failing = graph.add(fail, 'a')
+        dependent = graph.add(self.record, 'a', 'dependent', after=[failing])
+        graph.start()
+        self.assertTrue(dependent.join(5))
+        self.assertTrue(failing.join(0))
+        self.assertEqual(['dependent'], self.executed)
+    
+    def test_host_fairness(self):
+        pool = ExecutionPool(max_workers=1, max_per_host=1)
+        started = threading.Event()
+        gate = threading.Event()
+        tasks = [pool.submit(self.record, 'a', 'a1', started=started, gate=gate)]
+        self.assertTrue(started.wait(5))
+        # Queued while the only worker is busy
+        for name in ('a2', 'a3', 'a4', 'b1', 'b2'):
+            tasks.append(pool.submit(self.record, name[0], name))
+        gate.set()
+        for task in tasks:
+            self.assertTrue(task.join(5))
+        # Hosts are served in turns, a large batch on one host does not delay the others
+        self.assertEqual(['a1', 'a2', 'b1', 'a3', 'b2', 'a4'], self.executed)
+    
+    def test_max_per_host(self):
+        pool = ExecutionPool(max_workers=4, max_per_host=1)
+        running = {}
+        concurrency = []
+        
+        def run(host):
+            with self.lock:
+                running[host] = running.get(host, 0) + 1
+                concurrency.append(running[host])
+            # Different hosts do run at the same time
+            barrier.wait(5)
+            with self.lock:
+                running[host] -= 1
+        
+        barrier = threading.Barrier(2)
+        tasks = [pool.submit(run, host, host) for host in ('a', 'a', 'b', 'b')]
+        for task in tasks:
+            self.assertTrue(task.join(5))
+        self.assertFalse(barrier.broken)
+        self.assertEqual([1, 1, 1, 1], concurrency)
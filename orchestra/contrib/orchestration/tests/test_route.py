@@ -1,3 +1,5 @@
+from django.utils import timezone
+
 from orchestra.utils.tests import BaseTestCase
 
 from .. import backends, Operation
@@ -39,3 +41,55 @@ class RouterTests(BaseTestCase):
         route = Route.objects.create(backend=backend, host=self.host2,
                 match='route.backend == "something else"')
         self.assertEqual(2, len(Route.objects.get_for_operation(operation)))
+    
+    def test_route_index_invalidation(self):
+        
+        class IndexTestBackend(backends.ServiceController):
+            verbose_name = 'Route index'
+            model = 'orchestration.Route'
+            
+            def save(self, instance):
+                pass
+        
+        choices = backends.ServiceBackend.get_choices()
+        Route._meta.get_field('backend')._choices = choices
+        backend = IndexTestBackend.get_name()
+        
+        route = Route.objects.create(backend=backend, host=self.host, match='True')
+        operation = Operation(backend=IndexTestBackend, instance=route, action='save')
+        self.assertEqual(1, len(Route.objects.get_for_operation(operation)))
+        
+        route.match = 'False'
+        route.save()
+        self.assertEqual(0, len(Route.objects.get_for_operation(operation)))
+        
+        route.match = 'True'
+        route.save()
+        route.disable()
+        self.assertEqual(0, len(Route.objects.get_for_operation(operation)))
+    
+    def test_route_index_changes_from_other_processes(self):
+        
+        class VersionTestBackend(backends.ServiceController):
+            verbose_name = 'Route version'
+            model = 'orchestration.Route'
+            
+            def save(self, instance):
+                pass
+        
+        choices = backends.ServiceBackend.get_choices()
+        Route._meta.get_field('backend')._choices = choices
+        backend = VersionTestBackend.get_name()
+        
+        route = Route.objects.create(backend=backend, host=self.host, match='True')
+        operation = Operation(backend=VersionTestBackend, instance=route, action='save')
+        self.assertEqual([route], Route.objects.get_for_operation(operation))
+        
+        # update() sends no signals, like changes made on other processes
+        Route.objects.filter(pk=route.pk).update(match='False', updated_at=timezone.now())
+        self.assertEqual([], Route.objects.get_for_operation(operation))
+        
+        Route.objects.filter(pk=route.pk).update(match='True', updated_at=timezone.now())
+        Server.objects.filter(pk=self.host.pk).update(address='10.0.0.1', updated_at=timezone.now())
+        routes = Route.objects.get_for_operation(operation)
+        self.assertEqual('10.0.0.1', routes[0].host.get_address())
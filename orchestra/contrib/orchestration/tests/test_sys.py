@@ -0,0 +1,64 @@
+import time
+
+from orchestra.utils.sys import LineBuffer, OutputBuffer, run
+from orchestra.utils.tests import BaseTestCase
+
+
+class SysTests(BaseTestCase):
+    """ orchestra.utils.sys, which runs the OpenSSH execution method """
+    def feed(self, *chunks):
+        lines = []
+        buffer = LineBuffer(lines.append)
+        for chunk in chunks:
+            buffer.feed(chunk)
+        return lines, buffer
+    
+    def test_line_buffer_split_lines(self):
+        lines, buffer = self.feed(b'fir', b'st\nsec', b'', b'ond\n')
+        self.assertEqual([b'first', b'second'], lines)
+        buffer.close()
+        self.assertEqual(2, buffer.lines)
+    
+    def test_line_buffer_crlf(self):
+        # Terminators split across chunks too
+        lines, buffer = self.feed('one\r\ntwo\r', '\nthree \r\n')
+        self.assertEqual(['one', 'two', 'three '], lines)
+    
+    def test_line_buffer_last_line(self):
+        lines, buffer = self.feed(b'one\nlast')
+        self.assertEqual([b'one'], lines)
+        buffer.close()
+        self.assertEqual([b'one', b'last'], lines)
+        self.assertEqual(2, buffer.lines)
+        buffer.close()
+        self.assertEqual(2, len(lines))
+    
+    def test_output_buffer_max_size(self):
+        buffer = OutputBuffer(max_size=4)
+        buffer.write(b'ab')
+        self.assertFalse(buffer.truncated)
+        buffer.write(b'cdef')
+        self.assertEqual(b'cdef', buffer.getvalue())
+        self.assertTrue(buffer.truncated)
+    
+    def test_run_max_buffer(self):
+        out = run("printf 'abcdefghij'; printf 'xyz' >&2", max_buffer=4)
+        self.assertEqual(b'ghij', out.stdout)
+        self.assertEqual(b'xyz', out.stderr)
+        self.assertTrue(out.truncated)
+        out = run("printf 'abcd'", max_buffer=4)
+        self.assertFalse(out.truncated)
+    
+    def test_run_line_callback(self):
+        lines = []
+        out = run("printf 'one\\r\\ntwo\\nthree'", line_callback=lines.append)
+        self.assertEqual([b'one', b'two', b'three'], lines)
+        self.assertEqual(b'one\r\ntwo\nthree', out.stdout)
+    
+    def test_run_background_child(self):
+        start = time.time()
+        # The background sleep inherits the pipes, like the ssh ControlMaster
+        out = run("sleep 10 & echo done")
+        self.assertEqual(b'done', out.stdout)
+        self.assertEqual(0, out.exit_code)
+        self.assertLess(time.time()-start, 5)
@@ -2,6 +2,8 @@ from django.utils.translation import ugettext_lazy as _
 
 from orchestra.contrib.bills.models import Invoice, Fee, ProForma
 
+from .engine import get_deferred_number
+
 
 class BillsBackend(object):
     def create_bills(self, account, lines, **options):
@@ -19,30 +21,30 @@ class BillsBackend(object):
             if proforma:
                 if ant_bill is None:
                     if create_new:
-                        bill = ProForma.objects.create(account=account)
+                        bill = self.create_bill(ProForma, account, options)
                     else:
                         bill = ProForma.objects.filter(account=account, is_open=True).last()
                         if bill:
                             bill.updated()
                         else:
-                            bill = ProForma.objects.create(account=account, is_open=True)
+                            bill = self.create_bill(ProForma, account, options, is_open=True)
                     bills.append(bill)
                 else:
                     bill = ant_bill
                 ant_bill = bill
             elif service.is_fee:
-                bill = Fee.objects.create(account=account)
+                bill = self.create_bill(Fee, account, options)
                 bills.append(bill)
             else:
                 if ant_bill is None:
                     if create_new:
-                        bill = Invoice.objects.create(account=account)
+                        bill = self.create_bill(Invoice, account, options)
                     else:
                         bill = Invoice.objects.filter(account=account, is_open=True).last()
                         if bill:
                             bill.updated()
                         else:
-                            bill = Invoice.objects.create(account=account, is_open=True)
+                            bill = self.create_bill(Invoice, account, options, is_open=True)
                     bills.append(bill)
                 else:
                     bill = ant_bill
@@ -64,6 +66,12 @@ class BillsBackend(object):
             self.create_sublines(billine, line.discounts)
         return bills
     
+    def create_bill(self, bill_class, account, options, **kwargs):
+        """ options.defer_numbers leaves the numbering to orders.engine.assign_numbers() """
+        if options.get('defer_numbers', False):
+            kwargs['number'] = get_deferred_number()
+        return bill_class.objects.create(account=account, **kwargs)
+    
 #    def format_period(self, ini, end):
 #        ini = ini.strftime("%b, %Y")
 #        end = (end-datetime.timedelta(seconds=1)).strftime("%b, %Y")
@@ -0,0 +1,144 @@
+import logging
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django import db
+from django.db import transaction
+from django.db.models import QuerySet
+
+from . import settings
+
+
+logger = logging.getLogger(__name__)
+
+# Bills created by the workers are numbered afterwards, see assign_numbers()
+DEFERRED_NUMBER_PREFIX = '~'
+
+
+class BillingError(Exception):
+    """ accounts that failed on parallel_bill(), the bills of the other accounts are kept """
+    def __init__(self, failures, bills):
+        self.failures = failures
+        self.bills = bills
+        accounts = ', '.join(str(account_id) for account_id in failures)
+        super(BillingError, self).__init__("Billing failed for accounts %s." % accounts)
+
+
+def get_deferred_number():
+    """ unique placeholder that Bill.get_number() does not take into account """
+    return DEFERRED_NUMBER_PREFIX + uuid.uuid4().hex[:15]
+
+
+def assign_numbers(bills):
+    """ numbers bills with placeholder numbers in order, as the sequential path does on creation """
+    with transaction.atomic():
+        for bill in bills:
+            number = bill.number
+            if number.startswith(DEFERRED_NUMBER_PREFIX):
+                bill.number = bill.get_number()
+                # Bills already numbered meanwhile, i.e. by assign_deferred_numbers(), are left alone
+                type(bill).objects.filter(pk=bill.pk, number=number).update(number=bill.number)
+
+
+def assign_deferred_numbers():
+    """ numbers the bills left with placeholder numbers by an interrupted parallel_bill() """
+    from orchestra.contrib.bills.models import Bill
+    bills = list(Bill.objects.filter(number__startswith=DEFERRED_NUMBER_PREFIX).order_by('id'))
+    assign_numbers(bills)
+    return bills
+
+
+def bill_accounts(accounts, options):
+    """
+    Worker side: bills each account on its own transaction
+    
+    accounts is a list of (account_id, order_ids), returns ({account_id: bills}, {account_id: error})
+    New bills get placeholder numbers, since concurrent workers can not number them in sequence
+    """
+    from .models import Order
+    results = {}
+    failures = {}
+    # Rates do not change during the run, accounts of the shard share their tables
+    rate_tables = {}
+    for account_id, order_ids in accounts:
+        try:
+            with transaction.atomic():
+                queryset = Order.objects.filter(id__in=order_ids).order_by('id')
+                results[account_id] = queryset.bill(workers=1, rate_tables=rate_tables,
+                    defer_numbers=True, **options)
+        except Exception:
+            # The other accounts of the shard are still billed
+            logger.exception("Error billing account %i" % account_id)
+            failures[account_id] = traceback.format_exc()
+    return results, failures
+
+
+def get_shards(queryset, num):
+    """ splits the accounts of queryset in num shards with a similar number of orders """
+    accounts = OrderedDict()
+    for order_id, account_id in queryset.order_by('id').values_list('id', 'account_id'):
+        accounts.setdefault(account_id, []).append(order_id)
+    shards = [ [] for ix in range(num) ]
+    sizes = [0] * num
+    # Largest accounts first on the lightest shard
+    for account_id, order_ids in sorted(accounts.items(), key=lambda a: -len(a[1])):
+        ix = sizes.index(min(sizes))
+        shards[ix].append((account_id, order_ids))
+        sizes[ix] += len(order_ids)
+    return list(accounts), [ shard for shard in shards if shard ]
+
+
+def get_executor(workers):
+    # Forked workers must not share the parent connections
+    db.connections.close_all()
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def parallel_bill(queryset, workers, progress=None, **options):
+    """
+    Bills the orders of queryset with a pool of worker processes, accounts are split in shards
+    and billed on per-account transactions, producing the same bills as the sequential path
+    
+    Bills are numbered once all workers are done, in the account order of the sequential path.
+    Bills left with placeholder numbers by an interrupted run are numbered by numberdeferredbills.
+    Accounts that fail do not stop the others, BillingError is raised at the end with them.
+    progress is called with (billed_accounts, total_accounts) as shards complete
+    """
+    # Querysets (i.e. related_queryset) are only meaningful to the caller
+    options = {
+        key: value for key, value in options.items() if not isinstance(value, QuerySet)
+    }
+    accounts, shards = get_shards(queryset, workers*settings.ORDERS_BILLING_SHARDS_PER_WORKER)
+    total = len(accounts)
+    results = {}
+    failures = {}
+    start = time.time()
+    commit = options.get('commit', True)
+    try:
+        with get_executor(workers) as executor:
+            futures = [ executor.submit(bill_accounts, shard, options) for shard in shards ]
+            for future in as_completed(futures):
+                shard_results, shard_failures = future.result()
+                results.update(shard_results)
+                failures.update(shard_failures)
+                logger.info("Billed %i of %i accounts in %.2f seconds" % (
+                    len(results)+len(failures), total, time.time()-start))
+                if progress:
+                    progress(len(results)+len(failures), total)
+    finally:
+        # Even when the pool breaks, the committed bills already returned are numbered
+        bills = []
+        for account_id in accounts:
+            account_bills = results.get(account_id, [])
+            if commit:
+                # Bills of an account in creation order
+                account_bills = sorted(set(account_bills), key=lambda bill: bill.pk)
+            bills += account_bills
+        if commit:
+            assign_numbers(bills)
+    if failures:
+        raise BillingError(failures, bills)
+    return bills
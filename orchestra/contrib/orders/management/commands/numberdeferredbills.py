@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from ...engine import assign_deferred_numbers
+
+
+class Command(BaseCommand):
+    help = 'Numbers the bills left with placeholder numbers by an interrupted parallel billing.'
+    
+    def handle(self, *args, **options):
+        for bill in assign_deferred_numbers():
+            self.stdout.write('%s %s' % (bill.account_id, bill.number))
@@ -0,0 +1,110 @@
+import bisect
+import datetime
+import decimal
+
+from django.conf import settings as djsettings
+from django.utils import timezone
+
+
+class MetricTimeline(object):
+    """
+    In-memory metric history of an order, answers the same questions as Order.get_metric()
+    by bisection instead of running one query per call
+    
+    rows are (id, value, created_on, updated_on) tuples of the order's MetricStorage
+    """
+    def __init__(self, order_id, rows, does_not_exist=LookupError):
+        self.order_id = order_id
+        self.does_not_exist = does_not_exist
+        # Changes are computed in id order, like the metrics query does
+        self.by_id = sorted(rows)
+        self.id_created = [row[2] for row in self.by_id]
+        self.chronological = all(a <= b for a, b in zip(self.id_created, self.id_created[1:]))
+        by_created = sorted(self.by_id, key=lambda row: row[2])
+        self.created = [row[2] for row in by_created]
+        # Latest by updated_on of every prefix of created
+        self.latest = []
+        latest = None
+        for row in by_created:
+            if latest is None or row[3] >= latest[3]:
+                latest = row
+            self.latest.append(latest)
+    
+    def __len__(self):
+        return len(self.by_id)
+    
+    def get_latest(self, index):
+        """ value latest updated among the first index rows by created_on """
+        if not index:
+            return decimal.Decimal(0)
+        return self.latest[index-1][1]
+    
+    def get_value(self, date):
+        """ value on effect on date """
+        date = datetime.date(year=date.year, month=date.month, day=date.day)
+        date += datetime.timedelta(days=1)
+        return self.get_latest(bisect.bisect_right(self.created, date))
+    
+    def get_slot_value(self, ini, end):
+        """ value latest updated among the ones created before end and updated since ini """
+        index = bisect.bisect_left(self.created, end)
+        if not index:
+            return decimal.Decimal(0)
+        __, value, __, updated_on = self.latest[index-1]
+        if updated_on >= self.as_datetime(updated_on, ini):
+            return value
+        return decimal.Decimal(0)
+    
+    def as_datetime(self, reference, date):
+        """ date as the database compares it against updated_on """
+        if isinstance(date, datetime.datetime):
+            return date
+        date = datetime.datetime(year=date.year, month=date.month, day=date.day)
+        if djsettings.USE_TZ and timezone.is_aware(reference):
+            date = timezone.make_aware(date, timezone.get_default_timezone())
+        return date
+    
+    def get_changes(self, ini, end):
+        """ [(ini, end, value)] of the value changes between ini and end """
+        if self.chronological:
+            stop = bisect.bisect_left(self.id_created, end)
+            # Older rows only matter as the value on effect on ini
+            start = max(min(bisect.bisect_right(self.id_created, ini), stop)-1, 0)
+            rows = self.by_id[start:stop]
+        else:
+            rows = [row for row in self.by_id if row[2] < end]
+        result = []
+        prev = None
+        for row in rows:
+            created = row[2]
+            if created > ini:
+                if prev is None:
+                    raise ValueError(
+                        "Metric storage information for order %i is inconsistent." % self.order_id)
+                cini = prev[2]
+                if not result:
+                    cini = ini
+                result.append((cini, created, prev[1]))
+            prev = row
+        if prev is None:
+            raise ValueError(
+                "Metric storage information for order %i is inconsistent." % self.order_id)
+        result.append((prev[2], end, prev[1]))
+        return result
+    
+    def get_metric(self, *args, **kwargs):
+        """ same interface as Order.get_metric() """
+        if kwargs.pop('changes', False):
+            return self.get_changes(*args)
+        if kwargs:
+            raise AttributeError
+        if len(args) == 2:
+            return self.get_slot_value(*args)
+        elif len(args) == 1:
+            return self.get_value(args[0])
+        elif not args:
+            if not self.latest:
+                raise self.does_not_exist(
+                    "Order %i has no metric storage information." % self.order_id)
+            return max(self.by_id, key=lambda row: row[3])[1]
+        raise AttributeError
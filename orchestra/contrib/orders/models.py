@@ -2,7 +2,7 @@ import datetime
 import decimal
 import logging
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models import F, Q, Sum
 from django.apps import apps
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -15,6 +15,7 @@ from orchestra.models import queryset
 from orchestra.utils.python import import_class
 
 from . import settings
+from .metrics import MetricTimeline
 
 
 logger = logging.getLogger(__name__)
@@ -24,6 +25,16 @@ class OrderQuerySet(models.QuerySet):
     group_by = queryset.group_by
     
     def bill(self, **options):
+        """
+        options.workers > 1 bills accounts in parallel worker processes, see engine.parallel_bill,
+        unless we are inside a transaction that the workers could not take part in
+        """
+        workers = options.pop('workers', None) or settings.ORDERS_BILLING_WORKERS
+        # Rate tables shared by the accounts of this run, see Service.get_rates()
+        rate_tables = options.pop('rate_tables', {})
+        if workers > 1 and not transaction.get_connection(self.db).in_atomic_block:
+            from .engine import parallel_bill
+            return parallel_bill(self, workers, **options)
         bills = []
         bill_backend = Order.get_bill_backend()
         qs = self.select_related('account', 'service')
@@ -35,7 +46,8 @@ class OrderQuerySet(models.QuerySet):
                     # Saved for undoing support
                     order.old_billed_on = order.billed_on
                     order.old_billed_until = order.billed_until
-                lines = service.handler.generate_bill_lines(orders, account, **options)
+                lines = service.handler.generate_bill_lines(orders, account,
+                    rate_tables=rate_tables, **options)
                 bill_lines.extend(lines)
             # TODO make this consistent always returning the same fucking types
             if commit:
@@ -105,7 +117,8 @@ class OrderQuerySet(models.QuerySet):
         """ return inactive orders """
         return self.filter(cancelled_on__lte=timezone.now(), **kwargs)
     
-    def update_by_instance(self, instance, service=None, commit=True):
+    def update_by_instance(self, instance, service=None, commit=True, matches=None):
+        """ matches: service.handler.matches(instance) as evaluated by the caller, with service """
         updates = []
         if service is None:
             Service = apps.get_model(settings.ORDERS_SERVICE_MODEL)
@@ -115,7 +128,11 @@ class OrderQuerySet(models.QuerySet):
         for service in services:
             orders = Order.objects.by_object(instance, service=service)
             orders = orders.select_related('service').active()
-            if service.handler.matches(instance):
+            if matches is None:
+                match = service.handler.matches(instance)
+            else:
+                match = matches
+            if match:
                 if not orders:
                     account_id = getattr(instance, 'account_id', instance.pk)
                     if account_id is None:
@@ -183,6 +200,20 @@ class Order(models.Model):
     def get_bill_backend(cls):
         return import_class(settings.ORDERS_BILLING_BACKEND)()
     
+    @classmethod
+    def prefetch_metrics(cls, orders):
+        """ loads the metric history of all orders with a single query, used by get_metric() """
+        timelines = MetricStorage.objects.get_timelines(orders)
+        for order in orders:
+            order.metric_timeline = timelines[order.pk]
+    
+    @classmethod
+    def clear_prefetched_metrics(cls, orders):
+        """ get_metric() queries the database again """
+        for order in orders:
+            if hasattr(order, 'metric_timeline'):
+                del order.metric_timeline
+    
     def clean(self):
         if self.billed_on and self.billed_on < self.registered_on:
             raise ValidationError(_("Billed date can not be earlier than registered on."))
@@ -231,6 +262,9 @@ class Order(models.Model):
         self.save(update_fields=['ignore'])
     
     def get_metric(self, *args, **kwargs):
+        timeline = getattr(self, 'metric_timeline', None)
+        if timeline is not None:
+            return timeline.get_metric(*args, **kwargs)
         if kwargs.pop('changes', False):
             ini, end = args
             result = []
@@ -271,6 +305,19 @@ class Order(models.Model):
 
 
 class MetricStorageQuerySet(models.QuerySet):
+    def get_timelines(self, orders):
+        """ {order.pk: MetricTimeline} of orders """
+        rows = {order.pk: [] for order in orders}
+        values = self.filter(order__in=list(rows)).values_list(
+            'order', 'id', 'value', 'created_on', 'updated_on')
+        for order_id, *row in values.iterator():
+            rows[order_id].append(tuple(row))
+        timelines = {}
+        for order_id, order_rows in rows.items():
+            timelines[order_id] = MetricTimeline(order_id, order_rows,
+                does_not_exist=self.model.DoesNotExist)
+        return timelines
+    
     def store(self, order, value):
         now = timezone.now()
         try:
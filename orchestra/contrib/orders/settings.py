@@ -44,3 +44,17 @@ ORDERS_BILLED_METRIC_CLEANUP_DAYS = Setting('ORDERS_BILLED_METRIC_CLEANUP_DAYS',
     40,
     help_text=("Number of days after a billed stored metric is deleted."),
 )
+
+
+ORDERS_BILLING_WORKERS = Setting('ORDERS_BILLING_WORKERS',
+    1,
+    help_text=("Number of processes used for billing orders outside of a transaction, "
+               "accounts are billed sequentially when 1."),
+)
+
+
+ORDERS_BILLING_SHARDS_PER_WORKER = Setting('ORDERS_BILLING_SHARDS_PER_WORKER',
+    4,
+    help_text=("Accounts are split in <tt>workers*shards_per_worker</tt> shards, "
+               "smaller shards balance better and report progress more often."),
+)
@@ -0,0 +1,161 @@
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+from dateutil.relativedelta import relativedelta
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils import timezone
+
+from orchestra.contrib.bills.models import Bill
+from orchestra.contrib.services.models import Service
+from orchestra.contrib.systemusers.models import SystemUser
+from orchestra.utils.tests import random_ascii, BaseTestCase
+
+from .. import engine
+from ..models import Order
+
+
+class SerialExecutor(object):
+    """ runs the shards on this process, worker processes can not see the test transaction """
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        pass
+    
+    def submit(self, func, *args):
+        future = Future()
+        future.set_result(func(*args))
+        return future
+
+
+class BrokenExecutor(SerialExecutor):
+    """ runs the first shard only, as if the pool broke afterwards """
+    def __init__(self):
+        self.submitted = 0
+    
+    def submit(self, func, *args):
+        self.submitted += 1
+        if self.submitted == 1:
+            return super(BrokenExecutor, self).submit(func, *args)
+        future = Future()
+        future.set_exception(BrokenProcessPool())
+        return future
+
+
+class EngineTests(BaseTestCase):
+    DEPENDENCIES = (
+        'orchestra.contrib.bills',
+        'orchestra.contrib.orders',
+        'orchestra.contrib.plans',
+        'orchestra.contrib.systemusers',
+    )
+    
+    def setUp(self):
+        self.get_executor = engine.get_executor
+        engine.get_executor = lambda workers: SerialExecutor()
+        self.service = Service.objects.create(
+            description="FTP Account",
+            content_type=ContentType.objects.get_for_model(SystemUser),
+            match='not systemuser.is_main',
+            billing_period=Service.ANUAL,
+            billing_point=Service.FIXED_DATE,
+            is_fee=False,
+            metric='',
+            pricing_period=Service.NEVER,
+            rate_algorithm='orchestra.contrib.plans.ratings.step_price',
+            on_cancel=Service.COMPENSATE,
+            payment_style=Service.PREPAY,
+            tax=0,
+            nominal_price=10,
+        )
+        # Accounts with 3, 2 and 1 orders
+        self.accounts = []
+        for num in (3, 2, 1):
+            account = self.create_account()
+            for ix in range(num):
+                SystemUser.objects.create_user('%s_ftp' % random_ascii(10), account=account)
+            self.accounts.append(account)
+        self.billing_point = timezone.now().date() + relativedelta(years=1)
+    
+    def tearDown(self):
+        engine.get_executor = self.get_executor
+    
+    def get_orders(self):
+        return Order.objects.filter(service=self.service)
+    
+    def get_bills(self, bills):
+        return [
+            (bill.account_id, bill.number, bill.is_open, bill.get_total()) for bill in bills
+        ]
+    
+    def test_get_shards(self):
+        accounts, shards = engine.get_shards(self.get_orders(), 2)
+        self.assertEqual([account.pk for account in self.accounts], accounts)
+        self.assertEqual([
+                [self.accounts[0].pk],
+                [self.accounts[1].pk, self.accounts[2].pk],
+            ], [[account_id for account_id, __ in shard] for shard in shards]
+        )
+        order_ids = [order_id for shard in shards for __, ids in shard for order_id in ids]
+        self.assertEqual(sorted(self.get_orders().values_list('id', flat=True)), sorted(order_ids))
+        # Empty shards are left out
+        accounts, shards = engine.get_shards(self.get_orders(), 5)
+        self.assertEqual(3, len(shards))
+    
+    def test_parallel_bill(self):
+        options = {
+            'billing_point': self.billing_point,
+            'fixed_point': True,
+        }
+        with transaction.atomic():
+            # Accounts in the order of their first order, like get_shards()
+            bills = self.get_orders().order_by('id').bill(workers=1, **options)
+            sequential = self.get_bills(sorted(bills, key=lambda bill: bill.number))
+            transaction.set_rollback(True)
+        progress = []
+        bills = engine.parallel_bill(self.get_orders(), 2,
+            progress=lambda *args: progress.append(args), **options)
+        self.assertEqual(sequential, self.get_bills(bills))
+        self.assertEqual(3, len(bills))
+        self.assertEqual(3, len(set(bill.number for bill in bills)))
+        self.assertFalse(Bill.objects.filter(number__startswith=engine.DEFERRED_NUMBER_PREFIX))
+        self.assertEqual((3, 3), progress[-1])
+    
+    def test_bill_accounts_failures(self):
+        account = self.accounts[2]
+        order_ids = list(account.orders.values_list('id', flat=True))
+        # Invalid order ids
+        results, failures = engine.bill_accounts(
+            [(0, ['invalid']), (account.pk, order_ids)],
+            {'billing_point': self.billing_point, 'fixed_point': True}
+        )
+        self.assertEqual([0], list(failures))
+        self.assertEqual([account.pk], list(results))
+        bill = results[account.pk][0]
+        self.assertTrue(bill.number.startswith(engine.DEFERRED_NUMBER_PREFIX))
+        engine.assign_numbers([bill])
+        self.assertFalse(bill.number.startswith(engine.DEFERRED_NUMBER_PREFIX))
+        self.assertEqual(bill.number, Bill.objects.get(pk=bill.pk).number)
+    
+    def test_parallel_bill_broken_pool(self):
+        engine.get_executor = lambda workers: BrokenExecutor()
+        with self.assertRaises(BrokenProcessPool):
+            engine.parallel_bill(self.get_orders(), 2, billing_point=self.billing_point,
+                fixed_point=True)
+        # The bills of the shard that completed are numbered anyway
+        self.assertEqual(1, Bill.objects.count())
+        self.assertFalse(Bill.objects.filter(number__startswith=engine.DEFERRED_NUMBER_PREFIX))
+    
+    def test_assign_deferred_numbers(self):
+        account = self.accounts[0]
+        order_ids = list(account.orders.values_list('id', flat=True))
+        # As left by an interrupted run
+        results, failures = engine.bill_accounts(
+            [(account.pk, order_ids)],
+            {'billing_point': self.billing_point, 'fixed_point': True}
+        )
+        bill = results[account.pk][0]
+        self.assertEqual([bill], engine.assign_deferred_numbers())
+        self.assertFalse(Bill.objects.filter(number__startswith=engine.DEFERRED_NUMBER_PREFIX))
+        self.assertEqual([], engine.assign_deferred_numbers())
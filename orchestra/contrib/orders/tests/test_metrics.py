@@ -0,0 +1,122 @@
+import datetime
+import decimal
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from orchestra.contrib.accounts.models import Account
+from orchestra.contrib.services.models import Service
+from orchestra.utils.tests import BaseTestCase
+
+from ..metrics import MetricTimeline
+from ..models import MetricStorage, Order
+
+
+class MetricTimelineTests(BaseTestCase):
+    DEPENDENCIES = (
+        'orchestra.contrib.orders',
+        'orchestra.contrib.plans',
+    )
+    
+    def setUp(self):
+        self.service = Service.objects.create(
+            description="Traffic",
+            content_type=ContentType.objects.get_for_model(Account),
+            match='True',
+            billing_period=Service.MONTHLY,
+            billing_point=Service.FIXED_DATE,
+            is_fee=False,
+            metric='0',
+            pricing_period=Service.NEVER,
+            rate_algorithm='orchestra.contrib.plans.ratings.step_price',
+            on_cancel=Service.NOTHING,
+            payment_style=Service.POSTPAY,
+            tax=0,
+            nominal_price=10,
+        )
+        self.account = self.create_account()
+        self.ini = datetime.date(2016, 1, 1)
+        self.now = timezone.now().replace(year=2016, month=1, day=1, hour=12)
+    
+    def create_order(self, metrics):
+        """ metrics are (created_on, value, updated_on) tuples, dates as days since ini """
+        order = Order.objects.create(account=self.account, service=self.service,
+            content_type=ContentType.objects.get_for_model(Account), object_id=self.account.pk)
+        for created_on, value, updated_on in metrics:
+            metric = MetricStorage.objects.create(order=order, value=value,
+                updated_on=self.now+datetime.timedelta(days=updated_on))
+            # created_on is auto_now_add
+            MetricStorage.objects.filter(pk=metric.pk).update(
+                created_on=self.ini+datetime.timedelta(days=created_on))
+        return order
+    
+    def get_metric(self, order, *args, **kwargs):
+        try:
+            return order.get_metric(*args, **kwargs)
+        except Exception as exc:
+            return type(exc)
+    
+    def assertSameMetrics(self, order):
+        """ the timeline gives the same answers as the queries of Order.get_metric() """
+        order = Order.objects.get(pk=order.pk)
+        timeline = MetricStorage.objects.get_timelines([order])[order.pk]
+        self.assertIsInstance(timeline, MetricTimeline)
+        dates = [self.ini+datetime.timedelta(days=day) for day in range(-1, 16)]
+        calls = [((), {})]
+        calls += [((date,), {}) for date in dates]
+        for ini in dates:
+            for end in dates:
+                if ini < end:
+                    calls.append(((ini, end), {}))
+                    calls.append(((ini, end), {'changes': True}))
+        for args, kwargs in calls:
+            # get_metric() pops changes from kwargs
+            expected = self.get_metric(order, *args, **dict(kwargs))
+            if isinstance(expected, type):
+                # Both fail on inconsistent metric storage
+                with self.assertRaises(Exception):
+                    timeline.get_metric(*args, **dict(kwargs))
+            else:
+                self.assertEqual(expected, timeline.get_metric(*args, **dict(kwargs)), (args, kwargs))
+    
+    def test_chronological(self):
+        order = self.create_order([
+            (0, 10, 0),
+            (3, 20, 4),
+            (3, 25, 5),
+            (7, 5, 7),
+            (12, 40, 14),
+        ])
+        self.assertSameMetrics(order)
+    
+    def test_not_chronological(self):
+        order = self.create_order([
+            (2, 10, 3),
+            (0, 15, 1),
+            (9, 30, 12),
+            (5, 20, 5),
+        ])
+        self.assertSameMetrics(order)
+    
+    def test_empty(self):
+        order = self.create_order([])
+        timeline = MetricStorage.objects.get_timelines([order])[order.pk]
+        self.assertEqual(decimal.Decimal(0), timeline.get_metric(self.ini))
+        with self.assertRaises(MetricStorage.DoesNotExist):
+            timeline.get_metric()
+    
+    def test_prefetch_metrics(self):
+        order = self.create_order([(0, 10, 0)])
+        Order.prefetch_metrics([order])
+        self.assertIsInstance(order.metric_timeline, MetricTimeline)
+        MetricStorage.objects.filter(order=order).update(value=20)
+        self.assertEqual(10, order.get_metric())
+        # Billing does not leave stale metrics behind
+        Order.clear_prefetched_metrics([order])
+        self.assertFalse(hasattr(order, 'metric_timeline'))
+        self.assertEqual(20, order.get_metric())
+    
+    def test_generate_bill_lines(self):
+        order = self.create_order([(0, 10, 0)])
+        self.service.handler.generate_bill_lines([order], self.account, commit=False)
+        self.assertFalse(hasattr(order, 'metric_timeline'))
@@ -1,12 +1,21 @@
 import datetime
+import decimal
+import logging
+import os
+import textwrap
 
 from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 
 from orchestra.contrib.orchestration import ServiceBackend
+from orchestra.utils.python import format_exception
+from orchestra.utils.sys import LineBuffer
 
-from . import helpers
+from . import helpers, settings
+
+
+logger = logging.getLogger(__name__)
 
 
 class ServiceMonitor(ServiceBackend):
@@ -42,20 +51,129 @@ class ServiceMonitor(ServiceBackend):
         model = model.lower()
         return ContentType.objects.get_by_natural_key(app_label, model)
     
+    def prefetch(self, instances):
+        super(ServiceMonitor, self).prefetch(instances)
+        self.last_data = self.get_last_data_in_bulk([instance.pk for instance in instances])
+    
+    def get_last_data_in_bulk(self, object_ids):
+        """ {object_id: last MonitorData or None} using one grouped query per batch """
+        from django.db.models import Max
+        from .models import MonitorData
+        last_data = {object_id: None for object_id in object_ids}
+        object_ids = list(last_data)
+        batch_size = settings.RESOURCES_MONITOR_DATA_BATCH_SIZE
+        for ix in range(0, len(object_ids), batch_size):
+            last_ids = MonitorData.objects.filter(content_type=self.content_type,
+                monitor=self.get_name(), object_id__in=object_ids[ix:ix+batch_size]
+            ).values('object_id').annotate(last_id=Max('id')).values_list('last_id', flat=True)
+            for data in MonitorData.objects.filter(id__in=list(last_ids)):
+                last_data[data.object_id] = data
+        return last_data
+    
     def get_last_data(self, object_id):
         from .models import MonitorData
+        try:
+            # Prefetched for the whole execution
+            return self.last_data[int(object_id)]
+        except (AttributeError, KeyError):
+            pass
         try:
             return MonitorData.objects.filter(content_type=self.content_type,
                 monitor=self.get_name(), object_id=object_id).latest()
         except MonitorData.DoesNotExist:
             return None
-        
+    
     def get_last_date(self, object_id):
         data = self.get_last_data(object_id)
         if data is None:
             return self.current_date - datetime.timedelta(days=1)
         return data.created_at
     
+    def get_log_cursor_path(self, log_path):
+        """ remote file tracking how far log_path has been parsed by this monitor """
+        cursor_dir = settings.RESOURCES_MONITOR_LOG_CURSOR_DIR
+        if not cursor_dir:
+            return None
+        name = '.'.join((self.get_name(), log_path.strip('/').replace('/', '_')))
+        return os.path.join(cursor_dir, name)
+    
+    def append_log_reader(self):
+        """
+        Defines read_logs(logs, cursor_path, ini_date, end_date, get_date) on Python monitor scripts
+        
+        It yields (date, line) for the lines of (current_log, rotated_log) dated between ini_date
+        and end_date. When a cursor_path is given, parsing resumes from the inode and byte offset
+        where the previous run ended, as long as that run covered ini_date, and the cursor is
+        moved forward; thus only newly appended bytes are parsed. Rotated or truncated logs
+        are detected by inode and size, falling back to reading them from the beginning.
+        """
+        self.append(textwrap.dedent("""\
+            import json
+            import os
+            import sys
+            
+            def read_logs(logs, cursor_path, ini_date, end_date, get_date):
+                log, rotated = logs
+                sources = [(rotated, 0), (log, 0)]
+                cursor = None
+                if cursor_path:
+                    try:
+                        with open(cursor_path) as handler:
+                            cursor = json.load(handler)
+                    except (IOError, ValueError):
+                        pass
+                if cursor and cursor['date'] <= ini_date:
+                    for ix, (path, offset) in enumerate(sources):
+                        try:
+                            inode = os.stat(path).st_ino
+                        except OSError:
+                            continue
+                        if inode == cursor['inode']:
+                            sources = [(path, cursor['offset'])] + sources[ix+1:]
+                            break
+                next_cursor = None
+                for path, offset in sources:
+                    try:
+                        handler = open(path, 'rb')
+                    except IOError as e:
+                        sys.stderr.write(str(e)+'\\n')
+                        continue
+                    with handler:
+                        stat = os.fstat(handler.fileno())
+                        if offset > stat.st_size:
+                            # Truncated
+                            offset = 0
+                        handler.seek(offset)
+                        position = offset
+                        ended = False
+                        for line in handler:
+                            size = len(line)
+                            if not isinstance(line, str):
+                                line = line.decode('utf8', 'replace')
+                            date = get_date(line)
+                            if date is not None and date >= end_date:
+                                # Next run starts from here
+                                ended = True
+                            elif not ended:
+                                position += size
+                            if date is not None and ini_date < date < end_date:
+                                yield date, line
+                    if path == log:
+                        next_cursor = {
+                            'inode': stat.st_ino,
+                            'offset': position,
+                            'date': end_date,
+                        }
+                if cursor_path and next_cursor:
+                    cursor_dir = os.path.dirname(cursor_path)
+                    if not os.path.isdir(cursor_dir):
+                        os.makedirs(cursor_dir)
+                    with open(cursor_path + '.tmp', 'w') as handler:
+                        json.dump(next_cursor, handler)
+                    os.rename(cursor_path + '.tmp', cursor_path)
+            """)
+        )
+    
     def process(self, line):
         """ line -> object_id, value, state"""
         result = line.split()
@@ -66,29 +184,90 @@ class ServiceMonitor(ServiceBackend):
         result.append(None)
         return result
     
-    def store(self, log):
-        """ stores monitored values from stdout """
-        from django.contrib.contenttypes.models import ContentType
-        from .models import MonitorData
-        name = self.get_name()
-        app_label, model_name = self.model.split('.')
-        ct = ContentType.objects.get_by_natural_key(app_label, model_name.lower())
-        for line in log.stdout.splitlines():
-            line = line.strip()
+    def parse_line(self, num, line, records, errors):
+        """ appends the (num, object_id, value, state) record of line to records, or to errors """
+        line = line.strip()
+        if not line:
+            return
+        try:
             object_id, value, state = self.process(line)
             if isinstance(value, bytes):
                 value = value.decode('ascii')
             if isinstance(state, bytes):
                 state = state.decode('ascii')
-            content_object = ct.get_object_for_this_type(pk=object_id)
-            MonitorData.objects.create(
+            # Validate now, a single invalid value would abort the whole bulk insert
+            object_id = int(object_id)
+            value = decimal.Decimal(value)
+            if state is not None:
+                state = decimal.Decimal(state)
+        except (ValueError, TypeError, decimal.InvalidOperation) as exc:
+            errors.append("Line %i: %s" % (num, format_exception(exc)))
+            return
+        records.append((num, object_id, value, state))
+    
+    def store(self, log, records=None, errors=None):
+        """
+        stores monitored values from stdout
+        
+        records and errors are provided when the output has been parsed while it arrived,
+        otherwise log.stdout is parsed.
+        Object representations are fetched in bulk and values inserted in batches,
+        lines that can not be processed are reported on log.stderr without aborting the rest.
+        """
+        from .models import MonitorData
+        name = self.get_name()
+        ct = self.content_type
+        if records is None:
+            records = []
+            errors = []
+            for num, line in enumerate(log.stdout.splitlines(), 1):
+                self.parse_line(num, line, records, errors)
+        reprs = {}
+        ids = list(set(record[1] for record in records))
+        batch_size = settings.RESOURCES_MONITOR_DATA_BATCH_SIZE
+        manager = ct.model_class()._base_manager
+        for ix in range(0, len(ids), batch_size):
+            for pk, obj in manager.in_bulk(ids[ix:ix+batch_size]).items():
+                reprs[pk] = str(obj)[:256]
+        objs = []
+        for num, object_id, value, state in records:
+            try:
+                content_object_repr = reprs[object_id]
+            except KeyError:
+                errors.append("Line %i: %s with id %i does not exist" % (num, self.model, object_id))
+                continue
+            objs.append(MonitorData(
                 monitor=name, object_id=object_id, content_type=ct, value=value, state=state,
-                created_at=self.current_date, content_object_repr=str(content_object),
-            )
+                created_at=self.current_date, content_object_repr=content_object_repr,
+            ))
+        MonitorData.objects.bulk_create(objs, batch_size=batch_size)
+        if errors:
+            errors = '\n'.join(errors)
+            logger.error("%s monitored data errors:\n%s" % (name, errors))
+            log.stderr += '\n' + errors if log.stderr else errors
+            log.save(update_fields=('stderr', 'updated_at'))
+        return objs
     
-    def execute(self, *args, **kwargs):
-        log = super(ServiceMonitor, self).execute(*args, **kwargs)
-        self.store(log)
+    def execute(self, server, async=False, log=None):
+        if log is None:
+            log = self.create_log(server)
+        # Parse lines as they arrive, instead of splitting the whole output at the end
+        records = []
+        errors = []
+        lines = LineBuffer(lambda line: self.parse_line(lines.lines, line, records, errors))
+        
+        def parse(log, stream, content):
+            if stream == log.STDOUT:
+                lines.feed(content)
+        
+        log.writer.listeners.append(parse)
+        log = super(ServiceMonitor, self).execute(server, async=async, log=log)
+        lines.close()
+        if lines.lines:
+            self.store(log, records, errors)
+        else:
+            # Output not streamed through log.writer, i.e. synchronous executions
+            self.store(log)
         return log
     
     @classmethod
@@ -4,3 +4,17 @@ from orchestra.contrib.settings import Setting
 RESOURCES_OLD_MONITOR_DATA_DAYS = Setting('RESOURCES_OLD_MONITOR_DATA_DAYS',
     40,
 )
+
+
+RESOURCES_MONITOR_DATA_BATCH_SIZE = Setting('RESOURCES_MONITOR_DATA_BATCH_SIZE',
+    1000,
+    help_text="Number of monitored values fetched and stored per database query."
+)
+
+
+RESOURCES_MONITOR_LOG_CURSOR_DIR = Setting('RESOURCES_MONITOR_LOG_CURSOR_DIR',
+    '/dev/shm/orchestra-monitors',
+    help_text=("Remote directory where traffic monitors keep how far each log has been parsed, "
+               "so only new log lines are parsed on each run.<br>"
+               "Leave it empty for parsing the whole logs every time.")
+)
@@ -30,7 +30,9 @@ class ApacheTrafficByHost(ServiceMonitor):
             'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
             'ignore_hosts': str(settings.SAAS_TRAFFIC_IGNORE_HOSTS),
             'include_received_bytes': str(self.include_received_bytes),
+            'cursor_path': repr(self.get_log_cursor_path(access_log)),
         }
+        self.append_log_reader()
         self.append(textwrap.dedent("""\
             import sys
             from datetime import datetime
@@ -46,6 +48,7 @@ class ApacheTrafficByHost(ServiceMonitor):
             end_date = to_local_timezone('{current_date}')
             end_date = int(end_date.strftime('%Y%m%d%H%M%S'))
             access_logs = {access_logs}
+            cursor_path = {cursor_path}
             sites = {{}}
             months = {{
                 'Jan': '01',
@@ -68,33 +71,37 @@ class ApacheTrafficByHost(ServiceMonitor):
                 ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
                 sites[site_domain] = [ini_date, object_id, 0]
             
-            def monitor(sites, end_date, months, access_logs):
+            def get_date(line):
+                try:
+                    # [16/Sep/2015:11:40:38
+                    date = line.split()[3]
+                    day, month, date = date[1:].split('/')
+                    year, hour, min, sec = date.split(':')
+                    return int(year + months[month] + day + hour + min + sec)
+                except (ValueError, KeyError, IndexError):
+                    return None
+            
+            def monitor(sites, end_date, months, access_logs, cursor_path):
                 include_received = {include_received_bytes}
-                for access_log in access_logs:
-                    try:
-                        with open(access_log, 'r') as handler:
-                            for line in handler.readlines():
-                                line = line.split()
-                                host, __, __, date = line[:4]
-                                if host in {ignore_hosts}:
-                                    continue
-                                size, hostname = line[-2:]
-                                size = int(size)
-                                if include_received:
-                                    size += int(line[-3])
-                                try:
-                                    site = sites[hostname]
-                                except KeyError:
-                                    continue
-                                else:
-                                    # [16/Sep/2015:11:40:38
-                                    day, month, date = date[1:].split('/')
-                                    year, hour, min, sec = date.split(':')
-                                    date = year + months[month] + day + hour + min + sec
-                                    if site[0] < int(date) < end_date:
-                                        site[2] += size
-                    except IOError as e:
-                        sys.stderr.write(str(e)+'\\n')
+                if sites:
+                    # Single pass over the new lines for all sites
+                    ini_date = min(site[0] for site in sites.values())
+                    for date, line in read_logs(access_logs, cursor_path, ini_date, end_date, get_date):
+                        line = line.split()
+                        host = line[0]
+                        if host in {ignore_hosts}:
+                            continue
+                        size, hostname = line[-2:]
+                        size = int(size)
+                        if include_received:
+                            size += int(line[-3])
+                        try:
+                            site = sites[hostname]
+                        except KeyError:
+                            continue
+                        else:
+                            if site[0] < date:
+                                site[2] += size
                 for opts in sites.values():
                     ini_date, object_id, size = opts
                     sys.stdout.write('%s %s\\n' % (object_id, size))
@@ -106,7 +113,7 @@ class ApacheTrafficByHost(ServiceMonitor):
         self.append("prepare(%(object_id)s, '%(site_domain)s', '%(last_date)s')" % context)
     
     def commit(self):
-        self.append('monitor(sites, end_date, months, access_logs)')
+        self.append('monitor(sites, end_date, months, access_logs, cursor_path)')
     
     def get_context(self, saas):
         return {
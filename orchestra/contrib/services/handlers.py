@@ -2,12 +2,14 @@ import calendar
 import datetime
 import decimal
 import math
-from functools import cmp_to_key
+from functools import cmp_to_key, lru_cache
 
 from dateutil import relativedelta
+from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.utils import timezone, translation
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext, ugettext_lazy as _
 
 from orchestra import plugins
@@ -17,6 +19,12 @@ from orchestra.utils.python import AttrDict, format_exception
 from . import settings, helpers
 
 
+@lru_cache(maxsize=256)
+def compile_expression(expression):
+    """ code objects are cached by source, thus compiled once per service revision """
+    return compile(expression, '<service expression>', 'eval')
+
+
 class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
     """
     Separates all the logic of billing handling from the model allowing to better
@@ -44,7 +52,12 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
     def validate_content_type(self, service):
         pass
     
-    def validate_expression(self, service, method):
+    def validate_expression(self, service, method, expression=None):
+        if expression:
+            try:
+                compile_expression(expression)
+            except SyntaxError as exc:
+                raise ValidationError(format_exception(exc))
         try:
             obj = service.content_type.model_class().objects.all()[0]
         except IndexError:
@@ -57,13 +70,13 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
     def validate_match(self, service):
         if not service.match:
             service.match = 'True'
-        self.validate_expression(service, 'matches')
+        self.validate_expression(service, 'matches', service.match)
     
     def validate_metric(self, service):
-        self.validate_expression(service, 'get_metric')
+        self.validate_expression(service, 'get_metric', service.metric)
     
     def validate_order_description(self, service):
-        self.validate_expression(service, 'get_order_description')
+        self.validate_expression(service, 'get_order_description', service.order_description)
     
     def get_content_type(self):
         if not self.model:
@@ -71,14 +84,13 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
         app_label, model = self.model.split('.')
         return ContentType.objects.get_by_natural_key(app_label, model.lower())
     
-    def get_expression_context(self, instance):
+    @cached_property
+    def expression_context(self):
+        """ instance independent part of the expression context, built once per handler """
         return {
-            'instance': instance,
-            'obj': instance,
             'ugettext': ugettext,
             'handler': self,
             'service': self.service,
-            instance._meta.model_name: instance,
             'math': math,
             'logsteps': lambda n, size=1: \
                 round(n/(decimal.Decimal(size*10**int(math.log10(max(n, 1))))))*size*10**int(math.log10(max(n, 1))),
@@ -86,12 +98,33 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
             'Decimal': decimal.Decimal,
         }
     
+    def get_expression_context(self, instance, context=None):
+        """ updates context, a copy of expression_context by default, with instance """
+        if context is None:
+            context = dict(self.expression_context)
+        context.update({
+            'instance': instance,
+            'obj': instance,
+            instance._meta.model_name: instance,
+        })
+        return context
+    
+    def evaluate(self, expression, instances):
+        """
+        Batch evaluation: yields the result of expression for each instance,
+        compiling it once and reusing a single context
+        """
+        code = compile_expression(expression)
+        context = dict(self.expression_context)
+        for instance in instances:
+            yield eval(code, self.get_expression_context(instance, context))
+    
     def matches(self, instance):
         if not self.match:
             # Blank expressions always evaluate True
             return True
         safe_locals = self.get_expression_context(instance)
-        return eval(self.match, safe_locals)
+        return eval(compile_expression(self.match), safe_locals)
     
     def get_ignore_delta(self):
         if self.ignore_period == self.NEVER:
@@ -125,7 +158,7 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
         if self.metric:
             safe_locals = self.get_expression_context(instance)
             try:
-                return eval(self.metric, safe_locals)
+                return eval(compile_expression(self.metric), safe_locals)
             except Exception as exc:
                 raise type(exc)("'%s' evaluating metric for '%s' service" % (exc, self.service))
     
@@ -135,7 +168,7 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
         with translation.override(account.language):
             if not self.order_description:
                 return '%s: %s' % (ugettext(self.description), instance)
-            return eval(self.order_description, safe_locals)
+            return eval(compile_expression(self.order_description), safe_locals)
     
     def get_billing_point(self, order, bp=None, **options):
         cachable = bool(self.billing_point == self.FIXED_DATE and not options.get('fixed_point'))
@@ -363,7 +396,9 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
             size = self.get_price_size(ini, end)
             metric = len(orders)
             interval = helpers.Interval(ini=ini, end=end)
-            for position, order in enumerate(orders, start=1):
+            positions = range(1, metric+1)
+            prices = self.get_prices(account, [metric]*metric, positions=positions, rates=rates)
+            for order, price in zip(orders, prices):
                 csize = 0
                 compensations = getattr(order, '_compensations', [])
                 # Compensations < new_billed_until
@@ -371,7 +406,6 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
                     intersect = comp.intersect(interval)
                     if intersect:
                         csize += self.get_price_size(intersect.ini, intersect.end)
-                price = self.get_price(account, metric, position=position, rates=rates)
                 cprice = price * csize
                 price = price * size
                 if order in priced:
@@ -467,7 +501,7 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
             givers = sorted(givers, key=cmp_to_key(helpers.cmp_billed_until_or_registered_on))
             orders = sorted(orders, key=cmp_to_key(helpers.cmp_billed_until_or_registered_on))
             self.assign_compensations(givers, orders, **options)
-        rates = self.get_rates(account)
+        rates = self.get_rates(account, tables=options.get('rate_tables'))
         has_billing_period = self.billing_period != self.NEVER
         has_pricing_period = self.get_pricing_period() != self.NEVER
         if rates and (has_billing_period or has_pricing_period):
@@ -508,6 +542,7 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
     def bill_with_metric(self, orders, account, **options):
         lines = []
         bp = None
+        rates = self.get_rates(account, tables=options.get('rate_tables'))
         for order in orders:
             prepay_discount = 0
             bp = self.get_billing_point(order, bp=bp, **options)
@@ -525,11 +560,11 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
                         if bmetric is None:
                             bmetric = order.get_metric(order.billed_on)
                         bsize = self.get_price_size(rini, order.billed_until)
-                        prepay_discount = self.get_price(account, bmetric) * bsize
+                        prepay_discount = self.get_price(account, bmetric, rates=rates) * bsize
                         prepay_discount = round(prepay_discount, 2)
                         for cini, cend, metric in order.get_metric(rini, rend, changes=True):
                             size = self.get_price_size(cini, cend)
-                            price = self.get_price(account, metric) * size
+                            price = self.get_price(account, metric, rates=rates) * size
                             discounts = ()
                             discount = min(price, max(prepay_discount, 0))
                             prepay_discount -= price
@@ -565,7 +600,7 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
                     # Changes (Mailbox disk-like)
                     for cini, cend, metric in order.get_metric(ini, bp, changes=True):
                         cini = max(recharged_until, cini)
-                        price = self.get_price(account, metric)
+                        price = self.get_price(account, metric, rates=rates)
                         discounts = ()
                         # Since the current datamodel can't guarantee to retrieve the exact
                         # state for calculating prepay_discount (service price could have change)
@@ -588,7 +623,7 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
                             "Metric with prepay and pricing_period == billing_period")
                     for cini, cend in self.get_pricing_slots(ini, bp):
                         metric = order.get_metric(cini, cend)
-                        price = self.get_price(account, metric)
+                        price = self.get_price(account, metric, rates=rates)
                         discounts = ()
 #                        discount = min(price, max(prepay_discount, 0))
 #                        if discount > 0:
@@ -606,7 +641,7 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
                         # Traffic Prepay
                         metric = order.get_metric(timezone.now().date())
                         if metric > 0:
-                            price = self.get_price(account, metric)
+                            price = self.get_price(account, metric, rates=rates)
                             for cini, cend in self.get_pricing_slots(ini, bp):
                                 line = self.generate_line(order, price, cini, cend, metric=metric)
                                 lines.append(line)
@@ -624,7 +659,7 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
                 if self.get_pricing_period() == self.NEVER:
                     # get metric (Job-like)
                     metric = order.get_metric(date)
-                    price = self.get_price(account, metric)
+                    price = self.get_price(account, metric, rates=rates)
                     line = self.generate_line(order, price, date, metric=metric)
                     lines.append(line)
                 else:
@@ -639,7 +674,14 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
         if not self.metric:
             lines = self.bill_with_orders(orders, account, **options)
         else:
-            lines = self.bill_with_metric(orders, account, **options)
+            # Metric history of all the orders with a single query
+            order_model = apps.get_model(settings.SERVICES_ORDER_MODEL)
+            order_model.prefetch_metrics(orders)
+            try:
+                lines = self.bill_with_metric(orders, account, **options)
+            finally:
+                # Orders outlive billing, their metrics would become stale
+                order_model.clear_prefetched_metrics(orders)
         if options.get('commit', True):
             now = timezone.now().date()
             for line in lines:
@@ -1,24 +1,42 @@
-def get_chunks(porders, ini, end, ix=0):
-    if ix >= len(porders):
-        return [[ini, end, []]]
-    order = porders[ix]
-    ix += 1
-    bu = getattr(order, 'new_billed_until', order.billed_until)
-    if not bu or bu <= ini or order.registered_on >= end:
-        return get_chunks(porders, ini, end, ix=ix)
-    result = []
-    if order.registered_on < end and order.registered_on > ini:
-        ro = order.registered_on
-        result = get_chunks(porders, ini, ro, ix=ix)
-        ini = ro
-    if bu < end:
-        result += get_chunks(porders, bu, end, ix=ix)
-        end = bu
-    chunks = get_chunks(porders, ini, end, ix=ix)
-    for chunk in chunks:
-        chunk[2].insert(0, order)
-        result.append(chunk)
-    return result
+import bisect
+
+
+def get_chunks(porders, ini, end):
+    """
+    Splits [ini, end) at the registered_on and billed_until dates of porders,
+    returns [ini, end, orders] chunks, orders being the porders active during the chunk
+    
+    Sweep line over the boundary dates, O(n log n) on the number of orders plus the output size.
+    Orders whose billed_until is not greater than registered_on have no duration,
+    they get a chunk of zero length on their own and do not split the chunks of other orders.
+    """
+    if ini >= end:
+        return [[ini, end, [
+            order for order in porders
+                if getattr(order, 'new_billed_until', order.billed_until) and
+                   getattr(order, 'new_billed_until', order.billed_until) > ini and
+                   order.registered_on < end
+        ]]]
+    starts = {}
+    ends = {}
+    empty = []
+    for ix, order in enumerate(porders):
+        bu = getattr(order, 'new_billed_until', order.billed_until)
+        if not bu or bu <= ini or order.registered_on >= end:
+            continue
+        if order.registered_on >= bu:
+            empty.append([bu, bu, [order]])
+            continue
+        starts.setdefault(max(order.registered_on, ini), []).append(ix)
+        ends.setdefault(min(bu, end), []).append(ix)
+    dates = sorted(set(starts).union(ends).union((ini, end)))
+    chunks = []
+    active = set()
+    for cini, cend in zip(dates, dates[1:]):
+        active.difference_update(ends.get(cini, ()))
+        active.update(starts.get(cini, ()))
+        chunks.append([cini, cend, [porders[ix] for ix in sorted(active)]])
+    return chunks + empty
 
 
 def cmp_billed_until_or_registered_on(a, b):
@@ -79,54 +97,175 @@ class Interval(object):
         return intersections
 
 
-def get_intersections(order_intervals, compensations):
-    intersections = []
-    for compensation in compensations:
-        intersection = compensation.intersect_set(order_intervals)
-        length = 0
-        for intersection_interval in intersection:
-            length += len(intersection_interval)
-        intersections.append((length, compensation))
-    return sorted(intersections, key=lambda i: i[0])
-
-
-def intersect(compensation, order_intervals):
-    # Intervals should not overlap
-    compensated = []
-    not_compensated = []
-    unused_compensation = []
-    for interval in order_intervals:
-        compensated.append(compensation.intersect(interval, unused_compensation, not_compensated))
-    return (compensated, not_compensated, unused_compensation)
-
-
-def apply_compensation(order, compensation):
-    remaining_order = []
-    remaining_compensation = []
-    applied_compensation = compensation.intersect_set(order, remaining_compensation, remaining_order)
-    return applied_compensation, remaining_order, remaining_compensation
+class IntervalTree(object):
+    """ Static centered interval tree, overlapping() runs in O(log n + k) """
+    def __init__(self, intervals):
+        intervals = [interval for interval in intervals if interval.ini < interval.end]
+        self.center = None
+        self.left = self.right = None
+        if not intervals:
+            return
+        # Median start, so at least one interval stays on this node
+        starts = sorted(interval.ini for interval in intervals)
+        self.center = center = starts[len(starts)//2]
+        left, right, middle = [], [], []
+        for interval in intervals:
+            if interval.end <= center:
+                left.append(interval)
+            elif interval.ini > center:
+                right.append(interval)
+            else:
+                middle.append(interval)
+        self.by_ini = sorted(middle, key=lambda i: i.ini)
+        self.by_end = sorted(middle, key=lambda i: i.end, reverse=True)
+        if left:
+            self.left = IntervalTree(left)
+        if right:
+            self.right = IntervalTree(right)
+    
+    def overlapping(self, ini, end):
+        """ intervals sharing at least one day with [ini, end) """
+        pending = [self]
+        while pending:
+            node = pending.pop()
+            if node.center is None:
+                continue
+            if end <= node.center:
+                for interval in node.by_ini:
+                    if interval.ini >= end:
+                        break
+                    yield interval
+                if node.left:
+                    pending.append(node.left)
+            elif ini > node.center:
+                for interval in node.by_end:
+                    if interval.end <= ini:
+                        break
+                    yield interval
+                if node.right:
+                    pending.append(node.right)
+            else:
+                for interval in node.by_ini:
+                    yield interval
+                if node.left:
+                    pending.append(node.left)
+                if node.right:
+                    pending.append(node.right)
 
 
-def update_intersections(not_compensated, compensations):
-    # TODO can be optimized
-    compensation_intervals = []
-    for __, compensation in compensations:
-        compensation_intervals.append(compensation)
-    return get_intersections(not_compensated, compensation_intervals)
+class _Candidate(object):
+    """
+    Compensation waiting to be applied, ordered as the former implementation did:
+    stable sorting by overlapping length after every application, that is, comparing
+    the current length and then the previous ones back to the original position
+    """
+    __slots__ = ('interval', 'index', 'history')
+    
+    def __init__(self, interval, index, length):
+        self.interval = interval
+        self.index = index
+        # (step, length) on every change
+        self.history = [(0, length)]
+    
+    @property
+    def length(self):
+        return self.history[-1][1]
+    
+    def __lt__(self, other):
+        ha, hb = self.history, other.history
+        ia, ib = len(ha)-1, len(hb)-1
+        while True:
+            la, lb = ha[ia][1], hb[ib][1]
+            if la != lb:
+                return la < lb
+            step = max(ha[ia][0], hb[ib][0]) - 1
+            if step < 0:
+                return self.index < other.index
+            while ha[ia][0] > step:
+                ia -= 1
+            while hb[ib][0] > step:
+                ib -= 1
 
 
 def compensate(order, compensations):
-    remaining_interval = [order]
-    ordered_intersections = get_intersections(remaining_interval, compensations)
+    """
+    Greedily applies the compensations that overlap the most with what remains of order
+    
+    returns the unused days of the applied compensations, followed by the ones not applied,
+    and the applied ones. Only the compensations sharing days with the applied ones
+    are measured again on each application, using an interval tree.
+    """
+    # What remains of order, disjoint and sorted
+    remaining = [order]
+    ends = [order.end]
+    
+    def overlapping(interval):
+        """ slice of remaining intervals that can share days with interval """
+        ini = end = bisect.bisect_right(ends, interval.ini)
+        while end < len(remaining) and remaining[end].ini < interval.end:
+            end += 1
+        return ini, end
+    
+    def overlap(interval):
+        ini, end = overlapping(interval)
+        length = 0
+        for current in remaining[ini:end]:
+            length += max((min(current.end, interval.end)-max(current.ini, interval.ini)).days, 0)
+        return length
+    
+    candidates = []
+    idle = []
+    for index, compensation in enumerate(compensations):
+        length = overlap(compensation)
+        if length:
+            candidates.append(_Candidate(compensation, index, length))
+        else:
+            # What remains of order only shrinks, it will never be applied
+            idle.append(compensation)
+    # Initial order, stable sorting by length
+    candidates.sort(key=lambda candidate: (candidate.length, candidate.index))
+    by_interval = {id(candidate.interval): candidate for candidate in candidates}
+    tree = IntervalTree([candidate.interval for candidate in candidates])
     applied_compensations = []
     remaining_compensations = []
-    while ordered_intersections and ordered_intersections[len(ordered_intersections)-1][0]>0:
-        # Apply the first compensation:
-        __, compensation = ordered_intersections.pop()
-        (applied_compensation, remaining_interval, remaining_compensation) = apply_compensation(remaining_interval, compensation)
-        remaining_compensations += remaining_compensation
-        applied_compensations += applied_compensation
-        ordered_intersections = update_intersections(remaining_interval, ordered_intersections)
-    for __, compensation in ordered_intersections:
-        remaining_compensations.append(compensation)
+    step = 0
+    while candidates and candidates[-1].length > 0:
+        step += 1
+        compensation = candidates.pop().interval
+        by_interval.pop(id(compensation))
+        applied = []
+        updated = []
+        ini, end = overlapping(compensation)
+        for current in remaining[ini:end]:
+            intersection = current.intersect(compensation)
+            if intersection:
+                applied.append(Interval(intersection.ini, intersection.end, compensation.order))
+                updated += current - compensation
+            else:
+                updated.append(current)
+        remaining[ini:end] = updated
+        ends[ini:end] = [current.end for current in updated]
+        applied_compensations += applied
+        # Only the days not used, following receivers can not use them again
+        unused = [compensation]
+        for interval in applied:
+            unused = [piece for current in unused for piece in current - interval]
+        remaining_compensations += unused
+        # Only the compensations sharing days with the applied ones have changed
+        changed = {}
+        for interval in applied:
+            for other in tree.overlapping(interval.ini, interval.end):
+                candidate = by_interval.get(id(other))
+                if candidate is not None:
+                    changed[id(other)] = candidate
+        for candidate in changed.values():
+            length = overlap(candidate.interval)
+            if length != candidate.length:
+                del candidates[bisect.bisect_left(candidates, candidate)]
+                candidate.history.append((step, length))
+                bisect.insort(candidates, candidate)
+    # Not applied ones, as sorted by the former implementation
+    remaining_compensations += idle
+    for candidate in candidates:
+        remaining_compensations.append(candidate.interval)
     return remaining_compensations, applied_compensations
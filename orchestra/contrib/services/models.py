@@ -13,6 +13,7 @@ from orchestra.utils.python import import_class
 
 from . import settings
 from .handlers import ServiceHandler
+from .rating import RateTable
 
 
 autodiscover_modules('handlers')
@@ -201,51 +202,34 @@ class Service(models.Model):
         if position is provided an specific price for that position is returned,
         accumulated price is returned otherwise
         """
-        if rates is None:
-            rates = self.get_rates(account)
-        if rates:
-            rates =  self.rate_method(rates, metric)
-        if not rates:
-            rates = [{
-                'quantity': metric,
-                'price': self.nominal_price,
-            }]
-        counter = 0
-        if position is None:
-            ant_counter = 0
-            accumulated = 0
-            for rate in rates:
-                counter += rate['quantity']
-                if counter >= metric:
-                    counter = metric
-                    accumulated += (counter - ant_counter) * rate['price']
-                    accumulated = round(accumulated, 2)
-                    return decimal.Decimal(str(accumulated))
-                ant_counter = counter
-                accumulated += rate['price'] * rate['quantity']
-            raise RuntimeError("Rating algorithm bad result")
-        else:
-            if metric < position:
-                raise ValueError("Metric can not be less than the position.")
-            for rate in rates:
-                counter += rate['quantity']
-                if counter >= position:
-                    price = round(rate['price'], 2)
-                    return decimal.Decimal(str(rate['price']))
-            raise RuntimeError("Rating algorithm bad result")
+        if not isinstance(rates, RateTable):
+            rates = self.get_rates(account) if rates is None else RateTable(self, rates)
+        return rates.get_price(metric, position=position)
     
-    def get_rates(self, account, cache=True):
-        # rates are cached per account
+    def get_prices(self, account, metrics, positions=None, rates=None):
+        """ batch get_price(), the rate algorithm runs once per distinct metric """
+        if not isinstance(rates, RateTable):
+            rates = self.get_rates(account) if rates is None else RateTable(self, rates)
+        return rates.get_prices(metrics, positions=positions)
+    
+    def get_rates(self, account, cache=True, tables=None):
+        """
+        RateTable of account, the rates queryset without cache
+        
+        tables: dict shared by the accounts of a billing run,
+        accounts with the same contracted plans reuse the same table
+        """
         if not cache:
             return self.rates.by_account(account)
-        if not hasattr(self, '__cached_rates'):
-            self.__cached_rates = {}
+        if tables is None:
+            return RateTable(self, self.rates.by_account(account))
+        key = RateTable.get_key(self, account)
         try:
-            return self.__cached_rates[account.id]
+            return tables[key]
         except KeyError:
-            rates = self.rates.by_account(account)
-            self.__cached_rates[account.id] = rates
-            return rates
+            table = RateTable(self, self.rates.by_account(account))
+            tables[key] = table
+            return table
     
     @property
     def rate_method(self):
@@ -259,6 +243,11 @@ class Service(models.Model):
         queryset = related_model.objects.all()
         if related_model._meta.model_name != 'account':
             queryset = queryset.select_related('account').all()
-        for instance in queryset:
-            updates += manager.update_by_instance(instance, service=self, commit=commit)
+        instances = list(queryset)
+        # Lazily evaluated along with the updates, compiling the expression once
+        matches = self.handler.evaluate(self.match or 'True', instances)
+        for instance, match in zip(instances, matches):
+            updates += manager.update_by_instance(instance, service=self, commit=commit,
+                matches=bool(match))
         return updates
+
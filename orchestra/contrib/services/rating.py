@@ -0,0 +1,99 @@
+import bisect
+import decimal
+
+
+class RateTable(object):
+    """
+    Rates of a service for a set of contracted plans, shared by the accounts with the same plans
+    during a billing run, see Service.get_rates()
+    
+    The rate algorithm runs once per metric, its blocks are kept as cumulative quantities
+    where the price of any position is found by bisection.
+    """
+    def __init__(self, service, rates):
+        self.service = service
+        # Evaluated once, rate algorithms iterate over its result cache
+        self.rates = rates
+        self.has_rates = bool(rates)
+        self.blocks = {}
+        self.totals = {}
+    
+    @staticmethod
+    def get_key(service, account):
+        """ accounts with the same key have the same rates """
+        plan_model = service.rates.model._meta.get_field('plan').related_model
+        plans = plan_model.objects.filter(contracts__account=account).values_list('id', flat=True)
+        # Multiple contractions of the same plan matter
+        return (service.pk, service.rate_algorithm, tuple(sorted(plans)))
+    
+    def __bool__(self):
+        return self.has_rates
+    
+    def get_blocks(self, metric):
+        """ (cumulative quantities, prices, monotonic) of the rate algorithm result for metric """
+        try:
+            return self.blocks[metric]
+        except KeyError:
+            pass
+        rates = None
+        if self.has_rates:
+            rates = self.service.rate_method(self.rates, metric)
+        if not rates:
+            rates = [{
+                'quantity': metric,
+                'price': self.service.nominal_price,
+            }]
+        quantities = []
+        prices = []
+        counter = 0
+        for rate in rates:
+            counter += rate['quantity']
+            quantities.append(counter)
+            prices.append(rate['price'])
+        monotonic = all(a <= b for a, b in zip(quantities, quantities[1:]))
+        blocks = (quantities, prices, monotonic)
+        self.blocks[metric] = blocks
+        return blocks
+    
+    def find(self, quantities, monotonic, value):
+        """ index of the first block whose cumulative quantity reaches value """
+        if monotonic:
+            ix = bisect.bisect_left(quantities, value)
+        else:
+            ix = 0
+            while ix < len(quantities) and quantities[ix] < value:
+                ix += 1
+        if ix == len(quantities):
+            raise RuntimeError("Rating algorithm bad result")
+        return ix
+    
+    def get_price(self, metric, position=None):
+        """
+        if position is provided an specific price for that position is returned,
+        accumulated price is returned otherwise
+        """
+        quantities, prices, monotonic = self.get_blocks(metric)
+        if position is not None:
+            if metric < position:
+                raise ValueError("Metric can not be less than the position.")
+            return decimal.Decimal(str(prices[self.find(quantities, monotonic, position)]))
+        try:
+            return self.totals[metric]
+        except KeyError:
+            pass
+        ix = self.find(quantities, monotonic, metric)
+        accumulated = 0
+        ant_counter = 0
+        for quantity, price in zip(quantities[:ix], prices[:ix]):
+            accumulated += price * (quantity-ant_counter)
+            ant_counter = quantity
+        accumulated += (metric - ant_counter) * prices[ix]
+        total = decimal.Decimal(str(round(accumulated, 2)))
+        self.totals[metric] = total
+        return total
+    
+    def get_prices(self, metrics, positions=None):
+        """ prices of many metrics, or of each (metric, position), in one pass """
+        if positions is None:
+            return [self.get_price(metric) for metric in metrics]
+        return [self.get_price(metric, position) for metric, position in zip(metrics, positions)]
@@ -1,5 +1,6 @@
 import datetime
 import decimal
+import random
 from functools import cmp_to_key
 
 from django.contrib.contenttypes.models import ContentType
@@ -11,6 +12,7 @@ from orchestra.utils.tests import BaseTestCase
 
 from .. import helpers
 from ..models import Service
+from ..rating import RateTable
 
 
 class Order(object):
@@ -26,6 +28,175 @@ class Order(object):
         self.pk = self.id
 
 
+def _get_chunks_recursive(porders, ini, end, ix=0):
+    """ former helpers.get_chunks(), kept as reference """
+    if ix >= len(porders):
+        return [[ini, end, []]]
+    order = porders[ix]
+    ix += 1
+    bu = getattr(order, 'new_billed_until', order.billed_until)
+    if not bu or bu <= ini or order.registered_on >= end:
+        return _get_chunks_recursive(porders, ini, end, ix=ix)
+    result = []
+    if order.registered_on < end and order.registered_on > ini:
+        ro = order.registered_on
+        result = _get_chunks_recursive(porders, ini, ro, ix=ix)
+        ini = ro
+    if bu < end:
+        result += _get_chunks_recursive(porders, bu, end, ix=ix)
+        end = bu
+    chunks = _get_chunks_recursive(porders, ini, end, ix=ix)
+    for chunk in chunks:
+        chunk[2].insert(0, order)
+        result.append(chunk)
+    return result
+
+
+def _generate_orders(num, ini, end, seed):
+    """ num concurrent orders of the same service, some of them not billed yet """
+    rand = random.Random(seed)
+    days = (end-ini).days
+    orders = []
+    for ix in range(num):
+        registered_on = ini + datetime.timedelta(days=rand.randint(-days, days))
+        billed_until = None
+        if rand.random() > 0.1:
+            billed_until = registered_on + datetime.timedelta(days=rand.randint(1, 2*days))
+        orders.append(Order(registered_on=registered_on, billed_until=billed_until))
+    return orders
+
+
+def _normalize_chunks(chunks):
+    return sorted((ini, end, [order.id for order in orders]) for ini, end, orders in chunks)
+
+
+def _get_intersections(order_intervals, compensations):
+    intersections = []
+    for compensation in compensations:
+        intersection = compensation.intersect_set(order_intervals)
+        length = sum(len(interval) for interval in intersection)
+        intersections.append((length, compensation))
+    return sorted(intersections, key=lambda i: i[0])
+
+
+def _compensate_reference(order, compensations):
+    """ former helpers.compensate(), kept as reference, without returning the days used """
+    remaining_order = [order]
+    intersections = _get_intersections(remaining_order, compensations)
+    applied_compensations = []
+    remaining_compensations = []
+    while intersections and intersections[-1][0] > 0:
+        __, compensation = intersections.pop()
+        not_compensated = []
+        applied = compensation.intersect_set(remaining_order, [], not_compensated)
+        remaining_order = not_compensated
+        unused = [compensation]
+        for interval in applied:
+            unused = [piece for current in unused for piece in current - interval]
+        remaining_compensations += unused
+        applied_compensations += applied
+        intersections = _get_intersections(
+            remaining_order, [compensation for __, compensation in intersections])
+    remaining_compensations += [compensation for __, compensation in intersections]
+    return remaining_compensations, applied_compensations
+
+
+def _generate_compensations(num, ini, end, seed):
+    """ intervals of num cancelled and billed orders spread over [ini, end) """
+    rand = random.Random(seed)
+    days = (end-ini).days
+    compensations = []
+    for ix in range(num):
+        cancelled_on = ini + datetime.timedelta(days=rand.randint(0, days))
+        billed_until = cancelled_on + datetime.timedelta(days=rand.randint(1, 30))
+        compensations.append(helpers.Interval(cancelled_on, billed_until, order=ix))
+    return compensations
+
+
+def _generate_receiver(ini, end, seed):
+    rand = random.Random(seed)
+    days = (end-ini).days
+    receiver_ini = ini + datetime.timedelta(days=rand.randint(0, days//2))
+    if rand.random() > 0.5:
+        return helpers.Interval(receiver_ini, datetime.date.max)
+    return helpers.Interval(receiver_ini, receiver_ini + datetime.timedelta(days=rand.randint(1, days)))
+
+
+def _normalize_intervals(intervals):
+    return [(interval.ini, interval.end, interval.order) for interval in intervals]
+
+
+def _get_price_reference(service, rates, metric, position=None):
+    """ former Service.get_price(), kept as reference """
+    if rates:
+        rates = service.rate_method(rates, metric)
+    if not rates:
+        rates = [{
+            'quantity': metric,
+            'price': service.nominal_price,
+        }]
+    counter = 0
+    if position is None:
+        ant_counter = 0
+        accumulated = 0
+        for rate in rates:
+            counter += rate['quantity']
+            if counter >= metric:
+                counter = metric
+                accumulated += (counter - ant_counter) * rate['price']
+                accumulated = round(accumulated, 2)
+                return decimal.Decimal(str(accumulated))
+            ant_counter = counter
+            accumulated += rate['price'] * rate['quantity']
+        raise RuntimeError("Rating algorithm bad result")
+    else:
+        if metric < position:
+            raise ValueError("Metric can not be less than the position.")
+        for rate in rates:
+            counter += rate['quantity']
+            if counter >= position:
+                return decimal.Decimal(str(rate['price']))
+        raise RuntimeError("Rating algorithm bad result")
+
+
+def _generate_blocks(metric, seed=None, monotonic=True, complete=True):
+    """
+    rate algorithm result for metric, non monotonic results go back and forth
+    incomplete results do not reach metric
+    """
+    rand = random.Random(seed)
+    blocks = []
+    counter = 0
+    target = metric if complete else metric-1
+    while counter < target or not blocks:
+        quantity = rand.randint(0, max(target-counter, 0))
+        if not monotonic and rand.random() > 0.6:
+            quantity = -rand.randint(1, 3)
+        price = decimal.Decimal(rand.randint(0, 2000)) / 100
+        blocks.append({'quantity': quantity, 'price': price})
+        counter += quantity
+        if len(blocks) > 3*metric+3:
+            break
+    if complete and counter < metric:
+        blocks.append({'quantity': metric-counter, 'price': decimal.Decimal('1.50')})
+    return blocks
+
+
+class FakeService(object):
+    """ Fake service whose rate algorithm returns random blocks for each metric """
+    def __init__(self, nominal_price=10, seed=0, monotonic=True, complete=True):
+        self.nominal_price = decimal.Decimal(nominal_price)
+        self.seed = seed
+        self.monotonic = monotonic
+        self.complete = complete
+        self.calls = 0
+    
+    def rate_method(self, rates, metric):
+        self.calls += 1
+        seed = self.seed*100003 + metric
+        return _generate_blocks(metric, seed=seed, monotonic=self.monotonic, complete=self.complete)
+
+
 class HandlerTests(BaseTestCase):
     DEPENDENCIES = (
         'orchestra.contrib.orders',
@@ -134,6 +305,60 @@ class HandlerTests(BaseTestCase):
         self.assertIn([order4.registered_on, order4.billed_until, [order2, order3, order4]], chunks)
         self.assertIn([order4.billed_until, end, [order2, order3]], chunks)
     
+    def test_get_chunks_sweep_line(self):
+        ini = datetime.date(2016, 1, 1)
+        for seed in range(50):
+            end = ini + datetime.timedelta(days=seed % 30 + 1)
+            porders = _generate_orders(seed*4 + 1, ini, end, seed=seed)
+            self.assertEqual(
+                _normalize_chunks(_get_chunks_recursive(porders, ini, end)),
+                _normalize_chunks(helpers.get_chunks(porders, ini, end))
+            )
+    
+    def test_get_chunks_without_duration(self):
+        """
+        orders with billed_until <= registered_on get a zero-length chunk of their own,
+        the former version split the other orders at their dates, with overlapping chunks
+        and a negative-length one when billed_until < registered_on
+        """
+        date = lambda day: datetime.date(2016, 1, 1) + datetime.timedelta(days=day)
+        recursive = lambda porders: _normalize_chunks(_get_chunks_recursive(porders, ini, end))
+        ini, end = date(0), date(31)
+        longer = Order(registered_on=date(0), billed_until=date(19))
+        zero = Order(registered_on=date(9), billed_until=date(9))
+        negative = Order(registered_on=date(14), billed_until=date(9))
+        chunks = helpers.get_chunks([zero, longer], ini, end)
+        self.assertEqual([
+                [date(0), date(19), [longer]],
+                [date(19), end, []],
+                [date(9), date(9), [zero]],
+            ], chunks
+        )
+        self.assertEqual([
+                (date(0), date(9), [longer.id]),
+                (date(9), date(9), [zero.id, longer.id]),
+                (date(9), date(19), [longer.id]),
+                (date(19), end, []),
+            ], recursive([zero, longer])
+        )
+        chunks = helpers.get_chunks([negative, longer], ini, end)
+        self.assertEqual([
+                [date(0), date(19), [longer]],
+                [date(19), end, []],
+                [date(9), date(9), [negative]],
+            ], chunks
+        )
+        self.assertEqual([
+                (date(0), date(14), [longer.id]),
+                (date(9), date(19), [longer.id]),
+                (date(14), date(9), [negative.id, longer.id]),
+                (date(19), end, []),
+            ], recursive([negative, longer])
+        )
+        # Outside [ini, end) they have no chunk
+        outside = Order(registered_on=ini, billed_until=ini)
+        self.assertEqual([[ini, end, []]], helpers.get_chunks([outside], ini, end))
+    
     def test_sort_billed_until_or_registered_on(self):
         now = timezone.now().date()
         order = Order(
@@ -220,6 +445,40 @@ class HandlerTests(BaseTestCase):
                 self.assertEqual(test_line[1], compensation.end)
                 self.assertEqual(test_line[2], compensation.order)
     
+    def test_compensate_interval_tree(self):
+        """ same results as the former implementation without returning used days """
+        ini = datetime.date(2016, 1, 1)
+        for seed in range(200):
+            end = ini + datetime.timedelta(days=(5, 10, 30, 400)[seed % 4])
+            compensations = _generate_compensations(seed % 40, ini, end, seed=seed)
+            reference = remaining = compensations
+            for ix in range(3):
+                order = _generate_receiver(ini, end, seed=seed*3+ix)
+                reference, reference_used = _compensate_reference(order, reference)
+                remaining, used = helpers.compensate(order, remaining)
+                self.assertEqual(_normalize_intervals(reference_used), _normalize_intervals(used))
+                self.assertEqual(_normalize_intervals(reference), _normalize_intervals(remaining))
+    
+    def test_compensate_used_days(self):
+        """ days of a partially applied compensation are not returned again """
+        date = lambda day: datetime.date(2016, 1, 1) + datetime.timedelta(days=day)
+        compensations = [
+            helpers.Interval(date(40), date(60), order=1),
+            helpers.Interval(date(55), date(70), order=2),
+        ]
+        order = helpers.Interval(date(0), date(100))
+        remaining, used = helpers.compensate(order, compensations)
+        # The first splits what remains of order in two
+        self.assertEqual([
+                (date(40), date(60), 1),
+                (date(60), date(70), 2),
+            ], _normalize_intervals(used)
+        )
+        self.assertEqual([(date(55), date(60), 2)], _normalize_intervals(remaining))
+        # The days used by order are not available to another receiver
+        remaining, used = helpers.compensate(helpers.Interval(date(60), date(70)), remaining)
+        self.assertEqual([], used)
+    
     def test_rates(self):
         service = self.create_ftp_service()
         account = self.create_account()
@@ -470,7 +729,7 @@ class HandlerTests(BaseTestCase):
             },
         ]
         self.validate_results(rates, results)
-        
+    
     def test_best_price_multiple(self):
         service = self.create_ftp_service(rate_algorithm='orchestra.contrib.plans.ratings.best_price')
         account = self.create_account()
@@ -535,3 +794,42 @@ class HandlerTests(BaseTestCase):
             },
         ]
         self.validate_results(rates, results)
+    
+    def get_rating_outcome(self, func, *args):
+        try:
+            return func(*args)
+        except (RuntimeError, ValueError) as exc:
+            return type(exc)
+    
+    def test_rate_table(self):
+        for seed in range(60):
+            for rates in (['rate'], []):
+                service = FakeService(nominal_price=seed % 13, seed=seed,
+                    monotonic=bool(seed % 2), complete=bool(seed % 5))
+                table = RateTable(service, rates)
+                for metric in range(12):
+                    for position in [None] + list(range(metric+2)):
+                        self.assertEqual(
+                            self.get_rating_outcome(
+                                _get_price_reference, service, rates, metric, position),
+                            self.get_rating_outcome(table.get_price, metric, position)
+                        )
+    
+    def test_rate_table_get_prices(self):
+        service = FakeService(seed=7, monotonic=False)
+        table = RateTable(service, ['rate'])
+        metrics = [5, 5, 5, 5, 5, 9, 9]
+        positions = [1, 2, 3, 4, 5, 1, 9]
+        self.assertEqual(
+            [_get_price_reference(service, ['rate'], metric, position)
+                for metric, position in zip(metrics, positions)],
+            table.get_prices(metrics, positions=positions)
+        )
+        self.assertEqual(
+            [_get_price_reference(service, ['rate'], metric) for metric in metrics],
+            table.get_prices(metrics)
+        )
+        calls = service.calls
+        table.get_prices(metrics, positions=positions)
+        # The rate algorithm runs once per metric
+        self.assertEqual(calls, service.calls)
@@ -18,6 +18,8 @@ class UNIXUserController(ServiceController):
     verbose_name = _("UNIX user")
     model = 'systemusers.SystemUser'
     actions = ('save', 'delete', 'set_permission', 'validate_paths_exist', 'create_link')
+    select_related = ('account__main_systemuser',)
+    prefetch_related = ('account__systemusers', 'groups')
     doc_settings = (settings, (
         'SYSTEMUSERS_DEFAULT_GROUP_MEMBERS',
         'SYSTEMUSERS_MOVE_ON_DELETE_PATH',
@@ -228,9 +230,11 @@ class UNIXUserController(ServiceController):
             )
     
     def get_groups(self, user):
+        # Filtered in Python in order to take advantage of prefetched users and groups
         if user.is_main:
-            return user.account.systemusers.exclude(username=user.username).values_list('username', flat=True)
-        return list(user.groups.values_list('username', flat=True))
+            return [ sibling.username for sibling in user.account.systemusers.all()
+                     if sibling.username != user.username ]
+        return [ group.username for group in user.groups.all() ]
     
     def get_context(self, user):
         context = {
@@ -296,7 +300,9 @@ class Exim4Traffic(ServiceMonitor):
         context = {
             'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
             'mainlogs': str((mainlog, mainlog+'.1')),
+            'cursor_path': repr(self.get_log_cursor_path(mainlog)),
         }
+        self.append_log_reader()
         self.append(textwrap.dedent("""\
             import re
             import sys
@@ -310,6 +316,7 @@ class Exim4Traffic(ServiceMonitor):
                 return date
             
             mainlogs = {mainlogs}
+            cursor_path = {cursor_path}
             # Use local timezone
             end_date = to_local_timezone('{current_date}')
             end_date = int(end_date.strftime('%Y%m%d%H%M%S'))
@@ -321,26 +328,29 @@ class Exim4Traffic(ServiceMonitor):
                 ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
                 users[username] = [ini_date, object_id, 0]
             
-            def monitor(users, end_date, mainlogs):
+            def get_date(line):
+                try:
+                    date, time = line.split()[:2]
+                    return int(date.replace('-', '') + time.replace(':', ''))
+                except ValueError:
+                    return None
+            
+            def monitor(users, end_date, mainlogs, cursor_path):
                 user_regex = re.compile(r' U=([^ ]+) ')
-                for mainlog in mainlogs:
-                    try:
-                        with open(mainlog, 'r') as mainlog:
-                            for line in mainlog.readlines():
-                                if ' <= ' in line and 'P=local' in line:
-                                    username = user_regex.search(line).groups()[0]
-                                    try:
-                                        sender = users[username]
-                                    except KeyError:
-                                        continue
-                                    else:
-                                        date, time, id, __, __, user, protocol, size = line.split()[:8]
-                                        date = date.replace('-', '')
-                                        date += time.replace(':', '')
-                                        if sender[0] < int(date) < end_date:
-                                            sender[2] += int(size[2:])
-                    except IOError as e:
-                        sys.stderr.write(e)
+                if users:
+                    # Single pass over the new lines for all users
+                    ini_date = min(user[0] for user in users.values())
+                    for date, line in read_logs(mainlogs, cursor_path, ini_date, end_date, get_date):
+                        if ' <= ' in line and 'P=local' in line:
+                            username = user_regex.search(line).groups()[0]
+                            try:
+                                sender = users[username]
+                            except KeyError:
+                                continue
+                            else:
+                                size = line.split()[7]
+                                if sender[0] < date:
+                                    sender[2] += int(size[2:])
                 
                 for username, opts in users.iteritems():
                     __, object_id, size = opts
@@ -349,7 +359,7 @@ class Exim4Traffic(ServiceMonitor):
         )
     
     def commit(self):
-        self.append('monitor(users, end_date, mainlogs)')
+        self.append('monitor(users, end_date, mainlogs, cursor_path)')
     
     def monitor(self, user):
         context = self.get_context(user)
@@ -382,7 +392,9 @@ class VsFTPdTraffic(ServiceMonitor):
         context = {
             'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
             'vsftplogs': str((vsftplog, vsftplog+'.1')),
+            'cursor_path': repr(self.get_log_cursor_path(vsftplog)),
         }
+        self.append_log_reader()
         self.append(textwrap.dedent("""\
             import re
             import sys
@@ -396,6 +408,7 @@ class VsFTPdTraffic(ServiceMonitor):
                 return date
             
             vsftplogs = {vsftplogs}
+            cursor_path = {cursor_path}
             # Use local timezone
             end_date = to_local_timezone('{current_date}')
             end_date = int(end_date.strftime('%Y%m%d%H%M%S'))
@@ -409,27 +422,30 @@ class VsFTPdTraffic(ServiceMonitor):
                 ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
                 users[username] = [ini_date, object_id, 0]
             
-            def monitor(users, end_date, months, vsftplogs):
+            def get_date(line):
+                try:
+                    __, month, day, time, year = line.split()[:5]
+                    return int(year + months[month] + day + time.replace(':', ''))
+                except (ValueError, KeyError):
+                    return None
+            
+            def monitor(users, end_date, months, vsftplogs, cursor_path):
                 user_regex = re.compile(r'\] \[([^ ]+)\] (OK|FAIL) ')
                 bytes_regex = re.compile(r', ([0-9]+) bytes, ')
-                for vsftplog in vsftplogs:
-                    try:
-                        with open(vsftplog, 'r') as vsftplog:
-                            for line in vsftplog.readlines():
-                                if ' bytes, ' in line:
-                                    username = user_regex.search(line).groups()[0]
-                                    try:
-                                        user = users[username]
-                                    except KeyError:
-                                        continue
-                                    else:
-                                        __, month, day, time, year = line.split()[:5]
-                                        date = year + months[month] + day + time.replace(':', '')
-                                        if user[0] < int(date) < end_date:
-                                            bytes = bytes_regex.search(line).groups()[0]
-                                            user[2] += int(bytes)
-                    except IOError as e:
-                        sys.stderr.write(e)
+                if users:
+                    # Single pass over the new lines for all users
+                    ini_date = min(user[0] for user in users.values())
+                    for date, line in read_logs(vsftplogs, cursor_path, ini_date, end_date, get_date):
+                        if ' bytes, ' in line:
+                            username = user_regex.search(line).groups()[0]
+                            try:
+                                user = users[username]
+                            except KeyError:
+                                continue
+                            else:
+                                if user[0] < date:
+                                    bytes = bytes_regex.search(line).groups()[0]
+                                    user[2] += int(bytes)
                 
                 for username, opts in users.items():
                     __, object_id, size = opts
@@ -442,7 +458,7 @@ class VsFTPdTraffic(ServiceMonitor):
         self.append("prepare(%(object_id)s, '%(username)s', '%(last_date)s')" % context)
     
     def commit(self):
-        self.append('monitor(users, end_date, months, vsftplogs)')
+        self.append('monitor(users, end_date, months, vsftplogs, cursor_path)')
     
     def get_context(self, user):
         context = {
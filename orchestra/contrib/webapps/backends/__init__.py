@@ -10,6 +10,9 @@ class WebAppServiceMixin(object):
         ('webapps.WebAppOption', 'webapp'),
     )
     directive = None
+    dependencies = ('UNIXUserController',)
+    select_related = ('account__main_systemuser',)
+    prefetch_related = ('options', 'content_set')
     doc_settings = (settings,
         ('WEBAPPS_UNDER_CONSTRUCTION_PATH', 'WEBAPPS_MOVE_ON_DELETE_PATH',)
     )
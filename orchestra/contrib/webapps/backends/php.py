@@ -142,9 +142,16 @@ class PHPController(WebAppServiceMixin, ServiceController):
         super(PHPController, self).prepare()
         self.append(textwrap.dedent("""
             BACKEND="PHPController"
-            echo "$BACKEND" >> /dev/shm/reload.apache2
+            [[ -n "$ORCHESTRA_RELOADS" ]] || echo "$BACKEND" >> /dev/shm/reload.apache2
             
             function coordinate_apache_reload () {
+                if [[ -n "$ORCHESTRA_RELOADS" ]]; then
+                    # Bundled execution, Apache is reloaded once after all the backends have run
+                    if [[ $UPDATED_APACHE -eq 1 ]]; then
+                        echo "apache2 $ORCHESTRA_SECTION" >> $ORCHESTRA_RELOADS
+                    fi
+                    return 0
+                fi
                 # Coordinate Apache reload with other concurrent backends (e.g. Apache2Controller)
                 is_last=0
                 counter=0
@@ -56,8 +56,12 @@ class WebApp(models.Model):
     
     def get_options(self, **kwargs):
         options = OrderedDict()
-        qs = WebAppOption.objects.filter(**kwargs)
-        for name, value in qs.values_list('name', 'value').order_by('name'):
+        if kwargs == {'webapp_id': self.pk} and self.has_prefetched_options():
+            values = sorted((option.name, option.value) for option in self.options.all())
+        else:
+            qs = WebAppOption.objects.filter(**kwargs)
+            values = qs.values_list('name', 'value').order_by('name')
+        for name, value in values:
             if name in options:
                 if AppOption.get(name).comma_separated:
                     options[name] = options[name].rstrip(',') + ',' + value.lstrip(',')
@@ -67,6 +71,9 @@ class WebApp(models.Model):
                 options[name] = value
         return options
     
+    def has_prefetched_options(self):
+        return 'options' in getattr(self, '_prefetched_objects_cache', {})
+    
     def get_directive(self):
         return self.type_instance.get_directive()
     
@@ -79,7 +86,13 @@ class WebApp(models.Model):
     
     def get_path(self):
         path = self.get_base_path()
-        public_root = self.options.filter(name='public-root').first()
+        if self.has_prefetched_options():
+            public_root = None
+            for option in self.options.all():
+                if option.name == 'public-root':
+                    public_root = option
+        else:
+            public_root = self.options.filter(name='public-root').first()
         if public_root:
             path = os.path.join(path, public_root.value)
         return os.path.normpath(path.replace('//', '/'))
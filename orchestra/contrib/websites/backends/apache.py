@@ -27,6 +27,14 @@ class Apache2Controller(ServiceController):
         ('websites.WebsiteDirective', 'website'),
         ('webapps.WebApp', 'website_set'),
     )
+    dependencies = ('UNIXUserController', 'PHPController')
+    select_related = ('account__main_systemuser',)
+    prefetch_related = (
+        'domains',
+        'directives',
+        'content_set__webapp__account__main_systemuser',
+        'content_set__webapp__options',
+    )
     verbose_name = _("Apache 2")
     doc_settings = (settings, (
         'WEBSITES_VHOST_EXTRA_DIRECTIVES',
@@ -146,9 +154,16 @@ class Apache2Controller(ServiceController):
         # Coordinate apache restart with php backend in order not to overdo it
         self.append(textwrap.dedent("""
             BACKEND="Apache2Controller"
-            echo "$BACKEND" >> /dev/shm/reload.apache2
+            [[ -n "$ORCHESTRA_RELOADS" ]] || echo "$BACKEND" >> /dev/shm/reload.apache2
             
             function coordinate_apache_reload () {
+                if [[ -n "$ORCHESTRA_RELOADS" ]]; then
+                    # Bundled execution, Apache is reloaded once after all the backends have run
+                    if [[ $UPDATED_APACHE -eq 1 ]]; then
+                        echo "apache2 $ORCHESTRA_SECTION" >> $ORCHESTRA_RELOADS
+                    fi
+                    return 0
+                fi
                 # Coordinate Apache reload with other concurrent backends (e.g. PHPController)
                 is_last=0
                 counter=0
@@ -383,7 +398,7 @@ class Apache2Controller(ServiceController):
     def get_server_names(self, site):
         server_name = None
         server_alias = []
-        for domain in site.domains.all().order_by('name'):
+        for domain in sorted(site.domains.all(), key=lambda domain: domain.name):
             if not server_name and not domain.name.startswith('*'):
                 server_name = domain.name
             else:
@@ -432,66 +447,100 @@ class Apache2Traffic(ServiceMonitor):
     model = 'websites.Website'
     resource = ServiceMonitor.TRAFFIC
     verbose_name = _("Apache 2 Traffic")
+    script_executable = '/usr/bin/python'
     monthly_sum_old_values = True
     doc_settings = (settings,
         ('WEBSITES_TRAFFIC_IGNORE_HOSTS',)
     )
     
     def prepare(self):
-        super(Apache2Traffic, self).prepare()
-        ignore_hosts = '\\|'.join(settings.WEBSITES_TRAFFIC_IGNORE_HOSTS)
         context = {
             'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
-            'ignore_hosts': '-v "%s"' % ignore_hosts if ignore_hosts else '',
+            'ignore_hosts': str(settings.WEBSITES_TRAFFIC_IGNORE_HOSTS),
         }
+        self.append_log_reader()
         self.append(textwrap.dedent("""\
-            function monitor () {
-                OBJECT_ID=$1
-                INI_DATE=$(date "+%%Y%%m%%d%%H%%M%%S" -d "$2")
-                END_DATE=$(date '+%%Y%%m%%d%%H%%M%%S' -d '%(current_date)s')
-                LOG_FILE="$3"
-                {
-                    { grep %(ignore_hosts)s ${LOG_FILE} || echo -e '\\r'; } \\
-                        | awk -v ini="${INI_DATE}" -v end="${END_DATE}" '
-                            BEGIN {
-                                sum = 0
-                                months["Jan"] = "01"
-                                months["Feb"] = "02"
-                                months["Mar"] = "03"
-                                months["Apr"] = "04"
-                                months["May"] = "05"
-                                months["Jun"] = "06"
-                                months["Jul"] = "07"
-                                months["Aug"] = "08"
-                                months["Sep"] = "09"
-                                months["Oct"] = "10"
-                                months["Nov"] = "11"
-                                months["Dec"] = "12"
-                            } {
-                                # date = [11/Jul/2014:13:50:41
-                                date = substr($4, 2)
-                                year = substr(date, 8, 4)
-                                month = months[substr(date, 4, 3)];
-                                day = substr(date, 1, 2)
-                                hour = substr(date, 13, 2)
-                                minute = substr(date, 16, 2)
-                                second = substr(date, 19, 2)
-                                line_date = year month day hour minute second
-                                if ( line_date > ini && line_date < end)
-                                    sum += $NF
-                            } END {
-                                print sum
-                            }' || [[ $? == 1 ]] && true
-                } | xargs echo ${OBJECT_ID}
-            }""") % context)
+            import re
+            import sys
+            from datetime import datetime
+            from dateutil import tz
+            
+            def to_local_timezone(date, tzlocal=tz.tzlocal()):
+                date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S %Z')
+                date = date.replace(tzinfo=tz.tzutc())
+                date = date.astimezone(tzlocal)
+                return date
+            
+            # Use local timezone
+            end_date = to_local_timezone('{current_date}')
+            end_date = int(end_date.strftime('%Y%m%d%H%M%S'))
+            ignore_hosts = {ignore_hosts}
+            ignore_hosts = re.compile('|'.join(ignore_hosts)) if ignore_hosts else None
+            # {{log_file: (cursor_path, [[ini_date, object_id, size], ...])}}
+            logs = {{}}
+            months = {{
+                'Jan': '01',
+                'Feb': '02',
+                'Mar': '03',
+                'Apr': '04',
+                'May': '05',
+                'Jun': '06',
+                'Jul': '07',
+                'Aug': '08',
+                'Sep': '09',
+                'Oct': '10',
+                'Nov': '11',
+                'Dec': '12',
+            }}
+            
+            def prepare(object_id, log_file, cursor_path, ini_date):
+                global logs
+                ini_date = to_local_timezone(ini_date)
+                ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
+                logs.setdefault(log_file, (cursor_path, []))[1].append([ini_date, object_id, 0])
+            
+            def get_date(line):
+                try:
+                    # [11/Jul/2014:13:50:41
+                    date = line.split()[3]
+                    day, month, date = date[1:].split('/')
+                    year, hour, min, sec = date.split(':')
+                    return int(year + months[month] + day + hour + min + sec)
+                except (ValueError, KeyError, IndexError):
+                    return None
+            
+            def monitor(logs, end_date):
+                for log_file, (cursor_path, sites) in logs.items():
+                    # Websites sharing a log file are computed on a single pass
+                    ini_date = min(site[0] for site in sites)
+                    for date, line in read_logs((log_file, log_file+'.1'), cursor_path, ini_date,
+                            end_date, get_date):
+                        if ignore_hosts and ignore_hosts.search(line):
+                            continue
+                        try:
+                            size = int(line.split()[-1])
+                        except (ValueError, IndexError):
+                            continue
+                        for site in sites:
+                            if site[0] < date:
+                                site[2] += size
+                    for ini_date, object_id, size in sites:
+                        sys.stdout.write('%s %s\\n' % (object_id, size))
+            """).format(**context)
+        )
     
     def monitor(self, site):
         context = self.get_context(site)
-        self.append('monitor {object_id} "{last_date}" {log_file}'.format(**context))
+        self.append("prepare(%(object_id)s, '%(log_file)s', %(cursor_path)s, '%(last_date)s')" % context)
+    
+    def commit(self):
+        self.append('monitor(logs, end_date)')
     
     def get_context(self, site):
+        log_file = site.get_www_access_log_path()
         return {
-            'log_file': '%s{,.1}' % site.get_www_access_log_path(),
+            'log_file': log_file,
+            'cursor_path': repr(self.get_log_cursor_path(log_file)),
             'last_date': self.get_last_date(site.pk).strftime("%Y-%m-%d %H:%M:%S %Z"),
             'object_id': site.pk,
         }
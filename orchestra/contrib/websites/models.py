@@ -79,7 +79,8 @@ class Website(models.Model):
     @cached
     def get_directives(self):
         directives = OrderedDict()
-        for opt in self.directives.all().order_by('name', 'value'):
+        # Sorted in Python in order to take advantage of prefetched directives
+        for opt in sorted(self.directives.all(), key=lambda opt: (opt.name, opt.value)):
             try:
                 directives[opt.name].append(opt.value)
             except KeyError:
@@ -1,4 +1,5 @@
 import sys
+import threading
 
 from django import db
 from django.conf import settings as djsettings
@@ -60,3 +61,32 @@ class clone(object):
         db.connections[self.target].close()
         djsettings.DATABASES.pop(self.target)
         db.connections = self.old_connections
+
+
+_autocommit_lock = threading.Lock()
+
+
+def autocommit(model=None, origin='', max_age=None):
+    """
+    alias of a long-lived autocommit connection for making queries outside the current transaction
+    
+        log = BackendLog.objects.using(db.autocommit(model=BackendLog)).create()
+    
+    The alias is registered once per process and, unlike clone, shares the ConnectionHandler,
+    thus each thread keeps reusing its connection across requests until max_age (None: forever)
+    """
+    if model is not None:
+        origin = db.router.db_for_write(model)
+    origin = origin or db.DEFAULT_DB_ALIAS
+    target = 'autocommit_' + origin
+    if target not in db.connections.databases:
+        with _autocommit_lock:
+            if target not in db.connections.databases:
+                settings_dict = dict(db.connections[origin].settings_dict)
+                settings_dict.update({
+                    'AUTOCOMMIT': True,
+                    'ATOMIC_REQUESTS': False,
+                    'CONN_MAX_AGE': max_age,
+                })
+                db.connections.databases[target] = settings_dict
+    return target
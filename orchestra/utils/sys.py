@@ -67,8 +67,81 @@ def read_async(fd):
             return ''
 
 
-def runiterator(command, display=False, stdin=b''):
-    """ Subprocess wrapper for running commands concurrently """
+class LineBuffer(object):
+    """
+    Calls callback with every complete line fed, without the line terminator,
+    content can be either bytes or text, as long as it is always the same
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.pending = None
+        self.lines = 0
+    
+    def feed(self, content):
+        if not content:
+            return
+        if self.pending:
+            content = self.pending + content
+        lines = content.splitlines(True)
+        last = lines[-1]
+        if last.endswith(b'\n' if isinstance(last, bytes) else '\n'):
+            self.pending = None
+        else:
+            self.pending = lines.pop()
+        for line in lines:
+            self.lines += 1
+            self.callback(self.strip(line))
+    
+    def strip(self, line):
+        """ removes the line terminator only, other trailing whitespace is content """
+        newline = b'\n' if isinstance(line, bytes) else '\n'
+        carriage = b'\r' if isinstance(line, bytes) else '\r'
+        if line.endswith(newline):
+            line = line[:-1]
+            if line.endswith(carriage):
+                line = line[:-1]
+        return line
+    
+    def close(self):
+        """ flushes the last line when it has no terminator """
+        if self.pending:
+            self.lines += 1
+            self.callback(self.pending)
+            self.pending = None
+
+
+class OutputBuffer(object):
+    """
+    Accumulates output in a bytearray, avoiding the quadratic cost of bytes concatenation
+    
+    max_size keeps only the last max_size bytes, bounding memory usage of long outputs
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.buffer = bytearray()
+        self.truncated = False
+    
+    def write(self, content):
+        self.buffer += content
+        if self.max_size and len(self.buffer) > self.max_size:
+            del self.buffer[:len(self.buffer)-self.max_size]
+            self.truncated = True
+    
+    def getvalue(self):
+        return bytes(self.buffer)
+
+
+def runiterator(command, display=False, stdin=b'', chunk_size=65536, poll_interval=0.2):
+    """
+    Subprocess wrapper for running commands concurrently
+    
+    Yields the same state object every time new output is available, its stdout and stderr
+    hold only the output read since the previous iteration. The last one has the exit_code.
+    
+    Reading stops once the process has exited and its pipes are drained, without waiting
+    for EOF. Background processes, i.e. the ssh ControlMaster, may inherit the pipes and
+    keep them open. poll_interval is how often the process is checked while no output arrives.
+    """
     if display:
         sys.stderr.write("\n\033[1m $ %s\033[0m\n" % command)
     
@@ -79,57 +152,85 @@ def runiterator(command, display=False, stdin=b''):
     p.stdin.close()
     yield
     
-    make_async(p.stdout)
-    make_async(p.stderr)
+    stdout_fd = p.stdout.fileno()
+    stderr_fd = p.stderr.fileno()
+    make_async(stdout_fd)
+    make_async(stderr_fd)
+    
+    state = _Attribute(b'')
+    state.stderr = b''
+    state.exit_code = None
+    state.command = command
     
     # Async reading of stdout and sterr
-    while True:
-        stdout = b''
-        stderr = b''
-        # Get complete unicode chunks
-        select.select([p.stdout, p.stderr], [], [])
-        
-        stdoutPiece = read_async(p.stdout)
-        stderrPiece = read_async(p.stderr)
-        
-        stdout += (stdoutPiece or b'')
-        #.decode('ascii'), errors='replace')
-        stderr += (stderrPiece or b'')
-        #.decode('ascii'), errors='replace')
+    fds = [stdout_fd, stderr_fd]
+    exit_code = None
+    while fds:
+        # Once exited, what the process wrote is already buffered in the pipes
+        timeout = poll_interval if exit_code is None else 0
+        ready, __, __ = select.select(fds, [], [], timeout)
+        if exit_code is not None and not ready:
+            break
+        pieces = {stdout_fd: b'', stderr_fd: b''}
+        for fd in ready:
+            try:
+                piece = os.read(fd, chunk_size)
+            except BlockingIOError:
+                continue
+            if piece:
+                pieces[fd] = piece
+            else:
+                fds.remove(fd)
+        stdout = pieces[stdout_fd]
+        stderr = pieces[stderr_fd]
         
         if display and stdout:
-            sys.stdout.write(stdout.decode('utf8'))
+            sys.stdout.write(stdout.decode('utf8', errors='replace'))
         if display and stderr:
-            sys.stderr.write(stderr.decode('utf8'))
+            sys.stderr.write(stderr.decode('utf8', errors='replace'))
         
-        state = _Attribute(stdout)
-        state.stderr = stderr
-        state.exit_code =  p.poll()
-        state.command = command
-        yield state
-        
-        if state.exit_code != None:
-            p.stdout.close()
-            p.stderr.close()
-            raise StopIteration
+        if exit_code is None:
+            exit_code = p.poll()
+        if stdout or stderr:
+            state.stdout = stdout
+            state.stderr = stderr
+            yield state
+    
+    state.stdout = b''
+    state.stderr = b''
+    state.exit_code = p.wait()
+    p.stdout.close()
+    p.stderr.close()
+    yield state
 
 
-def join(iterator, display=False, silent=False, valid_codes=(0,)):
-    """ joins the iterator process """
-    stdout = b''
-    stderr = b''
+def join(iterator, display=False, silent=False, valid_codes=(0,), max_buffer=None, line_callback=None):
+    """
+    joins the iterator process
+    
+    max_buffer: keep only the last max_buffer bytes of each stream
+    line_callback: called with every stdout line (bytes) as soon as it is complete
+    """
+    stdout = OutputBuffer(max_buffer)
+    stderr = OutputBuffer(max_buffer)
+    lines = LineBuffer(line_callback) if line_callback else None
     for state in iterator:
-        stdout += state.stdout
-        stderr += state.stderr
+        stdout.write(state.stdout)
+        stderr.write(state.stderr)
+        if lines:
+            lines.feed(state.stdout)
+    if lines:
+        lines.close()
     
     exit_code = state.exit_code
     
-    out = _Attribute(stdout.strip())
-    err = stderr.strip()
+    out = _Attribute(stdout.getvalue().strip())
+    err = stderr.getvalue().strip()
     
     out.failed = False
     out.exit_code = exit_code
     out.stderr = err
+    out.truncated = stdout.truncated or stderr.truncated
     if exit_code not in valid_codes:
         out.failed = True
         msg = "\nrun() encountered an error (return code %s) while executing '%s'\n"
@@ -151,12 +252,14 @@ def joinall(iterators, **kwargs):
     return results
 
 
-def run(command, display=False, valid_codes=(0,), silent=False, stdin=b'', async=False):
+def run(command, display=False, valid_codes=(0,), silent=False, stdin=b'', async=False,
+        max_buffer=None, line_callback=None):
     iterator = runiterator(command, display, stdin)
     next(iterator)
     if async:
         return iterator
-    return join(iterator, display=display, silent=silent, valid_codes=valid_codes)
+    return join(iterator, display=display, silent=silent, valid_codes=valid_codes,
+        max_buffer=max_buffer, line_callback=line_callback)
 
 
 def sshrun(addr, command, *args, executable='bash', persist=False, options=None, **kwargs):